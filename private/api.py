@@ -7,15 +7,24 @@ import importlib.util
 import logging
 import os
 import sys
+import time
+import uuid
 import uvicorn
 
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, APIRouter
+from fastapi import APIRouter, Depends, FastAPI, HTTPException, Request
 from fastapi.openapi.docs import get_swagger_ui_html
-from fastapi.responses import JSONResponse
-from lib import configure_logging
-from lib.server import register_acl_with_boss
-from typing import List
+from fastapi.responses import JSONResponse, PlainTextResponse
+from lib import configure_logging, database, get_option, metrics, startup
+from lib.state import BOOT_ID_ENV, WORKERS_ENV, is_multi_worker, once_per_boot
+from lib.admission import AdmissionMiddleware, get_admission_stats
+from lib.conditional import get_conditional_stats
+from lib.logqueue import get_logging_stats, stop_logging
+from lib.metrics import MetricsMiddleware
+from lib.workers import get_process_stats, get_worker_stats, shutdown_workers
+from lib.server import close_backend_client, close_outbox, open_backend_client, register_acl_with_boss
+from lib.server import get_backend_client_stats, get_lookup_stats, get_outbox_stats, get_session_cache_stats, get_user_directory_stats
+from typing import List, Tuple
 
 configure_logging(logging.INFO, service_name="boss")
 
@@ -25,9 +34,19 @@ def get_app_dir() -> str:
 def get_apps() -> List[str]:
     return os.listdir(get_app_dir())
 
-def get_app_routers() -> List[APIRouter]:
+def get_app_routers() -> List[Tuple[str, APIRouter, list]]:
+    """ Import every app, and start them.
+
+    Apps are imported one at a time, then started at the same time. See
+    `lib/startup.py`.
+
+    Returns:
+        (bundle ID, router, dependencies to include it with), for each app
+        with a router.
+    """
     app_folders = get_apps()
     routers = []
+    starts = {}
 
     for app in app_folders:
         logging.info(f"Loading app ({app})")
@@ -47,32 +66,62 @@ def get_app_routers() -> List[APIRouter]:
         # Register the module in sys.modules with the dotted name (e.g. io.bithead.boss)
         # This allows for relative imports
         sys.modules[module_name] = module
+        began = time.perf_counter()
         try:
             spec.loader.exec_module(module)
         except Exception as e:
             logging.error(f"Failed to load module ({module_name}): {str(e)}")
             continue
+        startup.record(module_name, startup.IMPORT, time.perf_counter() - began)
 
+        dependencies = []
         if hasattr(module, "start"):
-            module.start()
+            if getattr(module, "LAZY_START", False):
+                dependencies.append(Depends(startup.LazyStart(module_name, module.start)))
+            else:
+                starts[module_name] = module.start
+        if hasattr(module, "shutdown"):
+            startup.on_shutdown(module_name, module.shutdown)
 
         if hasattr(module, "router"): # Should have `router` var
-            routers.append(module.router)
+            routers.append((module_name, module.router, dependencies))
         else:
             logging.warning(f"Module ({module_name}) does not have a 'router' attribute")
             continue
 
+    startup.start_apps(starts)
     return routers
 
 @asynccontextmanager
 async def register_services_with_boss(app):
-    """ Called once when the app starts. """
+    """ Called once when the app starts, and resumed once when it stops.
+
+    The pooled client to the Swift backend lives exactly as long as the app.
+    Apps are shut down first, then events still in the outbox are sent
+    before the client closes. Pooled database
+    connections are closed next, and queued log records are written last.
+    """
+    open_backend_client()
     try:
-        await register_acl_with_boss()
-    except Exception as error:
-        logging.error("Failed to register ACL with BOSS. Shutting down.")
-        raise error
-    yield
+        # Every worker has the same apps. The first to start registers them.
+        if once_per_boot("acl-registration"):
+            try:
+                await register_acl_with_boss()
+            except Exception as error:
+                logging.error("Failed to register ACL with BOSS. Shutting down.")
+                raise error
+        yield
+    finally:
+        try:
+            await startup.shutdown_apps()
+            await close_outbox()
+        finally:
+            await close_backend_client()
+            # Work still running may be using a connection
+            shutdown_workers()
+            # Checkpoints each WAL into its database
+            database.close()
+            stop_logging()
 
 # Add routes to app.
 #
@@ -99,6 +148,29 @@ if __name__ != "__main__":
         },
         lifespan=register_services_with_boss
     )
+    # Added first, so it runs inside the metrics middleware: a request that
+    # waits to be admitted, or is refused, is still timed.
+    app.add_middleware(AdmissionMiddleware)
+    app.add_middleware(MetricsMiddleware)
+
+    metrics.add_collector("backend_client", get_backend_client_stats)
+    metrics.add_collector("session_cache", get_session_cache_stats)
+    metrics.add_collector("backend_lookups", get_lookup_stats)
+    metrics.add_collector("outbox", get_outbox_stats)
+    metrics.add_collector("user_directory", get_user_directory_stats)
+    metrics.add_collector("sqlite", database.get_database_stats)
+    metrics.add_collector("workers", get_worker_stats)
+    metrics.add_collector("processes", get_process_stats)
+    metrics.add_collector("logging", get_logging_stats)
+    metrics.add_collector("conditional_get", get_conditional_stats)
+    metrics.add_collector("admission", get_admission_stats)
+
+    @app.get("/api/metrics", include_in_schema=False)
+    async def get_metrics(request: Request):
+        """ Request and backend metrics, for Prometheus to scrape. """
+        if not metrics.is_scrape_allowed(request):
+            raise HTTPException(status_code=404, detail="Not Found")
+        return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
     @app.get("/api/openapi.json", include_in_schema=False)
     async def openapi_json():
@@ -113,17 +185,34 @@ if __name__ != "__main__":
             swagger_css_url="https://cdn.jsdelivr.net/npm/swagger-ui-dist@5/swagger-ui.css",
         )
 
-    routers = get_app_routers()
-    for router in routers:
-        app.include_router(router)
+    booted = time.perf_counter()
+    for bundle_id, router, dependencies in get_app_routers():
+        began = time.perf_counter()
+        app.include_router(router, dependencies=dependencies)
+        startup.record(bundle_id, startup.ROUTER, time.perf_counter() - began)
+    startup.log_boot_report(time.perf_counter() - booted)
 
     # UI test support: reset and snapshot each app's own database, which the
     # Swift `/debug/uitests` endpoints do not reach. Mounted only in
     # development, because these destroy data by design. See `debug.py`.
     import debug
     if debug.is_enabled():
-        logging.info("Mounting UI test endpoints (/api/debug/uitests)")
-        app.include_router(debug.router)
+        # Restoring a snapshot closes this worker's pooled connections, not
+        # those of the others, which would keep reading the replaced file.
+        if is_multi_worker():
+            logging.warning("Not mounting UI test endpoints (/api/debug/uitests) with more than one worker")
+        else:
+            logging.info("Mounting UI test endpoints (/api/debug/uitests)")
+            app.include_router(debug.router)
 
 if __name__ == "__main__":
-    uvicorn.run("api:app", host="0.0.0.0", port=8082, log_config=None, use_colors=False, ws=None)
+    # Each worker is a process, with its own caches and pools. State that must
+    # be seen by all of them is kept with `lib.state`. Metrics and admission
+    # limits are per worker (see `lib/metrics.py` and `lib/admission.py`), and
+    # each worker writes its own log, e.g. `boss-0`.
+    workers = int(get_option("api_workers", 1))
+    if workers > 1:
+        os.environ[WORKERS_ENV] = str(workers)
+        os.environ[BOOT_ID_ENV] = uuid.uuid4().hex
+        logging.info(f"Starting ({workers}) workers")
+    uvicorn.run("api:app", host="0.0.0.0", port=8082, log_config=None, use_colors=False, ws=None, workers=workers)
@@ -5,23 +5,39 @@
 #
 
 import asyncio
-import aiodbm
 import httpx
 import logging
 import json
 
-from lib import get_config
+from lib import get_config, get_option, metrics
+from lib.cache import MISSING, Cache, CacheStats, SingleFlight, SingleFlightStats
 from lib.model import User
 # TODO: Decorate
-from lib.server import get_dbm_path, require_user
+from lib.server import backend_request, get_dbm_path, require_user
 from fastapi import APIRouter, HTTPException, Request
 from pydantic import BaseModel
 from starlette.responses import Response
 from starlette.status import HTTP_403_FORBIDDEN
-from typing import Any, List, Optional
+from typing import Any, Dict, List, Optional
+
+from . import workspace
+from .defaults import close_store, get_defaults_stats, get_store, make_key
+from .workspace import AppLink, Workspace
 
 HEARTBEAT_ENDPOINT = "http://127.0.0.1:8081/heartbeat"
 
+# Every open desktop polls the heartbeat. What the backend says is cached for
+# `heartbeat_ttl` seconds (5 by default), and probes for the same session made
+# at the same time share one backend call. That the backend is up, and whether
+# security is enabled, is the same for everyone, so it is cached once, under
+# `SERVER_STATE`. Only whether a session is signed in is cached per cookie.
+# Polls without a session share one entry.
+HEARTBEATS: Optional[Cache] = None
+PROBES = SingleFlight()
+SERVER_STATE = ("server",)
+# Parts of `ServerInfo` that are the same for everyone, read once
+SERVER: Optional[dict] = None
+
 # MARK: Data Models
 
 class Default(BaseModel):
@@ -30,18 +46,20 @@ class Default(BaseModel):
     key: str
     value: Optional[Any]
 
-class AppLink(BaseModel):
+class DefaultKey(BaseModel):
     bundleId: str
-    name: str
-    icon: str
-    # TODO: If specific information about opening a file is required
-    # there could be a `data` attribute here OR a path to a file to
-    # DL, etc. It's not clear how files and folders will work at this
-    # time.
+    key: str
+
+class DefaultsQuery(BaseModel):
+    userId: int
+    # Every default the user set in these bundles
+    bundleIds: List[str] = []
+    # And these defaults
+    keys: List[DefaultKey] = []
 
-class Workspace(BaseModel):
-    desktop: List[AppLink]
-    dock: List[AppLink]
+class HeartbeatStats(BaseModel):
+    sessions: CacheStats
+    probes: SingleFlightStats
 
 class ServerInfo(BaseModel):
     # Valuse: dev | prod
@@ -51,8 +69,80 @@ class ServerInfo(BaseModel):
     isSignedIn: bool
     isSecurityEnabled: bool
 
+# MARK: System
+
+async def shutdown():
+    await close_store()
+    workspace.clear_workspaces()
+
+def get_heartbeat_stats() -> HeartbeatStats:
+    return HeartbeatStats(sessions=heartbeats().stats(), probes=PROBES.stats())
+
+metrics.add_collector("defaults", get_defaults_stats)
+metrics.add_collector("heartbeat", get_heartbeat_stats)
+
 # MARK: Package
 
+def store():
+    return get_store(get_dbm_path())
+
+def encode_value(value: Any) -> Optional[str]:
+    """ Values are stored as text. Anything else is stored as its JSON. """
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
+    return json.dumps(value)
+
+def heartbeats() -> Cache:
+    global HEARTBEATS
+    if HEARTBEATS is None:
+        HEARTBEATS = Cache(
+            maxsize=int(get_option("heartbeat_cache_size", 4096)),
+            ttl=float(get_option("heartbeat_ttl", 5))
+        )
+    return HEARTBEATS
+
+def server_info() -> dict:
+    global SERVER
+    if SERVER is None:
+        cfg = get_config()
+        SERVER = {
+            "env": cfg.env,
+            "host": cfg.host.replace("https://", "").replace("http://", ""),
+            "url": cfg.host
+        }
+    return SERVER
+
+async def probe_heartbeat(cookie: Optional[str]) -> dict:
+    """ Ask the backend whether it is up, and whether `cookie` is signed in.
+
+    Returns the backend's answer. Cached; see `HEARTBEATS`. A session is
+    answered from the cache only while the backend is known to be up.
+    """
+    key = cookie or ""
+    signed_in = heartbeats().lookup(key)
+    server = heartbeats().get(SERVER_STATE, MISSING)
+    if signed_in is not MISSING and server is not MISSING:
+        return {"isSignedIn": signed_in, **server}
+    if signed_in is not MISSING and cookie:
+        # Only the backend's state is stale. Every session refreshes it with
+        # the same probe, made without a session.
+        data = await probe_heartbeat(None)
+        return {"isSignedIn": signed_in, "isSecurityEnabled": data["isSecurityEnabled"]}
+
+    async def probe() -> dict:
+        headers = {"Cookie": f"accessToken={cookie}"} if cookie else {}
+        response = await backend_request("GET", HEARTBEAT_ENDPOINT, headers=headers)
+        response.raise_for_status()
+        data = response.json()
+        server = {"isSecurityEnabled": data["isSecurityEnabled"]}
+        heartbeats()[SERVER_STATE] = server
+        heartbeats()[key] = data["isSignedIn"]
+        return {"isSignedIn": data["isSignedIn"], **server}
+
+    return await PROBES.do(("heartbeat", key), probe)
+
 def check_user(user_id, user):
     # UserID 1 is the super admin. This occurs when `login_enabled` is `False`.
     if user_id != user.id:
@@ -68,125 +158,111 @@ router = APIRouter(prefix="/api/io.bithead.boss")
 @router.get("/heartbeat", response_model=ServerInfo)
 async def get_heartbeat(request: Request):
     """ Used to determine if service is online. """
-    async with httpx.AsyncClient() as client:
-        try:
-            cookie = request.cookies.get("accessToken")
-            headers = {"Cookie": f"accessToken={cookie}"} if cookie else {}
-
-            response = await client.get(HEARTBEAT_ENDPOINT, headers=headers)
-            response.raise_for_status()
-            data = response.json()
-        except httpx.HTTPStatusError as e:
-            raise HTTPException(status_code=e.response.status_code, detail=e.response.text)
-        except httpx.RequestError as e:
-            raise HTTPException(status_code=500, detail=str(e))
-    cfg = get_config()
-    return ServerInfo(
-        env=cfg.env,
-        host=cfg.host.replace("https://", "").replace("http://", ""),
-        url=cfg.host,
-        isSignedIn=data["isSignedIn"],
-        isSecurityEnabled=data["isSecurityEnabled"]
-    )
+    try:
+        data = await probe_heartbeat(request.cookies.get("accessToken"))
+    except httpx.HTTPStatusError as e:
+        raise HTTPException(status_code=e.response.status_code, detail=e.response.text)
+    except httpx.RequestError as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return ServerInfo(**server_info(), **data)
 
 @router.get("/defaults/{bundle_id}/{user_id}/{key}", response_model=Default)
 @require_user()
 async def get_default(bundle_id: str, user_id: int, key: str, boss_user: User, request: Request):
     """ Get user default value for key. """
     check_user(user_id, boss_user)
-    db_key = f"{bundle_id}/{user_id}/{key}"
-    async with aiodbm.open(get_dbm_path(), "c") as db:
-        value = await db.get(db_key)
+    value = await store().get(make_key(bundle_id, user_id, key))
     return Default(bundleId=bundle_id, userId=user_id, key=key, value=value)
 
+@router.get("/defaults/{bundle_id}/{user_id}", response_model=List[Default])
+@require_user()
+async def get_bundle_defaults(bundle_id: str, user_id: int, boss_user: User, request: Request):
+    """ Returns every default a user has set in a bundle. """
+    check_user(user_id, boss_user)
+    keys = await store().keys(bundle_id, user_id)
+    values = await store().get_many([make_key(bundle_id, user_id, key) for key in keys])
+    return [
+        Default(bundleId=bundle_id, userId=user_id, key=key, value=values[make_key(bundle_id, user_id, key)])
+        for key in keys
+    ]
+
+@router.post("/defaults/query", response_model=List[Default])
+@require_user()
+async def query_defaults(query: DefaultsQuery, boss_user: User, request: Request):
+    """ Returns many defaults at once: every default of `bundleIds`, then each
+    of `keys`. A key that is not set is returned with no value. """
+    check_user(query.userId, boss_user)
+    keys: List[DefaultKey] = []
+    for bundle_id in query.bundleIds:
+        keys += [DefaultKey(bundleId=bundle_id, key=key) for key in await store().keys(bundle_id, query.userId)]
+    keys += query.keys
+    values = await store().get_many([make_key(k.bundleId, query.userId, k.key) for k in keys])
+    return [
+        Default(bundleId=k.bundleId, userId=query.userId, key=k.key, value=values[make_key(k.bundleId, query.userId, k.key)])
+        for k in keys
+    ]
+
 @router.delete("/defaults/{bundle_id}/{user_id}/{key}")
 @require_user()
 async def delete_default(bundle_id: str, user_id: int, key: str, boss_user: User, request: Request):
     """ Delete user default key. """
     check_user(user_id, boss_user)
-    db_key = f"{bundle_id}/{user_id}/{key}"
-    async with aiodbm.open(get_dbm_path(), "c") as db:
-        try:
-            await db.delete(db_key)
-        except KeyError:
-            pass
+    await store().delete(make_key(bundle_id, user_id, key))
 
 @router.post("/defaults")
 @require_user()
 async def set_default(default: Default, boss_user: User, request: Request):
     """ Set value for user default key. """
     check_user(default.userId, boss_user)
-    db_key = f"{default.bundleId}/{default.userId}/{default.key}"
-    async with aiodbm.open(get_dbm_path(), "c") as db:
-        await db.set(db_key, default.value)
+    await store().set(make_key(default.bundleId, default.userId, default.key), encode_value(default.value))
+
+@router.post("/defaults/batch")
+@require_user()
+async def set_defaults(defaults: List[Default], boss_user: User, request: Request):
+    """ Set many user defaults at once. A default with no value is deleted. """
+    values: Dict[str, Optional[str]] = {}
+    for default in defaults:
+        check_user(default.userId, boss_user)
+        values[make_key(default.bundleId, default.userId, default.key)] = encode_value(default.value)
+    await store().set_many(values)
 
 @router.get("/workspace/guest", response_model=Workspace)
-async def get_default(request: Request):
+async def get_guest_workspace(request: Request):
     """ Returns the default, guest, workspace. """
-    value = {
-        "desktop": [
-            AppLink(bundleId="io.bithead.json-formatter", name="JSON Formatter", icon="icon.svg"),
-            AppLink(bundleId="io.bithead.tutorial", name="Tutorial", icon="icon.svg"),
-            AppLink(bundleId="io.bithead.scheduler", name="Scheduler", icon="icon.svg"),
-            AppLink(bundleId="io.bithead.wordy", name="Wordy", icon="icon.svg")
-        ],
-        "dock": [
-            AppLink(bundleId="io.bithead.scheduler", name="Scheduler", icon="icon.svg")
-        ]
-    }
-
-    return Workspace(
-        desktop=value.get("desktop", []),
-        dock=value.get("dock", [])
-    )
+    return workspace.default_workspace()
 
 @router.get("/workspace/{user_id}", response_model=Workspace)
 @require_user()
-async def get_default(user_id: int, boss_user: User, request: Request):
+async def get_workspace(user_id: int, boss_user: User, request: Request):
     """ Returns user's workspace, which contains app links to open installed apps
     for both the dock and desktop (WIP). """
     check_user(user_id, boss_user)
+    return await workspace.get_workspace(store(), user_id)
 
-    # TODO: Read user preferences
-    db_key = f"desktop/{user_id}"
-    async with aiodbm.open(get_dbm_path(), "c") as db:
-        value = await db.get(db_key)
-    if value:
-        value = json.loads(value)
-    else:
-        value = {
-            "desktop": [
-                AppLink(bundleId="io.bithead.json-formatter", name="JSON Formatter", icon="icon.svg"),
-                AppLink(bundleId="io.bithead.tutorial", name="Tutorial", icon="icon.svg"),
-                AppLink(bundleId="io.bithead.scheduler", name="Scheduler", icon="icon.svg"),
-                AppLink(bundleId="io.bithead.wordy", name="Wordy", icon="icon.svg")
-            ],
-            "dock": [
-                AppLink(bundleId="io.bithead.scheduler", name="Scheduler", icon="icon.svg")
-            ]
-        }
-
-    return Workspace(
-        desktop=value.get("desktop", []),
-        dock=value.get("dock", [])
-    )
-
-@router.get("/workspace/desktop/{user_id}/{bundle_id}", response_model=Workspace)
-async def set_desktop_link(user_id: int, bundle_id: str, request: Request):
+@router.post("/workspace/desktop/{user_id}", response_model=Workspace)
+@require_user()
+async def set_desktop_link(user_id: int, link: AppLink, boss_user: User, request: Request):
     """ Add app link to desktop. """
-    pass
+    check_user(user_id, boss_user)
+    return await workspace.add_link(store(), user_id, workspace.DESKTOP, link)
 
-@router.delete("/workspace/dock/{user_id}/{bundle_id}", response_model=Workspace)
-async def delete_desktop_link(user_id: int, bundle_id: str, request: Request):
+@router.delete("/workspace/desktop/{user_id}/{bundle_id}", response_model=Workspace)
+@require_user()
+async def delete_desktop_link(user_id: int, bundle_id: str, boss_user: User, request: Request):
     """ Delete app link from desktop. """
-    pass
+    check_user(user_id, boss_user)
+    return await workspace.remove_link(store(), user_id, workspace.DESKTOP, bundle_id)
 
-@router.get("/workspace/dock/{user_id}/{bundle_id}", response_model=Workspace)
-async def set_dock_link(user_id: int, bundle_id: str, request: Request):
+@router.post("/workspace/dock/{user_id}", response_model=Workspace)
+@require_user()
+async def set_dock_link(user_id: int, link: AppLink, boss_user: User, request: Request):
     """ Add app link to dock. """
-    pass
+    check_user(user_id, boss_user)
+    return await workspace.add_link(store(), user_id, workspace.DOCK, link)
 
 @router.delete("/workspace/dock/{user_id}/{bundle_id}", response_model=Workspace)
-async def delete_dock_link(user_id: int, bundle_id: str, request: Request):
+@require_user()
+async def delete_dock_link(user_id: int, bundle_id: str, boss_user: User, request: Request):
     """ Delete app link from dock. """
-    pass
+    check_user(user_id, boss_user)
+    return await workspace.remove_link(store(), user_id, workspace.DOCK, bundle_id)
@@ -0,0 +1,301 @@
+#
+# User defaults store
+#
+# Defaults are kept in one dbm file, keyed by `<bundle ID>/<user ID>/<key>`.
+# Opening it is not free: `aiodbm` starts a thread for every open, and the
+# file's index is read again each time. Restoring a workspace reads dozens of
+# defaults, one request each.
+#
+# The store opens the file once, on first use, and keeps it open until the
+# server stops. Values read are cached. Writes are applied to the cache at
+# once and written to the file in a batch `defaults_flush_ms` later (200 by
+# default), so a burst of writes costs one flush. Set it to 0 to write every
+# change through before responding. What is waiting is written when the
+# server stops; a crash loses at most one window of writes.
+#
+# The keys of each bundle and user are indexed when the file is opened, so a
+# bundle's defaults can be listed without scanning the file.
+#
+# dbm files may only be held open by one process. With more than one worker
+# (`api_workers`), the store opens the file for every call instead, as BOSS
+# always did, and nothing is cached.
+#
+
+import aiodbm
+import asyncio
+import logging
+import time
+
+from cachetools import LRUCache
+from lib import get_option
+from lib.state import is_multi_worker
+from pydantic import BaseModel
+from typing import Dict, List, Optional, Set, Tuple
+
+# Most values cached at once. Keys are all indexed regardless.
+CACHE_SIZE = 10000
+
+class DefaultsStats(BaseModel):
+    keys: int
+    cached: int
+    # Writes not yet flushed to the file
+    dirty: int
+    hits: int
+    misses: int
+    writes: int
+    flushes: int
+    lastFlushMs: float
+
+def make_key(bundle_id: str, user_id: int, key: str) -> str:
+    return f"{bundle_id}/{user_id}/{key}"
+
+def split_key(db_key: str) -> Optional[Tuple[str, int, str]]:
+    """ Returns (bundle ID, user ID, key) of a default's key, or `None` if it
+    is not one, e.g. a workspace. """
+    parts = db_key.split("/", 2)
+    if len(parts) != 3 or not parts[1].isdigit():
+        return None
+    return parts[0], int(parts[1]), parts[2]
+
+def _decode(value: Optional[bytes]) -> Optional[str]:
+    if value is None:
+        return None
+    return value.decode("utf-8")
+
+class DefaultsStore:
+    """ A dbm file held open, with a read cache and batched writes.
+
+    Must be used from one event loop at a time.
+
+    @param path: Path to the dbm file
+    @param window: Seconds to hold writes before flushing them. 0 writes
+        every change through.
+    @param shared: The file is shared with other processes. Opens it for
+        every call, and caches nothing.
+    """
+
+    def __init__(self, path: str, window: float=0.2, shared: bool=False):
+        self.path = path
+        self.window = window
+        self.shared = shared
+
+        self.db: Optional[aiodbm.Database] = None
+        self.opening: Optional[asyncio.Future] = None
+        # Key -> value, or `None` if it is known not to exist
+        self.cache: LRUCache = LRUCache(maxsize=CACHE_SIZE)
+        # Key -> value to write, or `None` to delete. Never evicted.
+        self.dirty: Dict[str, Optional[str]] = {}
+        # (bundle ID, user ID) -> keys
+        self.index: Dict[Tuple[str, int], Set[str]] = {}
+        self.task: Optional[asyncio.Task] = None
+
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.flushes = 0
+        self.last_flush_ms = 0.0
+
+    async def _open(self) -> aiodbm.Database:
+        if self.db is not None:
+            return self.db
+        # Concurrent first calls share one open
+        if self.opening is None or self.opening.get_loop() is not asyncio.get_running_loop():
+            self.opening = asyncio.ensure_future(self._open_and_index())
+            self.opening.add_done_callback(self._opened)
+        return await asyncio.shield(self.opening)
+
+    def _opened(self, opening: asyncio.Future):
+        # A failed open is forgotten, so that the next call tries again
+        if opening.cancelled() or opening.exception() is not None:
+            if self.opening is opening:
+                self.opening = None
+
+    async def _open_and_index(self) -> aiodbm.Database:
+        db = await aiodbm.open(self.path, "c")
+        try:
+            keys = await db.keys()
+        except Exception:
+            await db.close()
+            raise
+        for db_key in keys:
+            self._index(db_key.decode("utf-8"), True)
+        self.db = db
+        logging.info(f"Opened defaults ({self.path}) with ({len(keys)}) keys")
+        return db
+
+    def _index(self, db_key: str, exists: bool):
+        parts = split_key(db_key)
+        if parts is None:
+            return
+        bundle_id, user_id, key = parts
+        if exists:
+            self.index.setdefault((bundle_id, user_id), set()).add(key)
+        else:
+            keys = self.index.get((bundle_id, user_id))
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.index[(bundle_id, user_id)]
+
+    async def get_many(self, db_keys: List[str]) -> Dict[str, Optional[str]]:
+        """ Returns the value of each key, or `None` if it is not set. """
+        if self.shared:
+            async with aiodbm.open(self.path, "c") as db:
+                return {db_key: _decode(await db.get(db_key)) for db_key in db_keys}
+
+        db = await self._open()
+        values = {}
+        for db_key in db_keys:
+            if db_key in self.dirty:
+                values[db_key] = self.dirty[db_key]
+                self.hits += 1
+            elif db_key in self.cache:
+                values[db_key] = self.cache[db_key]
+                self.hits += 1
+            else:
+                writes = self.writes
+                value = _decode(await db.get(db_key))
+                # A write made during the read is newer than what was read
+                if db_key in self.dirty:
+                    value = self.dirty[db_key]
+                elif db_key in self.cache:
+                    value = self.cache[db_key]
+                elif self.writes == writes:
+                    self.cache[db_key] = value
+                values[db_key] = value
+                self.misses += 1
+        return values
+
+    async def get(self, db_key: str) -> Optional[str]:
+        return (await self.get_many([db_key]))[db_key]
+
+    async def set_many(self, values: Dict[str, Optional[str]]):
+        """ Set many keys at once. A value of `None` deletes its key. """
+        self.writes += len(values)
+        if self.shared:
+            async with aiodbm.open(self.path, "c") as db:
+                await self._write(db, values)
+            return
+
+        db = await self._open()
+        for db_key, value in values.items():
+            self.cache[db_key] = value
+            self._index(db_key, value is not None)
+        if self.window <= 0:
+            await self._write(db, values)
+            return
+        self.dirty.update(values)
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self._flush_later())
+
+    async def set(self, db_key: str, value: str):
+        await self.set_many({db_key: value})
+
+    async def delete(self, db_key: str):
+        await self.set_many({db_key: None})
+
+    async def keys(self, bundle_id: str, user_id: int) -> List[str]:
+        """ Returns the keys set by a user in a bundle. """
+        if self.shared:
+            prefix = make_key(bundle_id, user_id, "")
+            async with aiodbm.open(self.path, "c") as db:
+                keys = [db_key.decode("utf-8") for db_key in await db.keys()]
+            return sorted(db_key[len(prefix):] for db_key in keys if db_key.startswith(prefix))
+
+        await self._open()
+        return sorted(self.index.get((bundle_id, user_id), ()))
+
+    async def _write(self, db: aiodbm.Database, values: Dict[str, Optional[str]]):
+        began = time.perf_counter()
+        for db_key, value in values.items():
+            if value is None:
+                try:
+                    await db.delete(db_key)
+                except KeyError:
+                    pass
+            else:
+                await db.set(db_key, value)
+        try:
+            await db.sync()
+        except AttributeError:
+            # Not every dbm can be synced. `dbm.ndbm` writes through.
+            pass
+        self.flushes += 1
+        self.last_flush_ms = (time.perf_counter() - began) * 1000
+
+    async def _flush_later(self):
+        # Writes made during a flush are flushed one window after it
+        while self.dirty:
+            await asyncio.sleep(self.window)
+            flushes = self.flushes
+            await self.flush()
+            if self.flushes == flushes:
+                # Failed. Retried on the next write.
+                break
+
+    async def flush(self):
+        """ Write every change waiting to the file. """
+        if not self.dirty or self.db is None:
+            return
+        values, self.dirty = self.dirty, {}
+        try:
+            await self._write(self.db, values)
+        except Exception:
+            logging.exception(f"Failed to flush ({len(values)}) defaults. Retrying on the next write.")
+            # Keep what was written since, which is newer
+            for db_key, value in values.items():
+                self.dirty.setdefault(db_key, value)
+
+    async def close(self):
+        """ Flush what is waiting, and close the file. """
+        if self.task is not None and not self.task.done():
+            if self.task.get_loop() is asyncio.get_running_loop():
+                self.task.cancel()
+                try:
+                    await self.task
+                except asyncio.CancelledError:
+                    pass
+            self.task = None
+        await self.flush()
+        if self.db is not None:
+            await self.db.close()
+        self.db = None
+        self.opening = None
+        self.cache.clear()
+        self.index.clear()
+
+    def get_stats(self) -> DefaultsStats:
+        return DefaultsStats(
+            keys=sum(len(keys) for keys in self.index.values()),
+            cached=len(self.cache),
+            dirty=len(self.dirty),
+            hits=self.hits,
+            misses=self.misses,
+            writes=self.writes,
+            flushes=self.flushes,
+            lastFlushMs=self.last_flush_ms
+        )
+
+# Opened on first use
+STORE: Optional[DefaultsStore] = None
+
+def get_store(path: str) -> DefaultsStore:
+    global STORE
+    if STORE is None:
+        STORE = DefaultsStore(
+            path,
+            window=float(get_option("defaults_flush_ms", 200)) / 1000,
+            shared=is_multi_worker()
+        )
+    return STORE
+
+async def close_store():
+    global STORE
+    if STORE is not None:
+        await STORE.close()
+    STORE = None
+
+def get_defaults_stats() -> DefaultsStats:
+    if STORE is None:
+        return DefaultsStats(keys=0, cached=0, dirty=0, hits=0, misses=0, writes=0, flushes=0, lastFlushMs=0)
+    return STORE.get_stats()
@@ -0,0 +1,141 @@
+#
+# User workspaces
+#
+# A workspace is the app links on a user's desktop and dock. It is read on
+# every desktop boot, and changes only when a user adds or removes a link.
+#
+# Each workspace is stored as one compact record in the defaults store, at
+# `desktop/<user ID>`:
+#
+# ```
+# {"desktop": [["io.bithead.wordy", "Wordy", "icon.svg"], ...], "dock": [...]}
+# ```
+#
+# Records written before links were stored this way, as objects, are still
+# read. Workspaces read are kept, parsed, in memory, so a boot is one lookup.
+# Changes to a user's workspace are made one at a time, and each replaces the
+# record whole.
+#
+# With more than one worker, the store is not cached (see `defaults.py`), and
+# neither are workspaces.
+#
+
+import asyncio
+import json
+import weakref
+
+from lib import get_option
+from lib.cache import MISSING, Cache
+from pydantic import BaseModel
+from typing import List, Optional
+
+from .defaults import DefaultsStore
+
+DESKTOP = "desktop"
+DOCK = "dock"
+
+class AppLink(BaseModel):
+    bundleId: str
+    name: str
+    icon: str
+    # TODO: If specific information about opening a file is required
+    # there could be a `data` attribute here OR a path to a file to
+    # DL, etc. It's not clear how files and folders will work at this
+    # time.
+
+class Workspace(BaseModel):
+    desktop: List[AppLink]
+    dock: List[AppLink]
+
+def default_workspace() -> Workspace:
+    return Workspace(
+        desktop=[
+            AppLink(bundleId="io.bithead.json-formatter", name="JSON Formatter", icon="icon.svg"),
+            AppLink(bundleId="io.bithead.tutorial", name="Tutorial", icon="icon.svg"),
+            AppLink(bundleId="io.bithead.scheduler", name="Scheduler", icon="icon.svg"),
+            AppLink(bundleId="io.bithead.wordy", name="Wordy", icon="icon.svg")
+        ],
+        dock=[
+            AppLink(bundleId="io.bithead.scheduler", name="Scheduler", icon="icon.svg")
+        ]
+    )
+
+def workspace_key(user_id: int) -> str:
+    return f"desktop/{user_id}"
+
+def encode_workspace(workspace: Workspace) -> str:
+    record = {
+        place: [[link.bundleId, link.name, link.icon] for link in getattr(workspace, place)]
+        for place in (DESKTOP, DOCK)
+    }
+    return json.dumps(record, separators=(",", ":"))
+
+def decode_workspace(value: str) -> Workspace:
+    record = json.loads(value)
+
+    def links(place: str) -> List[AppLink]:
+        return [
+            AppLink(bundleId=link[0], name=link[1], icon=link[2]) if isinstance(link, list) else AppLink(**link)
+            for link in record.get(place, [])
+        ]
+
+    return Workspace(desktop=links(DESKTOP), dock=links(DOCK))
+
+# User ID -> workspace
+WORKSPACES: Optional[Cache] = None
+# User ID -> lock held while their workspace changes. Kept while in use.
+LOCKS: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+def _workspaces() -> Cache:
+    global WORKSPACES
+    if WORKSPACES is None:
+        WORKSPACES = Cache(
+            maxsize=int(get_option("workspace_cache_size", 4096)),
+            ttl=float(get_option("workspace_cache_ttl", 3600))
+        )
+    return WORKSPACES
+
+def clear_workspaces():
+    _workspaces().clear()
+
+async def get_workspace(store: DefaultsStore, user_id: int) -> Workspace:
+    """ Returns a user's workspace, or the default workspace if they have none.
+
+    The workspace returned is shared. Do not change it.
+    """
+    workspace = MISSING if store.shared else _workspaces().lookup(user_id)
+    if workspace is not MISSING:
+        return workspace
+    value = await store.get(workspace_key(user_id))
+    workspace = decode_workspace(value) if value else default_workspace()
+    if not store.shared:
+        _workspaces()[user_id] = workspace
+    return workspace
+
+async def add_link(store: DefaultsStore, user_id: int, place: str, link: AppLink) -> Workspace:
+    """ Put an app link on the desktop or dock. A link to the same app is
+    replaced where it is. """
+    def add(links: List[AppLink]) -> List[AppLink]:
+        if any(existing.bundleId == link.bundleId for existing in links):
+            return [link if existing.bundleId == link.bundleId else existing for existing in links]
+        return links + [link]
+    return await _update(store, user_id, place, add)
+
+async def remove_link(store: DefaultsStore, user_id: int, place: str, bundle_id: str) -> Workspace:
+    """ Remove an app's link from the desktop or dock. """
+    def remove(links: List[AppLink]) -> List[AppLink]:
+        return [link for link in links if link.bundleId != bundle_id]
+    return await _update(store, user_id, place, remove)
+
+async def _update(store: DefaultsStore, user_id: int, place: str, change) -> Workspace:
+    lock = LOCKS.get(user_id)
+    if lock is None:
+        lock = LOCKS[user_id] = asyncio.Lock()
+    async with lock:
+        workspace = await get_workspace(store, user_id)
+        # A new workspace, so one already handed out is never changed
+        workspace = workspace.model_copy(update={place: change(getattr(workspace, place))})
+        await store.set(workspace_key(user_id), encode_workspace(workspace))
+        if not store.shared:
+            _workspaces()[user_id] = workspace
+    return workspace
@@ -1,24 +1,87 @@
 #
 # JSON Formatter API
 #
+# Text up to `json_formatter_inline_bytes` (64 KiB by default) is formatted on
+# the event loop; it takes less time than handing it off. Larger text, up to
+# `json_formatter_max_bytes` (16 MiB by default), is formatted in a worker
+# process, so a large paste does not hold up every other app. Larger still is
+# refused with a 413.
+#
+# `POST /stream` takes the text as the request body, and streams the
+# formatted text back as is, rather than inside a JSON string.
+#
 
-import json
-
-from fastapi import APIRouter, Request
+from fastapi import APIRouter, HTTPException, Request
+from lib import get_option
+from lib.admission import bulk
+from lib.jsonformat import FormatResult, format_text
+from lib.workers import run_in_process
 from pydantic import BaseModel
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.status import HTTP_413_REQUEST_ENTITY_TOO_LARGE
 from typing import Optional
 
+# Size of each chunk of a streamed response
+CHUNK_SIZE = 64 * 1024
+
 # MARK: Data Models
 
 class Formatted(BaseModel):
     text: str
     decodeError: Optional[str]
+    # 1-based line and column of the decode error
+    decodeLine: Optional[int] = None
+    decodeColumn: Optional[int] = None
 
 class FormattedRequest(BaseModel):
     text: str
+    # Leave out all whitespace, rather than indenting
+    minify: bool = False
+    sortKeys: bool = False
 
 # MARK: Package
 
+def inline_bytes() -> int:
+    return int(get_option("json_formatter_inline_bytes", 64 * 1024))
+
+def max_bytes() -> int:
+    return int(get_option("json_formatter_max_bytes", 16 * 1024 * 1024))
+
+def too_large() -> HTTPException:
+    return HTTPException(
+        status_code=HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        detail=f"JSON may be at most ({max_bytes()}) bytes"
+    )
+
+async def format_any(text: str, minify: bool, sort_keys: bool) -> FormatResult:
+    """ Format `text`, in a worker process if it is large. """
+    # Characters, not bytes, but close enough to choose where to run
+    if len(text) > max_bytes():
+        raise too_large()
+    if len(text) <= inline_bytes():
+        return format_text(text, minify, sort_keys)
+    return await run_in_process(format_text, text, minify, sort_keys)
+
+async def read_body(request: Request) -> str:
+    """ Read the request's body, refusing it as soon as it is too large. """
+    limit = max_bytes()
+    length = request.headers.get("content-length")
+    if length and length.isdigit() and int(length) > limit:
+        raise too_large()
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > limit:
+            raise too_large()
+    try:
+        return body.decode("utf-8")
+    except UnicodeDecodeError as exc:
+        raise HTTPException(status_code=400, detail=f"JSON must be UTF-8: {exc}")
+
+def chunks(text: str):
+    for start in range(0, len(text), CHUNK_SIZE):
+        yield text[start:start + CHUNK_SIZE].encode("utf-8")
+
 # MARK: API
 
 router = APIRouter(prefix="/api/io.bithead.json-formatter")
@@ -26,11 +89,25 @@ router = APIRouter(prefix="/api/io.bithead.json-formatter")
 @router.post("/", response_model=Formatted)
 async def format_json(body: FormattedRequest, request: Request):
     """ Returns formatted JSON string. """
-    text = body.text
-    error = None
-    try:
-        text = json.loads(body.text)
-        text = json.dumps(text, indent=4)
-    except json.decoder.JSONDecodeError as exc:
-        error = str(exc)
-    return Formatted(text=text, decodeError=error)
+    result = await format_any(body.text, body.minify, body.sortKeys)
+    if result.decodeError is not None:
+        return Formatted(
+            text=body.text,
+            decodeError=result.decodeError,
+            decodeLine=result.decodeLine,
+            decodeColumn=result.decodeColumn
+        )
+    return Formatted(text=result.text, decodeError=None)
+
+@router.post("/stream")
+@bulk()
+async def stream_json(request: Request, minify: bool=False, sortKeys: bool=False):
+    """ Formats the JSON text posted as the body, and streams it back.
+
+    Responds with a 422 and where the text is wrong if it is not JSON.
+    """
+    text = await read_body(request)
+    result = await format_any(text, minify, sortKeys)
+    if result.decodeError is not None:
+        return JSONResponse(status_code=422, content={"detail": result.model_dump()})
+    return StreamingResponse(chunks(result.text), media_type="application/json")
@@ -19,7 +19,10 @@ from urllib.request import Request as UrlRequest, urlopen
 
 from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
-from lib import get_config
+from lib import database, get_config, metrics
+from lib.admission import bulk
+from lib.conditional import etag
+from lib.responses import fast_json
 
 
 log = logging.getLogger(__name__)
@@ -37,6 +40,9 @@ COMPLETED_TRANSITION_STATUSES = COMPLETED_STATUSES
 MODEL_ID = "default"
 CURRENT_MODEL_SCHEMA_VERSION = 1
 MODEL_DB_NAME = "lean-visualizer.sqlite3"
+# Statements run on `conn.execute` directly, so the connection times them.
+# Pooled; `close()` returns it. See `lib.database`.
+MODEL_DB_CONNECTION = metrics.instrumented_connection("io.bithead.lean-visualizer", base=database.PooledConnection)
 # Jira's name for the multi-user field that says who did the work. Task metrics
 # are attributed by this field alone, never by assignee.
 DEVELOPERS_FIELD_NAME = "Developers"
@@ -156,6 +162,11 @@ def migrate_to_1_0_0(conn: sqlite3.Connection, version: tuple | None) -> tuple:
 
 
 
+# Migrated on the first request rather than at boot. Lean Visualizer is opened
+# far less often than the other apps, and none of them wait on it.
+LAZY_START = True
+
+
 def start() -> None:
     logging.info("Starting Lean Visualizer...")
     cfg = get_config()
@@ -630,7 +641,7 @@ def upgrade_model_state(schema_version: int, state: Dict[str, Any]) -> Dict[str,
 def get_model_db_connection() -> sqlite3.Connection:
     cfg = get_config()
     path = os.path.join(cfg.db_path, MODEL_DB_NAME)
-    conn = sqlite3.connect(path)
+    conn = database.connect(path, factory=MODEL_DB_CONNECTION)
     conn.row_factory = sqlite3.Row
     return conn
 
@@ -1980,6 +1991,7 @@ def sync_virtual_features(
 
 
 @router.get("/sync-jira", response_model=JiraSyncResponse)
+@bulk()
 def sync_jira() -> JiraSyncResponse:
     started = time.monotonic()
     log.info("jira.sync.start")
@@ -2072,6 +2084,7 @@ def get_metrics(
 
 
 @router.get("/metrics-window", response_model=MetricsWindowResponse)
+@fast_json
 def get_metrics_window(week_start: str | None = None, window_size: int = 5) -> MetricsWindowResponse:
     conn = get_model_db_connection()
     try:
@@ -2131,6 +2144,7 @@ def get_release_options() -> ReleaseOptionsResponse:
 
 
 @router.post("/sync-task-metrics", response_model=MetricsSyncResponse)
+@bulk()
 def sync_task_metrics(
     metric_year: int | None = None,
     metric_week_number: int | None = None,
@@ -2256,7 +2270,25 @@ def get_finished_work(year: int, operator_name: str = "") -> FinishedWorkRespons
     )
 
 
+def model_version() -> tuple:
+    """What `GET /model` depends on: the stored revision, which every save
+    bumps, and the Jira root from config.json.
+    """
+    try:
+        jira_root = jira_root_url(load_config())
+    except HTTPException:
+        jira_root = ""
+    conn = get_model_db_connection()
+    try:
+        row = conn.execute("SELECT revision FROM visualizer_models WHERE id = ?", (MODEL_ID,)).fetchone()
+    finally:
+        conn.close()
+    return (CURRENT_MODEL_SCHEMA_VERSION, int(row["revision"]) if row else 0, jira_root)
+
+
 @router.get("/model", response_model=ModelResponse)
+@etag(model_version)
+@fast_json
 def get_model() -> ModelResponse:
     jira_root = ""
     try:
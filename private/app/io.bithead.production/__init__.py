@@ -9,22 +9,51 @@
 #
 #   - Auth. `@require_admin()` is the BOSS super user; `@require_user()` is any
 #     signed-in operator.
-#   - Notifications. `send_events` needs the request to carry the caller's
+#   - Notifications. `queue_events` needs the request to carry the caller's
 #     credentials, so a route announces what its rule just did.
 #
+# Routes run on the event loop, and every rule blocks on SQLite. A quick rule
+# (an operator's tap) is called directly; one that reads a whole job or copies
+# files is handed to the worker pool with `run_sync`, so it cannot stall the
+# taps. Every rule that writes, a tap included, goes through `_write`, which
+# runs it on the worker pool in one transaction holding SQLite's write lock
+# (`db.unit_of_work`). Writes are then one at a time across every thread and
+# every worker process (`api_workers`), as they were on the loop. A design edit
+# may fork a frozen version, and starting a job freezes one, so two at once
+# could both fork the same version, or edit one that was frozen under it. A
+# rule that fails writes nothing. Reads are not held up.
+#
+# The largest reads (every job, a job's dashboard and work units) are returned
+# with `@fast_json`: their models are built by the rule, so they are serialized
+# once rather than validated again against `response_model`.
+#
+# An export or a CSV import can take a while and many rows. Those routes are
+# `@bulk()`, so only a few run at once and the taps are never queued behind
+# them. See `lib/admission.py`.
+#
+# Screens that poll (a job, a production line, a dashboard) are tagged with the
+# database's revision by `@etag`. A poll made when nothing was written since
+# the last one is answered `304` without running the rule.
+#
 
 import logging
 import re
+import time
 
 from functools import wraps
 from typing import List, Optional
 
 from fastapi import APIRouter, HTTPException, Request, Response, UploadFile, File
 
+from lib.admission import bulk
+from lib.conditional import etag
 from lib.model import User
-from lib.server import get_user_details, require_admin, require_user
+from lib.responses import fast_json
+from lib.server import require_admin, require_user, resolve_names
+from lib.workers import run_sync
 
 from . import csvimport
+from . import db
 from . import events
 from . import export
 from . import lib
@@ -34,6 +63,11 @@ from .model import *
 
 router = APIRouter(prefix="/api/io.bithead.production")
 
+# Throughput is measured over a window trailing the present, so a dashboard
+# changes as time passes even when nothing is written. Its tag changes this
+# often too. Operator names are refreshed as often.
+DASHBOARD_ETAG_SECONDS = 30
+
 
 def start():
     """Called once by `api.py` when the service loads this app."""
@@ -48,9 +82,11 @@ async def _names(request: Request) -> dict:
 
     Asking BOSS who a user is needs the request, so it happens here and the
     mapping is handed down. A rule is given names, never a way to look them up.
+    Names come from the shared user directory, which asks BOSS only when it is
+    stale. Every caller is an admin, who may see everyone's name.
     """
     try:
-        return {user.id: user.fullName for user in await get_user_details(request)}
+        return await resolve_names(request)
     except Exception as error:
         # A dashboard that cannot name its operators is still worth drawing —
         # but it is logged, because silence here reads as "nobody has a name"
@@ -59,6 +95,16 @@ async def _names(request: Request) -> dict:
         return {}
 
 
+def _in_unit(func, *args, **kwargs):
+    with db.unit_of_work():
+        return func(*args, **kwargs)
+
+
+async def _write(func, *args, **kwargs):
+    """Run a rule that writes on the worker pool, one at a time. See the module comment."""
+    return await run_sync(_in_unit, func, *args, **kwargs)
+
+
 def handled(func):
     """Turn a rule's refusal into the status the client expects.
 
@@ -132,21 +178,21 @@ async def get_pool(pool_id: int, request: Request):
 @require_admin()
 @handled
 async def create_pool(body: SavePoolInput, boss_user: User, request: Request):
-    return lib.save_pool(boss_user, None, body.name)
+    return await _write(lib.save_pool, boss_user, None, body.name)
 
 
 @router.put("/pool/{pool_id}", response_model=SavedPool)
 @require_admin()
 @handled
 async def update_pool(pool_id: int, body: SavePoolInput, boss_user: User, request: Request):
-    return lib.save_pool(boss_user, pool_id, body.name)
+    return await _write(lib.save_pool, boss_user, pool_id, body.name)
 
 
 @router.delete("/pool/{pool_id}", response_model=OK)
 @require_admin()
 @handled
 async def delete_pool(pool_id: int, boss_user: User, request: Request):
-    lib.delete_pool(boss_user, pool_id)
+    await _write(lib.delete_pool, boss_user, pool_id)
     return OK()
 
 
@@ -155,7 +201,8 @@ async def delete_pool(pool_id: int, boss_user: User, request: Request):
 @handled
 async def create_resource(pool_id: int, body: SaveResourceInput, boss_user: User,
                           request: Request):
-    return lib.save_resource(boss_user, pool_id, None, body.name, body.value, body.inService)
+    return await _write(lib.save_resource, boss_user, pool_id, None, body.name, body.value,
+                        body.inService)
 
 
 @router.put("/resource/{resource_id}", response_model=SavedResource)
@@ -163,14 +210,15 @@ async def create_resource(pool_id: int, body: SaveResourceInput, boss_user: User
 @handled
 async def update_resource(resource_id: int, body: SaveResourceInput, boss_user: User,
                           request: Request):
-    return lib.save_resource(boss_user, None, resource_id, body.name, body.value, body.inService)
+    return await _write(lib.save_resource, boss_user, None, resource_id, body.name,
+                        body.value, body.inService)
 
 
 @router.delete("/resource/{resource_id}", response_model=OK)
 @require_admin()
 @handled
 async def delete_resource(resource_id: int, boss_user: User, request: Request):
-    lib.delete_resource(boss_user, resource_id)
+    await _write(lib.delete_resource, boss_user, resource_id)
     return OK()
 
 
@@ -179,7 +227,7 @@ async def delete_resource(resource_id: int, boss_user: User, request: Request):
 @handled
 async def return_resource(resource_id: int, boss_user: User, request: Request):
     """Force a held resource back into its pool, leaving the line alone."""
-    returned = lib.return_resource(boss_user, resource_id)
+    returned = await _write(lib.return_resource, boss_user, resource_id)
     if returned.lineId is not None:
         line = lib.get_line_detail(returned.lineId)
         await events.send(request, events.LINE_STATUS, {"lineId": line.lineId,
@@ -202,6 +250,7 @@ async def get_production_lines(request: Request):
 @router.get("/production-line/{line_id}", response_model=ProductionLineDetail)
 @require_admin()
 @handled
+@etag(lambda: db.get_revision())
 async def get_production_line(line_id: int, request: Request):
     return lib.get_production_line_detail(line_id)
 
@@ -211,7 +260,8 @@ async def get_production_line(line_id: int, request: Request):
 @handled
 async def create_production_line(body: SaveProductionLineInput, boss_user: User,
                                  request: Request):
-    return lib.save_production_line(boss_user, None, body.name, body.columns, body.poolIds)
+    return await _write(lib.save_production_line, boss_user, None, body.name, body.columns,
+                        body.poolIds)
 
 
 @router.put("/production-line/{line_id}", response_model=SavedProductionLine)
@@ -220,14 +270,15 @@ async def create_production_line(body: SaveProductionLineInput, boss_user: User,
 async def update_production_line(line_id: int, body: SaveProductionLineInput, boss_user: User,
                                  request: Request):
     """Forks when the current version is frozen; the client reloads on `forked`."""
-    return lib.save_production_line(boss_user, line_id, body.name, body.columns, body.poolIds)
+    return await _write(lib.save_production_line, boss_user, line_id, body.name, body.columns,
+                        body.poolIds)
 
 
 @router.delete("/production-line/{line_id}", response_model=OK)
 @require_admin()
 @handled
 async def delete_production_line(line_id: int, boss_user: User, request: Request):
-    lib.delete_production_line(boss_user, line_id)
+    await _write(lib.delete_production_line, boss_user, line_id)
     return OK()
 
 
@@ -265,7 +316,7 @@ async def get_production_line_version(version_id: int, request: Request):
 @handled
 async def create_operation(line_id: int, body: SaveOperationInput, boss_user: User,
                            request: Request):
-    return lib.add_operation(boss_user, line_id, body.name)
+    return await _write(lib.add_operation, boss_user, line_id, body.name)
 
 
 @router.post("/production-line/{line_id}/operations/order", response_model=SavedProductionLine)
@@ -273,7 +324,7 @@ async def create_operation(line_id: int, body: SaveOperationInput, boss_user: Us
 @handled
 async def reorder_operations(line_id: int, body: ReorderOperationsInput, boss_user: User,
                              request: Request):
-    return lib.reorder_operations(boss_user, line_id, body.operationIds)
+    return await _write(lib.reorder_operations, boss_user, line_id, body.operationIds)
 
 
 # ---------------------------------------------------------------------------
@@ -304,14 +355,14 @@ async def preview_operation(operation_id: int, request: Request):
 @handled
 async def update_operation(operation_id: int, body: SaveOperationInput, boss_user: User,
                            request: Request):
-    return lib.save_operation(boss_user, operation_id, body.name)
+    return await _write(lib.save_operation, boss_user, operation_id, body.name)
 
 
 @router.delete("/operation/{operation_id}", response_model=DeletedFromLine)
 @require_admin()
 @handled
 async def delete_operation(operation_id: int, boss_user: User, request: Request):
-    return lib.delete_operation(boss_user, operation_id)
+    return await _write(lib.delete_operation, boss_user, operation_id)
 
 
 @router.post("/operation/{operation_id}/sections/order", response_model=SavedSection)
@@ -319,7 +370,7 @@ async def delete_operation(operation_id: int, boss_user: User, request: Request)
 @handled
 async def reorder_sections(operation_id: int, body: ReorderSectionsInput, boss_user: User,
                            request: Request):
-    return lib.reorder_sections(boss_user, operation_id, body.sectionIds)
+    return await _write(lib.reorder_sections, boss_user, operation_id, body.sectionIds)
 
 
 @router.post("/operation/{operation_id}/section", response_model=SavedSection)
@@ -327,8 +378,9 @@ async def reorder_sections(operation_id: int, body: ReorderSectionsInput, boss_u
 @handled
 async def create_section(operation_id: int, body: SaveSectionInput, boss_user: User,
                          request: Request):
-    return lib.add_section(boss_user, operation_id, body.type, name=body.name, label=body.label,
-                           required=body.required, body=body.body, options=body.options)
+    return await _write(lib.add_section, boss_user, operation_id, body.type, name=body.name,
+                        label=body.label, required=body.required, body=body.body,
+                        options=body.options)
 
 
 @router.put("/section/{section_id}", response_model=SavedSection)
@@ -336,15 +388,16 @@ async def create_section(operation_id: int, body: SaveSectionInput, boss_user: U
 @handled
 async def update_section(section_id: int, body: SaveSectionInput, boss_user: User,
                          request: Request):
-    return lib.save_section(boss_user, section_id, body.type, name=body.name, label=body.label,
-                            required=body.required, body=body.body, options=body.options)
+    return await _write(lib.save_section, boss_user, section_id, body.type, name=body.name,
+                        label=body.label, required=body.required, body=body.body,
+                        options=body.options)
 
 
 @router.delete("/section/{section_id}", response_model=DeletedFromLine)
 @require_admin()
 @handled
 async def delete_section(section_id: int, boss_user: User, request: Request):
-    return lib.delete_section(boss_user, section_id)
+    return await _write(lib.delete_section, boss_user, section_id)
 
 
 @router.post("/section/{section_id}/image", response_model=SavedSection)
@@ -357,8 +410,9 @@ async def upload_section_image(section_id: int, boss_user: User, request: Reques
     Every version owns its images outright — a fork copies the file — so the
     name is made unique here rather than reused.
     """
-    image_path = lib.store_section_image(section_id, file.filename, await file.read())
-    return lib.set_section_image(boss_user, section_id, image_path)
+    content = await file.read()
+    image_path = await run_sync(lib.store_section_image, section_id, file.filename, content)
+    return await _write(lib.set_section_image, boss_user, section_id, image_path)
 
 
 # ---------------------------------------------------------------------------
@@ -368,6 +422,7 @@ async def upload_section_image(section_id: int, boss_user: User, request: Reques
 @router.get("/jobs", response_model=List[JobDetail])
 @require_admin()
 @handled
+@fast_json
 async def get_jobs(request: Request):
     return lib.list_jobs()
 
@@ -375,6 +430,7 @@ async def get_jobs(request: Request):
 @router.get("/job/{job_id}", response_model=JobDetail)
 @require_admin()
 @handled
+@etag(lambda: db.get_revision())
 async def get_job(job_id: int, request: Request):
     return lib.get_job_detail(job_id)
 
@@ -383,7 +439,7 @@ async def get_job(job_id: int, request: Request):
 @require_admin()
 @handled
 async def create_job(body: SaveJobInput, boss_user: User, request: Request):
-    return lib.save_job(boss_user, None, body.name, body.productionLineId,
+    return await _write(lib.save_job, boss_user, None, body.name, body.productionLineId,
                         body.scheduledStart, body.scheduledCompletion)
 
 
@@ -391,7 +447,7 @@ async def create_job(body: SaveJobInput, boss_user: User, request: Request):
 @require_admin()
 @handled
 async def update_job(job_id: int, body: SaveJobInput, boss_user: User, request: Request):
-    return lib.save_job(boss_user, job_id, body.name, body.productionLineId,
+    return await _write(lib.save_job, boss_user, job_id, body.name, body.productionLineId,
                         body.scheduledStart, body.scheduledCompletion)
 
 
@@ -399,7 +455,7 @@ async def update_job(job_id: int, body: SaveJobInput, boss_user: User, request:
 @require_admin()
 @handled
 async def delete_job(job_id: int, boss_user: User, request: Request):
-    lib.delete_job(boss_user, job_id)
+    await _write(lib.delete_job, boss_user, job_id)
     return OK()
 
 
@@ -408,7 +464,7 @@ async def delete_job(job_id: int, boss_user: User, request: Request):
 @handled
 async def start_job(job_id: int, boss_user: User, request: Request):
     """Pin and freeze the version, and put every paused operator back to work."""
-    started = lib.start_job(boss_user, job_id)
+    started = await _write(lib.start_job, boss_user, job_id)
     await events.send(request, events.JOB_STATUS, {"jobId": job_id, "active": True},
                       events.everyone(job_id))
     return started
@@ -421,46 +477,51 @@ async def stop_job(job_id: int, boss_user: User, request: Request):
     # Recipients are read before the rule runs: stopping pauses the lines, and
     # the operators on them are exactly who needs to hear about it.
     recipients = events.everyone(job_id)
-    stopped = lib.stop_job(boss_user, job_id)
+    stopped = await _write(lib.stop_job, boss_user, job_id)
     await events.send(request, events.JOB_STATUS, {"jobId": job_id, "active": False}, recipients)
     return stopped
 
 
 @router.post("/job/{job_id}/work-units/preview", response_model=CsvPreview)
+@bulk()
 @require_admin()
 @handled
 async def preview_work_units(job_id: int, request: Request, file: UploadFile = File(...)):
     """Parse and report, writing nothing until the admin confirms."""
     columns = lib.get_job_detail(job_id).contract.columns
-    return csvimport.preview(job_id, await file.read(), columns)
+    return await run_sync(csvimport.preview, job_id, await file.read(), columns)
 
 
 @router.post("/job/{job_id}/work-units/commit", response_model=CommittedUpload)
+@bulk()
 @require_admin()
 @handled
 async def commit_work_units(job_id: int, body: CommitUploadInput, request: Request):
-    return CommittedUpload(workUnitCount=csvimport.commit(job_id, body.uploadId))
+    return CommittedUpload(workUnitCount=await _write(csvimport.commit, job_id, body.uploadId))
 
 
 @router.get("/job/{job_id}/dashboard", response_model=JobDashboard)
 @require_admin()
 @handled
+@etag(lambda: (db.get_revision(), int(time.time() // DASHBOARD_ETAG_SECONDS)))
+@fast_json
 async def get_job_dashboard(job_id: int, request: Request):
-    return lib.get_job_dashboard(job_id, names=await _names(request))
+    return await run_sync(lib.get_job_dashboard, job_id, names=await _names(request))
 
 
 @router.get("/job/{job_id}/work-units", response_model=List[WorkUnitSummary])
 @require_admin()
 @handled
+@fast_json
 async def get_work_units(job_id: int, request: Request, state: Optional[str] = None):
-    return lib.list_work_units(job_id, state, names=await _names(request))
+    return await run_sync(lib.list_work_units, job_id, state, names=await _names(request))
 
 
 @router.get("/work-unit/{work_unit_id}", response_model=WorkUnitDetail)
 @require_admin()
 @handled
 async def get_work_unit(work_unit_id: int, request: Request):
-    return lib.get_work_unit_detail(work_unit_id, names=await _names(request))
+    return await run_sync(lib.get_work_unit_detail, work_unit_id, names=await _names(request))
 
 
 @router.post("/work-unit/{work_unit_id}/requeue", response_model=RequeuedWorkUnit)
@@ -468,7 +529,7 @@ async def get_work_unit(work_unit_id: int, request: Request):
 @handled
 async def requeue_work_unit(work_unit_id: int, boss_user: User, request: Request):
     """Clear a failed unit's progress and put it at the front of the queue."""
-    requeued = lib.requeue_work_unit(boss_user, work_unit_id)
+    requeued = await _write(lib.requeue_work_unit, boss_user, work_unit_id)
     await events.send(request, events.WORK_UNIT,
                       {"jobId": requeued.jobId, "workUnitId": work_unit_id},
                       events.everyone(requeued.jobId))
@@ -476,6 +537,7 @@ async def requeue_work_unit(work_unit_id: int, boss_user: User, request: Request
 
 
 @router.get("/job/{job_id}/export")
+@bulk()
 @require_admin()
 @handled
 async def export_work_units(job_id: int, request: Request):
@@ -483,7 +545,7 @@ async def export_work_units(job_id: int, request: Request):
     job = lib.get_job_detail(job_id)
     slug = re.sub(r"[^a-z0-9]+", "-", job.name.lower()).strip("-") or "job"
     return Response(
-        content=export.work_units_csv(job_id, names=await _names(request)),
+        content=await run_sync(export.work_units_csv, job_id, names=await _names(request)),
         media_type="text/csv",
         headers={"Content-Disposition": f'attachment; filename="{slug}-work-units.csv"'})
 
@@ -506,7 +568,7 @@ async def _announce_line(request: Request, line_id: int):
 @require_user()
 @handled
 async def pause_line(line_id: int, boss_user: User, request: Request):
-    changed = lib.set_line_state(boss_user, line_id, "paused", _origin(boss_user))
+    changed = await _write(lib.set_line_state, boss_user, line_id, "paused", _origin(boss_user))
     await _announce_line(request, line_id)
     return changed
 
@@ -515,7 +577,7 @@ async def pause_line(line_id: int, boss_user: User, request: Request):
 @require_user()
 @handled
 async def resume_line(line_id: int, boss_user: User, request: Request):
-    changed = lib.set_line_state(boss_user, line_id, "working", _origin(boss_user))
+    changed = await _write(lib.set_line_state, boss_user, line_id, "working", _origin(boss_user))
     await _announce_line(request, line_id)
     return changed
 
@@ -525,7 +587,8 @@ async def resume_line(line_id: int, boss_user: User, request: Request):
 @handled
 async def stop_line(line_id: int, body: StopLineInput, boss_user: User, request: Request):
     """Raise the andon. The line stops until the origin that raised it clears it."""
-    changed = lib.set_line_state(boss_user, line_id, "stopped", _origin(boss_user), body.reason)
+    changed = await _write(lib.set_line_state, boss_user, line_id, "stopped", _origin(boss_user),
+                           body.reason)
     await _announce_line(request, line_id)
     return changed
 
@@ -534,7 +597,7 @@ async def stop_line(line_id: int, body: StopLineInput, boss_user: User, request:
 @require_user()
 @handled
 async def clear_andon(line_id: int, boss_user: User, request: Request):
-    changed = lib.set_line_state(boss_user, line_id, "working", _origin(boss_user))
+    changed = await _write(lib.set_line_state, boss_user, line_id, "working", _origin(boss_user))
     await _announce_line(request, line_id)
     return changed
 
@@ -544,7 +607,7 @@ async def clear_andon(line_id: int, boss_user: User, request: Request):
 @handled
 async def leave_line(line_id: int, boss_user: User, request: Request):
     """Release the work unit, return the resources, end the line."""
-    left = lib.leave_line(boss_user, line_id)
+    left = await _write(lib.leave_line, boss_user, line_id)
     # The operator is named explicitly. `everyone` is whoever holds a live line
     # on the job, and this line stopped being live a moment ago — so the one
     # person who most needs to hear this is the one it would leave out.
@@ -577,8 +640,8 @@ async def get_join_info(job_id: int, boss_user: User, request: Request):
 @require_user()
 @handled
 async def join_line(job_id: int, body: JoinLineInput, boss_user: User, request: Request):
-    joined = lib.join_line(boss_user, job_id,
-                           [entry.model_dump() for entry in body.resources])
+    joined = await _write(lib.join_line, boss_user, job_id,
+                          [entry.model_dump() for entry in body.resources])
     await _announce_line(request, joined.lineId)
     return joined
 
@@ -595,7 +658,7 @@ async def get_line_state(line_id: int, request: Request):
 @require_user()
 @handled
 async def pull_work(line_id: int, boss_user: User, request: Request):
-    pulled = lib.pull_work(boss_user, line_id)
+    pulled = await _write(lib.pull_work, boss_user, line_id)
     if not pulled.empty:
         line = lib.get_line_detail(line_id)
         await events.send(request, events.WORK_UNIT,
@@ -610,7 +673,8 @@ async def pull_work(line_id: int, boss_user: User, request: Request):
 @handled
 async def complete_operation(work_unit_id: int, step: int, body: OperationValuesInput,
                              boss_user: User, request: Request):
-    completed = lib.complete_operation(boss_user, work_unit_id, step, body.values, body.notes)
+    completed = await _write(lib.complete_operation, boss_user, work_unit_id, step, body.values,
+                             body.notes)
     await events.send(request, events.OPERATION,
                       {"jobId": completed.jobId, "workUnitId": work_unit_id, "step": step,
                        "unitComplete": completed.unitComplete},
@@ -624,7 +688,8 @@ async def complete_operation(work_unit_id: int, step: int, body: OperationValues
 async def fail_operation(work_unit_id: int, step: int, body: OperationValuesInput,
                          boss_user: User, request: Request):
     """Notes are required — they are the only record of what went wrong."""
-    failed = lib.fail_operation(boss_user, work_unit_id, step, body.values, body.notes)
+    failed = await _write(lib.fail_operation, boss_user, work_unit_id, step, body.values,
+                          body.notes)
     await events.send(request, events.WORK_UNIT,
                       {"jobId": failed.jobId, "workUnitId": work_unit_id, "state": "failed"},
                       events.everyone(failed.jobId))
@@ -637,7 +702,8 @@ async def fail_operation(work_unit_id: int, step: int, body: OperationValuesInpu
 async def edit_operation(work_unit_id: int, step: int, body: OperationValuesInput,
                          boss_user: User, request: Request):
     """Correct a completed step. Every later step is reset and walked again."""
-    edited = lib.edit_operation(boss_user, work_unit_id, step, body.values, body.notes)
+    edited = await _write(lib.edit_operation, boss_user, work_unit_id, step, body.values,
+                          body.notes)
     await events.send(request, events.OPERATION,
                       {"jobId": edited.jobId, "workUnitId": work_unit_id, "step": step,
                        "stepsReset": edited.stepsReset},
@@ -11,6 +11,7 @@ import io
 import json
 import uuid
 
+from lib.state import shared_state
 from typing import Any, Dict, List
 
 from . import db
@@ -18,11 +19,14 @@ from . import lib
 from .lib import *
 from .model import *
 
-# Previews awaiting confirmation, keyed by upload id. Held in memory rather
-# than in a table: an unconfirmed upload means nothing across a restart, and
-# the admin is looking at the preview when they confirm it. A restart between
-# the two simply asks them to choose the file again.
-_PENDING: Dict[str, Dict[str, Any]] = {}
+# Previews awaiting confirmation, keyed by upload id. Held as shared state
+# rather than in a table: an unconfirmed upload means nothing across a restart,
+# and the admin is looking at the preview when they confirm it. A restart
+# between the two, or a preview left for longer than `PENDING_TTL`, simply asks
+# them to choose the file again. Shared, because the confirm may be served by
+# another worker than the preview was.
+PENDING_TTL = 60 * 60 # 1 hour
+_PENDING = shared_state("io.bithead.production.csv-previews", ttl=PENDING_TTL)
 
 
 def preview(job_id: int, file_bytes: bytes, columns: List[str]) -> CsvPreview:
@@ -133,5 +137,5 @@ def commit(job_id: int, upload_id: str) -> int:
     for row_order, row in enumerate(pending["rows"], start=1):
         db.insert_work_unit(job_id, row_order, json.dumps(row))
 
-    del _PENDING[upload_id]
+    _PENDING.pop(upload_id)
     return len(pending["rows"])
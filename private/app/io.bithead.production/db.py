@@ -18,17 +18,22 @@
 import logging
 import os
 import sqlite3
+import threading
 
+from contextlib import contextmanager
 from pydantic import BaseModel
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
-from lib import get_config
+from lib import database, get_config, metrics
 
 DB_NAME = "production.sqlite3"
 
+# Labels this app's statements in metrics
+BUNDLE_ID = "io.bithead.production"
+
 # Bump when a `create_version_*` function is added, and add it to the chain in
 # `start_database`.
-CURRENT_VERSION = "1.0.0"
+CURRENT_VERSION = "1.0.1"
 
 
 def set_database_name(name: str):
@@ -47,47 +52,97 @@ def get_db_path() -> str:
 
 def delete_database():
     """Remove the database file. Used by tests between cases."""
-    path = get_db_path()
-    if os.path.isfile(path):
-        os.unlink(path)
+    database.remove(get_db_path())
 
 
 def get_conn():
-    """Connection to the Production database.
+    """Connection to the Production database, from the shared pool.
 
     Foreign keys are enforced per connection in SQLite and default to off. The
     schema leans on `ON DELETE CASCADE` — deleting a job must take its work
-    units, lines, and logs with it — so every connection turns them on.
+    units, lines, and logs with it — so every connection turns them on. Pooled
+    connections are configured once, when opened. See `lib.database`.
     """
-    conn = sqlite3.connect(get_db_path())
-    conn.execute("PRAGMA foreign_keys = ON")
-    return conn
+    return database.connect(get_db_path(), foreign_keys=True)
 
 
 # Every statement closes its connection in a `finally`, and must keep doing so.
+# `connection()` and `unit_of_work()` do it for them.
 #
 # A statement that fails — a NOT NULL violation, a bad column name — leaves its
 # connection with `in_transaction` true, holding SQLite's write lock. If that
 # connection is never closed, every later write in the process fails with
 # "database is locked": one rejected request bricks the app until it restarts.
 #
+# Connections are pooled, so `close()` returns one to the pool rather than
+# closing it, and the pool rolls it back first. That is what releases the lock
+# now — which makes the `finally` more load-bearing, not less: a connection
+# that is never returned is never rolled back, and nothing else will reclaim
+# it while the server holds its traceback.
+#
 # This does not reproduce in a test. CPython drops the frame as the exception
 # propagates, the connection is refcounted to zero and closed, and the lock
 # goes with it. A web server is different — it retains the traceback to render
 # its 500, the traceback holds the frame, and the frame holds the connection.
 # So the `finally` is load-bearing in production and invisible in the suite.
 
-def select(query: str, params: Optional[tuple] = None) -> List[Any]:
+class UnitOfWork(threading.local):
+    conn: Optional[sqlite3.Connection] = None
+
+
+UNIT = UnitOfWork()
+
+
+@contextmanager
+def unit_of_work() -> Iterator[sqlite3.Connection]:
+    """Run every statement in the block, on this thread, on one connection and
+    in one transaction.
+
+    The transaction begins with SQLite's write lock (`BEGIN IMMEDIATE`), so
+    units run one at a time across every thread and every worker process: a
+    rule that reads and then writes cannot lose an update to another. It is
+    committed when the block ends and rolled back if the block raises. A unit
+    inside another is part of it.
+    """
+    if UNIT.conn is not None:
+        yield UNIT.conn
+        return
     conn = get_conn()
     try:
+        conn.execute("BEGIN IMMEDIATE")
+        UNIT.conn = conn
+        yield conn
+        with metrics.statement(BUNDLE_ID, "COMMIT"):
+            conn.commit()
+    finally:
+        UNIT.conn = None
+        conn.close()
+
+
+@contextmanager
+def connection() -> Iterator[Tuple[sqlite3.Connection, bool]]:
+    """The connection of the unit of work, or one for a single statement, and
+    whether the statement must commit itself."""
+    if UNIT.conn is not None:
+        yield UNIT.conn, False
+        return
+    conn = get_conn()
+    try:
+        yield conn, True
+    finally:
+        conn.close()
+
+
+def select(query: str, params: Optional[tuple] = None) -> List[Any]:
+    with connection() as (conn, _):
         conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
-        cursor.execute(query, params or ())
-        records = cursor.fetchall()
+        with metrics.statement(BUNDLE_ID, query) as stmt:
+            cursor.execute(query, params or ())
+            records = cursor.fetchall()
+            stmt.rows = len(records)
         cursor.close()
         return records
-    finally:
-        conn.close()
 
 
 def update(query: str, params: tuple) -> int:
@@ -97,29 +152,49 @@ def update(query: str, params: tuple) -> int:
     update matching nothing — claiming a work unit another operator already
     took, for instance — and that is an outcome, not an error.
     """
-    conn = get_conn()
-    try:
+    with connection() as (conn, single):
         cursor = conn.cursor()
-        cursor.execute(query, params)
-        conn.commit()
-        changed = cursor.rowcount
+        with metrics.statement(BUNDLE_ID, query) as stmt:
+            cursor.execute(query, params)
+            changed = cursor.rowcount
+            if changed > 0:
+                _bump_revision(cursor)
+            if single:
+                conn.commit()
+            stmt.rows = changed
         cursor.close()
         return changed
-    finally:
-        conn.close()
 
 
 def insert(query: str, params: tuple) -> int:
-    conn = get_conn()
-    try:
+    with connection() as (conn, single):
         cursor = conn.cursor()
-        cursor.execute(query, params)
-        rowid = cursor.lastrowid
-        conn.commit()
+        with metrics.statement(BUNDLE_ID, query) as stmt:
+            cursor.execute(query, params)
+            rowid = cursor.lastrowid
+            inserted = cursor.rowcount
+            if inserted > 0:
+                _bump_revision(cursor)
+            if single:
+                conn.commit()
+            stmt.rows = inserted
         cursor.close()
         return rowid
-    finally:
-        conn.close()
+
+
+def _bump_revision(cursor):
+    """Count a change, in the transaction that made it."""
+    cursor.execute("UPDATE revision SET value = value + 1 WHERE id = 1")
+
+
+def get_revision() -> int:
+    """Changes ever made to the database.
+
+    One counter for everything: a route polled for a job or a line compares it
+    to decide whether anything could have changed since the last poll. Cheaper
+    than knowing exactly what did, and a write is rare next to a poll.
+    """
+    return select("SELECT value FROM revision WHERE id = 1")[0]["value"]
 
 
 def get_db_version(conn) -> Optional[tuple]:
@@ -456,6 +531,28 @@ def create_version_1_0_0(conn, version):
     return "1.0.0"
 
 
+def create_version_1_0_1(conn, version):
+    """Count changes, so a poll can tell when nothing changed. See `get_revision`."""
+    if version >= (1, 0, 1):
+        return
+
+    cursor = conn.cursor()
+    cursor.execute("BEGIN TRANSACTION")
+    cursor.execute("""
+        CREATE TABLE revision (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            value INTEGER NOT NULL
+        )
+    """)
+    cursor.execute("INSERT INTO revision (id, value) VALUES (1, 0)")
+    cursor.execute(
+        "INSERT INTO versions (version, create_date) VALUES (?, datetime('now'))",
+        ("1.0.1",)
+    )
+    conn.commit()
+    cursor.close()
+
+
 def start_database():
     """Create or migrate the database. Called once when the service starts."""
     conn = get_conn()
@@ -463,6 +560,7 @@ def start_database():
         version = get_db_version(conn)
         logging.info(f"Production database version ({version})")
         create_version_1_0_0(conn, version)
+        create_version_1_0_1(conn, get_db_version(conn))
     finally:
         conn.close()
 
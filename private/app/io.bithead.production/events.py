@@ -1,23 +1,25 @@
 #
 # Production — notification events
 #
-# Wraps `lib.server.send_events` so a route names an event rather than
+# Wraps `lib.server.queue_events` so a route names an event rather than
 # assembling a payload.
 #
-# Routes emit, not business rules: `send_events` needs the FastAPI request to
+# Routes emit, not business rules: `queue_events` needs the FastAPI request to
 # carry the caller's credentials, and threading a request into `lib.py` would
 # make every rule untestable. A route calls its rule, then announces the result.
 #
-# A failed notification is logged and swallowed. The work has already been
-# committed by the time the event is sent, and an operator's tap must not fail
-# because a dashboard did not hear about it.
+# Events are queued, not sent: the route returns while the outbox delivers
+# them in the background. A failed notification is logged and swallowed. The
+# work has already been committed by the time the event is sent, and an
+# operator's tap must not fail, or wait, because a dashboard did not hear
+# about it.
 #
 
 import logging
 
 from typing import Any, Dict, List
 
-from lib.server import send_events
+from lib.server import queue_events
 
 from . import db
 from .lib import *
@@ -36,7 +38,8 @@ async def send(request, name: str, data: Dict[str, Any], user_ids: List[int]):
     # Every value crosses the wire as a string.
     payload = {key: ("" if value is None else str(value)) for key, value in (data or {}).items()}
     try:
-        await send_events(request, name, payload, recipients)
+        if not queue_events(request, name, payload, recipients):
+            logging.warning(f"Production dropped event ({name}). The outbox is full.")
     except Exception as error:
         logging.warning(f"Production could not send event ({name}): {error}")
 
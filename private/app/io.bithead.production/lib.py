@@ -4,7 +4,7 @@
 # The only module tests import for behaviour. Everything here takes and returns
 # plain values, and every statement it issues is a named function in `db.py`.
 #
-# Notifications are *not* sent from here. `lib.server.send_events` needs the
+# Notifications are *not* sent from here. `lib.server.queue_events` needs the
 # FastAPI request to carry the caller's credentials, and threading a request
 # through a business rule would make it untestable. Routes emit the event named
 # in `events.py` after the rule they call returns.
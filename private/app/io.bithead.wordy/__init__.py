@@ -11,12 +11,14 @@
 
 import asyncio
 import logging
+import threading
 
 from .db import start_database
 from .model import *
 from .lib import *
 from lib.model import User
 from lib.server import get_friends, require_user
+from lib.workers import run_sync
 from fastapi import APIRouter, Depends, HTTPException, Request
 from pydantic import BaseModel
 from typing import Annotated, List, Optional
@@ -30,9 +32,22 @@ class Solver(BaseModel):
     hits: List[Optional[str]]
     found: List[str]
     misses: List[str]
+    # Also rank guesses by how much they narrow down `words`. The board may
+    # then be empty.
+    rank: bool = False
+    # Number of ranked guesses to return
+    top: int = 10
+    # Time to spend ranking. Defaults to, and may be no more than, the
+    # `wordy_rank_budget_ms` option.
+    budgetMs: Optional[float] = None
 
 class PossibleWords(BaseModel):
+    # Empty when ranking an empty board
     words: List[str]
+    # Best guesses first, when ranked
+    ranked: Optional[List[RankedWord]] = None
+    # Number of possible words, when ranked
+    numWords: Optional[int] = None
 
 # MARK: Package
 
@@ -41,6 +56,8 @@ class PossibleWords(BaseModel):
 def start():
     logging.info("Starting Wordy...")
     start_database()
+    # Rank the first guess before anyone asks for it
+    threading.Thread(target=rank_first_guesses, name="wordy-first-guesses", daemon=True).start()
 
 def shutdown():
     pass
@@ -115,7 +132,7 @@ async def _debug_event(boss_user: User, request: Request):
 async def _friends(request: Request):
     """ Return a list of all friends and their puzzle results for a given date. """
     user, friends = await get_friends(request)
-    results = get_friend_results(user.id, friends)
+    results = await run_sync(get_friend_results, user.id, friends)
     return results
 
 @router.get("/statistics", response_model=Statistics)
@@ -127,7 +144,20 @@ async def _statistics(boss_user: User, request: Request):
 @router.post("/solve", response_model=PossibleWords)
 async def _solve(solver: Solver, request: Request):
     """ Solve a puzzle with hints. """
-    return PossibleWords(words=get_possible_words(
+    if solver.rank:
+        words, num_words, ranked = await run_sync(
+            rank_guesses,
+            solver.hits,
+            solver.found,
+            solver.misses,
+            solver.top,
+            solver.budgetMs
+        )
+        return PossibleWords(words=words, ranked=ranked, numWords=num_words)
+    # A broad pattern scans most of the dictionary. Off the event loop, so it
+    # does not hold up everyone else's guesses.
+    return PossibleWords(words=await run_sync(
+        get_possible_words,
         solver.hits,
         solver.found,
         solver.misses
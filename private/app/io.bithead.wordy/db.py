@@ -3,14 +3,19 @@
 #
 
 import csv
+import json
 import logging
 import os
 import random
 import sqlite3
-from typing import List, Any, Optional
+import threading
+from contextlib import contextmanager
+from typing import List, Any, Iterator, Optional
 
-from lib import get_config
+from lib import database, get_config, metrics
 from datetime import datetime, timedelta
+from .index import WordIndex
+from .patterns import PatternTable, open_table, table_path
 from .model import *
 
 
@@ -25,6 +30,9 @@ sqlite3.register_converter("timestamp", convert_datetime)
 
 # Library
 
+# Labels this app's statements in metrics
+BUNDLE_ID = "io.bithead.wordy"
+
 # Randomize words when put in the databse. Default is true. This is set to
 # False in test.
 RANDOMIZE_WORDS = True
@@ -40,6 +48,11 @@ DB_NAME = "wordy.sqlite3"
 WORDS = b''
 # Total number of words in database
 NUM_WORDS = 0
+# Solver index of `WORDS`. Built with it.
+INDEX: Optional[WordIndex] = None
+# Pattern of every word in `WORDS` against every other, if it has been built
+# with `bin/build_patterns.py`. Mapped with `WORDS`.
+TABLE: Optional[PatternTable] = None
 # All words are 5 characters long. This isn't necessary. However, it makes
 # it more readable as it avoids a magic number, that may not be obvious.
 WORD_LEN = 5
@@ -71,49 +84,103 @@ def get_db_path() -> str:
     cfg = get_config()
     return os.path.join(cfg.db_path, DB_NAME)
 
+def get_patterns_path() -> str:
+    return table_path(get_db_path())
+
 def delete_database():
-    path = get_db_path()
-    if os.path.isfile(path):
-        os.unlink(path)
+    database.remove(get_db_path())
 
 def get_conn():
-    """ Get connection to wordy database. """
+    """ Get connection to wordy database, from the shared pool. """
     path = get_db_path()
     logging.debug(f"Wordy database path ({path})")
-    conn = sqlite3.connect(path)
-    return conn
+    return database.connect(path)
 
-def select(query: str, params: Optional[tuple]=None) -> List[Any]:
+# A connection is returned to the pool, and rolled back if a statement failed,
+# in a `finally`. One that is not keeps SQLite's write lock until it is
+# garbage collected. See `lib.database`.
+#
+# Inside `unit_of_work`, statements run on its connection and are committed
+# with it, when the block ends.
+
+class UnitOfWork(threading.local):
+    conn: Optional[sqlite3.Connection] = None
+
+UNIT = UnitOfWork()
+
+@contextmanager
+def unit_of_work() -> Iterator[sqlite3.Connection]:
+    """ Runs every statement in the block, on this thread, on one connection
+    and in one transaction.
+
+    The transaction is committed when the block ends, and rolled back if it
+    raises. It begins with the write lock (`BEGIN IMMEDIATE`), so a block that
+    reads and then writes does not fail when another worker writes between.
+    A unit inside another is part of it.
+    """
+    if UNIT.conn is not None:
+        yield UNIT.conn
+        return
     conn = get_conn()
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute(query, params or ())
-    records = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    return records
+    try:
+        conn.row_factory = sqlite3.Row
+        conn.execute("BEGIN IMMEDIATE")
+        UNIT.conn = conn
+        yield conn
+        with metrics.statement(BUNDLE_ID, "COMMIT"):
+            conn.commit()
+    finally:
+        UNIT.conn = None
+        conn.close()
+
+@contextmanager
+def connection() -> Iterator[tuple[sqlite3.Connection, bool]]:
+    """ Yields the connection of the unit of work, or one for a single
+    statement, and whether the statement must commit itself. """
+    if UNIT.conn is not None:
+        yield UNIT.conn, False
+        return
+    conn = get_conn()
+    try:
+        conn.row_factory = sqlite3.Row
+        yield conn, True
+    finally:
+        conn.close()
+
+def select(query: str, params: Optional[tuple]=None) -> List[Any]:
+    with connection() as (conn, _):
+        cursor = conn.cursor()
+        with metrics.statement(BUNDLE_ID, query) as stmt:
+            cursor.execute(query, params or ())
+            records = cursor.fetchall()
+            stmt.rows = len(records)
+        cursor.close()
+        return records
 
 def update(query: str, params: tuple):
-    conn = get_conn()
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute(query, params)
-    conn.commit()
-    num_rows_affected = cursor.rowcount
-    cursor.close()
-    conn.close()
+    with connection() as (conn, single):
+        cursor = conn.cursor()
+        with metrics.statement(BUNDLE_ID, query) as stmt:
+            cursor.execute(query, params)
+            if single:
+                conn.commit()
+            stmt.rows = cursor.rowcount
+        num_rows_affected = cursor.rowcount
+        cursor.close()
     if num_rows_affected < 0:
         raise Exception(f"No records were updated with query ({query}) params ({params})")
 
 def insert(query: str, params: tuple) -> int:
-    conn = get_conn()
-    cursor = conn.cursor()
-    cursor.execute(query, params)
-    rowid = cursor.lastrowid
-    conn.commit()
-    cursor.close()
-    conn.close()
-    return rowid
+    with connection() as (conn, single):
+        cursor = conn.cursor()
+        with metrics.statement(BUNDLE_ID, query) as stmt:
+            cursor.execute(query, params)
+            rowid = cursor.lastrowid
+            if single:
+                conn.commit()
+            stmt.rows = cursor.rowcount
+        cursor.close()
+        return rowid
 
 def get_db_version(conn) -> tuple[int, int, int]:
     """ Get current database version.
@@ -139,7 +206,7 @@ def get_db_version(conn) -> tuple[int, int, int]:
 
 def create_version_1_0_0(conn, version):
     if version is not None:
-        return
+        return version
 
     dict_path = get_dictionary_path()
     if not os.path.isfile(dict_path):
@@ -260,6 +327,42 @@ def create_version_1_0_0(conn, version):
 
     return (1, 0, 0)
 
+def create_version_1_1_0(conn, version):
+    """ Stores guesses compactly, in `user_words.guesses`, instead of JSON.
+
+    See `model.encode_attempts`. A puzzle's keys are made from its guesses
+    when it is loaded, and the number of guesses has its own column, so a
+    friend's result is read without parsing anything.
+    """
+    if version >= (1, 1, 0):
+        return version
+
+    logging.info("Installing db v1.1.0 - Compact guesses")
+
+    cursor = conn.cursor()
+    cursor.execute("BEGIN TRANSACTION")
+    cursor.execute("ALTER TABLE user_words ADD COLUMN guesses TEXT")
+    cursor.execute("ALTER TABLE user_words ADD COLUMN num_guesses INT NOT NULL DEFAULT 0")
+
+    cursor.execute("SELECT id, attempts FROM user_words WHERE attempts IS NOT NULL")
+    rows = cursor.fetchall()
+    for user_word_id, attempts in rows:
+        attempts = [[TypedLetter(**letter) for letter in attempt] for attempt in json.loads(attempts)]
+        cursor.execute("""
+            UPDATE user_words SET guesses = ?, num_guesses = ? WHERE id = ?
+        """, (encode_attempts(attempts), len(attempts), user_word_id))
+    cursor.execute("UPDATE user_words SET attempts = NULL, keys = NULL")
+
+    cursor.execute("""
+        INSERT INTO versions (version, create_date)
+        VALUES (?, ?)
+    """, ("1.1.0", datetime.now()))
+    conn.commit()
+    cursor.close()
+    logging.info(f"Encoded the guesses of ({len(rows)}) puzzles")
+
+    return (1, 1, 0)
+
 def start_database():
     """ Start the database by creating and updating, as necessary.
 
@@ -270,15 +373,24 @@ def start_database():
     ver = get_db_version(conn)
     logging.info(f"Database version ({ver})")
     ver = create_version_1_0_0(conn, ver)
+    ver = create_version_1_1_0(conn, ver)
     conn.close()
     cache_words()
 
 def cache_words() -> [str]:
-    """ Cache all database words. """
-    global WORDS, NUM_WORDS
+    """ Cache all database words, index them for the solver, and map their
+    pattern table. """
+    global WORDS, NUM_WORDS, INDEX, TABLE
     rows = select("SELECT word FROM words ORDER BY word")
+    words = b''.join(r["word"].encode("ascii") for r in rows)
+    index = WordIndex(words, WORD_LEN)
+    table = open_table(get_patterns_path(), words, WORD_LEN)
+    if table is None:
+        logging.info(f"No pattern table at ({get_patterns_path()}). Patterns will be computed.")
     NUM_WORDS = len(rows)
-    WORDS = b''.join(r["word"].encode("ascii") for r in rows)
+    WORDS = words
+    INDEX = index
+    TABLE = table
 
 def get_word(date: str) -> Word:
     """ Get word for `date`. """
@@ -445,17 +557,17 @@ def insert_user_word(user_id: int, word_id: int) -> int:
         VALUES (?, ?, ?, ?)
     """, (user_id, word_id, datetime.now(), datetime.now()))
 
-def update_user_word(user_word_id: int, guess_number: int, attempts: str, keys: str, solved: Optional[bool]) -> int:
+def update_user_word(user_word_id: int, guess_number: int, guesses: str, num_guesses: int, solved: Optional[bool]) -> int:
     return update("""
         UPDATE user_words SET
             update_date = ?,
             guess_number = ?,
-            attempts = ?,
-            keys = ?,
+            guesses = ?,
+            num_guesses = ?,
             solved = ?
         WHERE
             id = ?
-    """, (datetime.now(), guess_number, attempts, keys, solved, user_word_id))
+    """, (datetime.now(), guess_number, guesses, num_guesses, solved, user_word_id))
 
 def insert_user_state(user_id: int, user_word_id: int, word_id: int, word_date: str) -> int:
     return insert("""
@@ -532,6 +644,14 @@ def get_friend_user_words(word_id: int, friend_user_ids: List[int]) -> List[User
     return [UserWord(**row) for row in rows]
 
 def get_possible_words(hits: List[Optional[str]], found: List[str], misses: List[str]) -> List[str]:
+    """ Returns words, in alphabetical order, with each hit at its position,
+    every found letter anywhere, and no missed letter. """
+    if INDEX is None:
+        return sorted(query_possible_words(hits, found, misses))
+    return INDEX.match(hits, found, misses)
+
+def query_possible_words(hits: List[Optional[str]], found: List[str], misses: List[str]) -> List[str]:
+    """ `get_possible_words`, in SQL. Scans every word. """
     pattern = ''
     params = []
     for h in hits:
@@ -0,0 +1,125 @@
+#
+# Solver index
+#
+# Answers "which words have these letters here, contain these, and not
+# those" from the packed word list in `db.WORDS`, without SQL.
+#
+# Word `i` is bit `i` of a bitset. For every position and letter there is a
+# bitset of the words with that letter there, and for every letter, one of
+# the words containing it. A query is one AND per hit, per found letter and
+# per missed letter (with its complement), over the whole dictionary at once.
+#
+# With NumPy installed, the words are instead kept as a (words, 5) array of
+# letters and compared column by column, which is faster still for large
+# dictionaries.
+#
+
+from typing import Dict, List, Optional
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def _bitset(indices: List[int], num_words: int) -> int:
+    bits = bytearray((num_words + 7) // 8)
+    for i in indices:
+        bits[i >> 3] |= 1 << (i & 7)
+    return int.from_bytes(bits, "little")
+
+class WordIndex:
+    """ Index of a packed, sorted word list.
+
+    @param words: Every word, `word_len` ASCII letters each, concatenated
+    @param use_numpy: Use NumPy if it is installed
+    """
+
+    def __init__(self, words: bytes, word_len: int, use_numpy: bool=True):
+        self.word_len = word_len
+        self.num_words = len(words) // word_len
+        self.words = words[:self.num_words * word_len]
+        self.all = (1 << self.num_words) - 1
+        self.array = None
+        if use_numpy and numpy is not None:
+            self.array = numpy.frombuffer(self.words, dtype=numpy.uint8).reshape(self.num_words, word_len)
+            # letter -> words containing `letter`
+            self.contains_array = {
+                letter: (self.array == letter).any(axis=1)
+                for letter in numpy.unique(self.array).tolist()
+            }
+            return
+
+        # (position, letter) -> words with `letter` at `position`
+        at: Dict[tuple, List[int]] = {}
+        # letter -> words containing `letter`
+        contains: Dict[int, List[int]] = {}
+        for i in range(self.num_words):
+            word = words[i * word_len:(i + 1) * word_len]
+            for position, letter in enumerate(word):
+                at.setdefault((position, letter), []).append(i)
+            for letter in set(word):
+                contains.setdefault(letter, []).append(i)
+        self.at = {key: _bitset(indices, self.num_words) for key, indices in at.items()}
+        self.contains = {letter: _bitset(indices, self.num_words) for letter, indices in contains.items()}
+
+    def word(self, i: int) -> str:
+        return self.words[i * self.word_len:(i + 1) * self.word_len].decode("ascii")
+
+    def find(self, word: str) -> Optional[int]:
+        """ Returns the position of `word` in the packed list, or `None` if it is not in it. """
+        key = word.encode("ascii")
+        lo, hi = 0, self.num_words
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.words[mid * self.word_len:(mid + 1) * self.word_len] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.num_words and self.words[lo * self.word_len:(lo + 1) * self.word_len] == key:
+            return lo
+        return None
+
+    def match(self, hits: List[Optional[str]], found: List[str], misses: List[str]) -> List[str]:
+        """ Returns, in order, the words with each hit at its position, every
+        found letter anywhere, and no missed letter. """
+        return [self.word(i) for i in self.indices(hits, found, misses)]
+
+    def indices(self, hits: List[Optional[str]], found: List[str], misses: List[str]) -> List[int]:
+        """ `match`, as the position of each word in the packed list. """
+        if self.array is not None:
+            return self._match_array(hits, found, misses)
+        mask = self.all
+        for position, letter in enumerate(hits):
+            if letter is not None:
+                mask &= self.at.get((position, ord(letter)), 0)
+        for letter in set(found):
+            mask &= self.contains.get(ord(letter), 0)
+        for letter in set(misses):
+            mask &= ~self.contains.get(ord(letter), 0)
+        return self._indices(mask)
+
+    def _indices(self, mask: int) -> List[int]:
+        indices = []
+        for offset, byte in enumerate(mask.to_bytes((self.num_words + 7) // 8, "little")):
+            while byte:
+                low = byte & -byte
+                indices.append(offset * 8 + low.bit_length() - 1)
+                byte ^= low
+        return indices
+
+    def _match_array(self, hits: List[Optional[str]], found: List[str], misses: List[str]) -> List[int]:
+        array = self.array
+        mask = numpy.ones(self.num_words, dtype=bool)
+        for position, letter in enumerate(hits):
+            if letter is not None:
+                mask &= array[:, position] == ord(letter)
+        for letter in set(found):
+            contains = self.contains_array.get(ord(letter))
+            if contains is None:
+                return []
+            mask &= contains
+        for letter in set(misses):
+            contains = self.contains_array.get(ord(letter))
+            if contains is not None:
+                mask &= ~contains
+        return numpy.flatnonzero(mask).tolist()
@@ -9,10 +9,14 @@ import json
 
 from . import db
 from .model import *
+from .patterns import digits, pattern
+from .solver import Ranker
 from cachetools import TTLCache
 from fastapi import Request
+from lib import get_option
 from lib.model import Friend, User
-from lib.server import send_events
+from lib.server import queue_events
+from lib.state import shared_state
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 
@@ -21,11 +25,20 @@ USER_TTL = 60 * 60 # 1 hour
 
 VALID_CHARS = "abcdefghijklmnopqrstuvwxyz"
 
+# A letter's digit in a pattern. See `patterns.py`.
+MISS = 0
+FOUND = 1
+HIT = 2
+
 # Contains word records alone w/ word analysis (letters that exist in word, etc.)
 TARGET_WORDS = TTLCache(1024, ttl=WORD_TTL)
 
-# Contains map of user's current puzzle state
-PUZZLES = TTLCache(1024, ttl=USER_TTL)
+# Contains map of user's current puzzle state. Shared by every worker, as a
+# guess recorded by one must be seen by the next worker to serve the user.
+PUZZLES = shared_state("io.bithead.wordy.puzzles", ttl=USER_TTL, model=Puzzle)
+
+# Ranks guesses against the words in `db.INDEX`. Made again when it is.
+RANKER: Optional[Ranker] = None
 
 # Should only be used for testing. This allows the current puzzle date to be shifted
 # forwards or backwards in time to test scenarios such as streaks, etc.
@@ -133,15 +146,14 @@ def make_puzzle(user_id: int, user_word: UserWord) -> Puzzle:
     Making a puzzle effectively effectively sets the user's active puzzle. It is
     expected that all subsequent requests will be to guess the puzzle.
     """
-    attempts = user_word.attempts or "[]"
-    keys = user_word.keys or "{}"
+    attempts = decode_attempts(user_word.guesses)
     puzzle = Puzzle(
         id=user_word.id,
         wordId=user_word.word_id,
         date=user_word.date,
         guessNumber=user_word.guess_number,
-        attempts=json.loads(attempts),
-        keys=json.loads(keys),
+        attempts=attempts,
+        keys=make_keys(attempts),
         solved=user_word.solved
     )
     # Set active user puzzle
@@ -202,13 +214,11 @@ def save_statistics(user_id: int, puzzle: Puzzle, s: Statistics):
         )
 
 def save_puzzle(puzzle: Puzzle):
-    d = puzzle.model_dump_json()
-    d = json.loads(d)
     db.update_user_word(
         puzzle.id,
         puzzle.guessNumber,
-        json.dumps(d["attempts"]),
-        json.dumps(d["keys"]),
+        encode_attempts(puzzle.attempts),
+        len(puzzle.attempts),
         puzzle.solved
     )
 
@@ -234,7 +244,24 @@ def get_cached_puzzle(user_id: int) -> Puzzle:
         puzzle = make_puzzle(user_id, user_word)
     return puzzle
 
+def mark_guess(word: str, target: str) -> List[int]:
+    """ Returns the mark of each letter of `word`, `MISS`, `FOUND` or `HIT`,
+    when the answer is `target`.
+
+    This is looked up in the pattern table, if it has been built.
+    """
+    if db.TABLE is not None:
+        guess, answer = db.INDEX.find(word), db.INDEX.find(target)
+        if guess is not None and answer is not None:
+            return digits(db.TABLE.pattern(guess, answer), len(word))
+    return digits(pattern(word.encode("ascii"), target.encode("ascii")), len(word))
+
 def guess_word(user_id: int, word: str) -> Puzzle:
+    """ Attempt to solve the user's active puzzle with `word`.
+
+    Everything the guess reads and writes, including the statistics of a
+    finishing guess, is one transaction. Either all of it is saved, or none.
+    """
     word = word.lower()
     for char in word:
         if char not in VALID_CHARS:
@@ -246,6 +273,17 @@ def guess_word(user_id: int, word: str) -> Puzzle:
     if not db.is_word(word):
         raise WordyError("Word does not exist")
 
+    try:
+        with db.unit_of_work():
+            return record_guess(user_id, word)
+    except WordyError:
+        raise
+    except Exception:
+        # The cached puzzle may have the guess that was rolled back
+        PUZZLES.pop(user_id, None)
+        raise
+
+def record_guess(user_id: int, word: str) -> Puzzle:
     puzzle = get_cached_puzzle(user_id)
 
     if puzzle.solved is not None:
@@ -290,22 +328,18 @@ def guess_word(user_id: int, word: str) -> Puzzle:
 
     keys = puzzle.keys
 
-    chars = list(target.word.word)
+    marks = mark_guess(word, target.word.word)
     for idx, letter in enumerate(word):
-        if letter == target.word.word[idx]:
-            chars[idx] = None
+        if marks[idx] == HIT:
             keys[letter] = TypedLetterState.HIT
             matches[idx] = TypedLetter(
                 letter=letter,
                 state=TypedLetterState.HIT
             )
     for idx, letter in enumerate(word):
-        if letter == target.word.word[idx]:
+        if marks[idx] == HIT:
             continue # Already matched
-        if letter in chars:
-            # Remove first matching letter
-            _idx = chars.index(letter)
-            chars[_idx] = None
+        if marks[idx] == FOUND:
             # Overwrite key if lower state
             key = keys.get(letter, None)
             if key is None or key == TypedLetterState.MISS:
@@ -346,7 +380,7 @@ async def send_puzzle_update_to_friends(request: Request, user: User, puzzle: Pu
         "user": user.model_dump_json(),
         "puzzle": puzzle.model_dump_json()
     }
-    await send_events(request, "io.bithead.wordy.puzzle.update", data=event, user_ids=user_ids)
+    queue_events(request, "io.bithead.wordy.puzzle.update", data=event, user_ids=user_ids)
 
 def get_statistics(user_id: int) -> Statistics:
     try:
@@ -386,15 +420,11 @@ def get_friend_results(user_id: int, friends: List[Friend]) -> FriendResults:
                 solved=None
             ))
         else:
-            num_guesses = 0
-            if uw.attempts is not None:
-                attempts = json.loads(uw.attempts)
-                num_guesses = len(attempts)
             results.append(FriendResult(
                 userId=friend.userId,
                 name=friend.name,
                 avatarUrl=friend.avatarUrl,
-                numGuesses=num_guesses,
+                numGuesses=uw.num_guesses,
                 solved=uw.solved
             ))
     return FriendResults(
@@ -403,21 +433,81 @@ def get_friend_results(user_id: int, friends: List[Friend]) -> FriendResults:
         results=results
     )
 
-def get_possible_words(hits: List[Optional[str]], found: List[str], misses: List[str]) -> List[str]:
-    """ Get list of possible words based on hit|found|missed letters. """
+def _is_letter(char: any) -> bool:
+    """ Returns `True` if `char` is one letter, 'a' through 'z'. """
+    return isinstance(char, str) and len(char) == 1 and char in VALID_CHARS
+
+def check_hints(hits: List[Optional[str]], found: List[str], misses: List[str]):
+    """ Raises `WordyError` if hints are not letters, or are not one hit for every letter. """
     for char in hits:
-        if char is not None and char not in VALID_CHARS:
+        if char is not None and not _is_letter(char):
             raise WordyError("Hit characters must contain characters 'A' through 'Z' only")
     for char in found:
-        if char is not None and char not in VALID_CHARS:
+        if not _is_letter(char):
             raise WordyError("Found characters must contain characters 'A' through 'Z' only")
     for char in misses:
-        if char is not None and char not in VALID_CHARS:
+        if not _is_letter(char):
             raise WordyError("Missed characters must contain characters 'A' through 'Z' only")
 
     if len(hits) != 5:
         raise WordyError("You must provide 5 hit characters")
+
+def get_possible_words(hits: List[Optional[str]], found: List[str], misses: List[str]) -> List[str]:
+    """ Get list of possible words based on hit|found|missed letters. """
+    check_hints(hits, found, misses)
     if hits == [None, None, None, None, None] and not found and not misses:
         raise WordyError("You must provide at least one hit, found, or missed character")
 
     return db.get_possible_words(hits, found, misses)
+
+def get_ranker() -> Ranker:
+    global RANKER
+    if db.INDEX is None:
+        raise WordyError("Words have not been loaded")
+    if RANKER is None or RANKER.index is not db.INDEX:
+        RANKER = Ranker(db.INDEX, db.TABLE)
+    return RANKER
+
+def max_rank_top() -> int:
+    return int(get_option("wordy_rank_max_top", 50))
+
+def rank_budget_ms() -> float:
+    return float(get_option("wordy_rank_budget_ms", 250))
+
+def first_guess_budget_ms() -> float:
+    return float(get_option("wordy_first_guess_budget_ms", 2000))
+
+def rank_first_guesses() -> List[RankedWord]:
+    """ Rank the guesses of an empty board, which every puzzle starts with.
+
+    This is done once for the words in the database. Requests for the empty
+    board are then answered from memory.
+    """
+    ranker = get_ranker()
+    return make_ranked_words(ranker, ranker.rank_first_guesses(max_rank_top(), first_guess_budget_ms() / 1000))
+
+def make_ranked_words(ranker: Ranker, ranked: list) -> List[RankedWord]:
+    return [
+        RankedWord(word=ranker.index.word(r.index), score=round(r.score, 4), isCandidate=r.is_candidate)
+        for r in ranked
+    ]
+
+def rank_guesses(hits: List[Optional[str]], found: List[str], misses: List[str], top: int, budget_ms: Optional[float]=None) -> tuple[List[str], int, List[RankedWord]]:
+    """ Returns the possible words, their number, and the `top` guesses ranked
+    by how much they are expected to narrow them down.
+
+    Unlike `get_possible_words`, the board may be empty. Every word is then
+    possible, so none are returned, only their number.
+
+    @param budget_ms: Time to spend ranking. No more than `wordy_rank_budget_ms`.
+    """
+    check_hints(hits, found, misses)
+    top = max(1, min(top, max_rank_top()))
+    if hits == [None, None, None, None, None] and not found and not misses:
+        return [], get_ranker().index.num_words, rank_first_guesses()[:top]
+
+    ranker = get_ranker()
+    candidates = ranker.index.indices(hits, found, misses)
+    budget = min(budget_ms or rank_budget_ms(), rank_budget_ms()) / 1000
+    ranked = ranker.rank(candidates, top, budget)
+    return [ranker.index.word(i) for i in candidates], len(candidates), make_ranked_words(ranker, ranked)
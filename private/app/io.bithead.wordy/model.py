@@ -22,9 +22,13 @@ class UserWord(BaseModel):
     create_date: datetime
     update_date: datetime
     guess_number: int
+    # Before v1.1.0, JSON of `Puzzle.attempts` and `Puzzle.keys`. Now `NULL`.
     attempts: Optional[str]
     keys: Optional[str]
     solved: Optional[bool]
+    # `encode_attempts` of the guesses made
+    guesses: Optional[str] = None
+    num_guesses: int = 0
 
     word: str
     date: str
@@ -66,6 +70,46 @@ class TypedLetter(BaseModel):
 
     model_config = ConfigDict(use_enum_values=True)
 
+# A letter's mark in an encoded guess. The same digits as a pattern. See `patterns.py`.
+MARKS = {
+    TypedLetterState.MISS: "0",
+    TypedLetterState.FOUND: "1",
+    TypedLetterState.HIT: "2",
+}
+MARKS.update({state.value: mark for state, mark in list(MARKS.items())})
+STATES = {mark: state.value for state, mark in MARKS.items() if isinstance(state, TypedLetterState)}
+
+def encode_attempts(attempts: List[List[TypedLetter]]) -> str:
+    """ Returns guesses as the word then the mark of each of its letters,
+    comma separated. e.g. `hello00001,bigot22222` """
+    return ",".join(
+        "".join(letter.letter for letter in attempt) + "".join(MARKS[letter.state] for letter in attempt)
+        for attempt in attempts
+    )
+
+def decode_attempts(guesses: Optional[str]) -> List[List[TypedLetter]]:
+    """ Returns the attempts of guesses encoded by `encode_attempts`. """
+    if not guesses:
+        return []
+    attempts = []
+    for guess in guesses.split(","):
+        word_len = len(guess) // 2
+        attempts.append([
+            TypedLetter(letter=letter, state=STATES[mark])
+            for letter, mark in zip(guess[:word_len], guess[word_len:])
+        ])
+    return attempts
+
+def make_keys(attempts: List[List[TypedLetter]]) -> Dict[str, TypedLetterState]:
+    """ Returns the best mark each letter typed has had. """
+    keys = {}
+    for attempt in attempts:
+        for letter in attempt:
+            key = keys.get(letter.letter, None)
+            if key is None or MARKS[letter.state] > MARKS[key]:
+                keys[letter.letter] = letter.state
+    return keys
+
 class Puzzle(BaseModel): # A user_words
     # user_words.id
     id: int
@@ -123,3 +167,11 @@ class Statistics(BaseModel):
     # Guess distribution starting with the number of times 1 guess finished the
     # puzzle to 6 guesses to finishe the puzzle.
     distribution: List[int]
+
+class RankedWord(BaseModel):
+    word: str
+    # Bits of information the guess is expected to give. Every bit halves the
+    # words that may be the answer.
+    score: float
+    # The word may be the answer
+    isCandidate: bool
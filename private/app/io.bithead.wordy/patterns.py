@@ -0,0 +1,167 @@
+#
+# Feedback patterns
+#
+# The pattern a guess gives for an answer is one base 3 digit per letter, 0
+# miss, 1 found and 2 hit, the first letter being the lowest digit. A five
+# letter word has 243 of them, so one fits in a byte.
+#
+# `bin/build_patterns.py` computes the pattern of every guess against every
+# answer in the dictionary into a table on disk: a header, then one row of
+# (words) bytes for each guess, in the order of `db.WORDS`. Wordy maps it
+# read only at start. Every worker maps the same file, so they share its
+# pages, and marking a guess or ranking one is a lookup.
+#
+# The header records a digest of the words the table was built for. A table
+# built for another dictionary is not used.
+#
+# This module does not import the rest of Wordy, so that `bin/` may load it.
+#
+
+import hashlib
+import logging
+import mmap
+import os
+import struct
+
+from typing import List, Optional
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MAGIC = b"WORDYPAT"
+VERSION = 1
+# Magic, version, word length, number of words, digest of the words
+HEADER = struct.Struct("<8sHHI16s")
+# Rows of the table computed at once, with NumPy
+BLOCK_SIZE = 64
+
+def pattern(guess: bytes, answer: bytes) -> int:
+    """ Returns the pattern `guess` gives for `answer`.
+
+    A repeated letter is found only as many times as it is in `answer`, and
+    hits are counted first, as `lib.guess_word` marks a guess.
+    """
+    value = 0
+    # Letters of the answer not yet hit or found
+    left = bytearray(answer)
+    unhit = []
+    for i in range(len(guess)):
+        if guess[i] == answer[i]:
+            value += 2 * 3 ** i
+            left[i] = 0
+        else:
+            unhit.append(i)
+    for i in unhit:
+        j = left.find(guess[i])
+        if j >= 0:
+            value += 3 ** i
+            left[j] = 0
+    return value
+
+def digits(value: int, word_len: int) -> List[int]:
+    """ Returns the digit of each letter of a pattern. """
+    return [value // 3 ** i % 3 for i in range(word_len)]
+
+def pattern_matrix(guesses, answers):
+    """ Returns the (guesses, answers) matrix of the pattern each guess gives each answer.
+
+    Requires NumPy.
+
+    @param guesses: (guesses, word length) array of letters
+    @param answers: (answers, word length) array of letters
+    """
+    word_len = guesses.shape[1]
+    # Where each letter of the guess is not hit
+    unhit = [guesses[:, i, None] != answers[None, :, i] for i in range(word_len)]
+    value = numpy.zeros((len(guesses), len(answers)), dtype=numpy.uint8)
+    for i in range(word_len):
+        letter = guesses[:, i, None]
+        # Letters of the answer, not hit, that are this letter
+        left = numpy.zeros_like(value)
+        for k in range(word_len):
+            left += (answers[None, :, k] == letter) & unhit[k]
+        # Less those found by the same letter earlier in the guess
+        for j in range(i):
+            left -= (guesses[:, j, None] == letter) & unhit[j] & (left > 0)
+        found = unhit[i] & (left > 0)
+        value += (~unhit[i]).astype(numpy.uint8) * (2 * 3 ** i) + found.astype(numpy.uint8) * 3 ** i
+    return value
+
+def words_digest(words: bytes) -> bytes:
+    return hashlib.blake2b(words, digest_size=16).digest()
+
+def table_path(db_path: str) -> str:
+    """ Returns the path of the table for the Wordy database at `db_path`. """
+    return os.path.splitext(db_path)[0] + ".patterns"
+
+def build_table(words: bytes, word_len: int, path: str, use_numpy: bool=True):
+    """ Write the pattern table of `words` to `path`.
+
+    The table is written beside `path` and moved over it, so a worker never
+    maps half a table.
+
+    @param words: Every word, `word_len` ASCII letters each, concatenated, in
+        the order of `db.WORDS`
+    """
+    num_words = len(words) // word_len
+    words = words[:num_words * word_len]
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as fh:
+        fh.write(HEADER.pack(MAGIC, VERSION, word_len, num_words, words_digest(words)))
+        if use_numpy and numpy is not None:
+            array = numpy.frombuffer(words, dtype=numpy.uint8).reshape(num_words, word_len)
+            for start in range(0, num_words, BLOCK_SIZE):
+                fh.write(pattern_matrix(array[start:start + BLOCK_SIZE], array).tobytes())
+        else:
+            split = [words[i * word_len:(i + 1) * word_len] for i in range(num_words)]
+            for guess in split:
+                fh.write(bytes(pattern(guess, answer) for answer in split))
+    os.replace(tmp_path, path)
+
+class PatternTable:
+    """ The patterns of every guess against every answer, mapped from a table on disk.
+
+    Open with `open_table`.
+    """
+
+    def __init__(self, path: str, buffer: mmap.mmap, num_words: int):
+        self.path = path
+        self.buffer = buffer
+        self.num_words = num_words
+        self.array = None
+        if numpy is not None:
+            self.array = numpy.frombuffer(buffer, dtype=numpy.uint8, count=num_words * num_words, offset=HEADER.size)
+            self.array = self.array.reshape(num_words, num_words)
+
+    def pattern(self, guess: int, answer: int) -> int:
+        """ Returns the pattern of the guess at index `guess` for the answer at index `answer`. """
+        return self.buffer[HEADER.size + guess * self.num_words + answer]
+
+    def row(self, guess: int) -> memoryview:
+        """ Returns the pattern of the guess at index `guess` for every answer. """
+        start = HEADER.size + guess * self.num_words
+        return memoryview(self.buffer)[start:start + self.num_words]
+
+def open_table(path: str, words: bytes, word_len: int) -> Optional[PatternTable]:
+    """ Maps the pattern table at `path`.
+
+    Returns `None` if there is no table, or it was not built for `words`.
+    """
+    if not os.path.isfile(path):
+        return None
+    num_words = len(words) // word_len
+    with open(path, "rb") as fh:
+        header = fh.read(HEADER.size)
+        size = os.fstat(fh.fileno()).st_size
+        expected = (MAGIC, VERSION, word_len, num_words, words_digest(words[:num_words * word_len]))
+        if len(header) != HEADER.size or HEADER.unpack(header) != expected:
+            logging.warning(f"Pattern table ({path}) was not built for these words. Run `bin/build_patterns.py` again.")
+            return None
+        if size != HEADER.size + num_words * num_words:
+            logging.warning(f"Pattern table ({path}) is ({size}) bytes. Expected ({HEADER.size + num_words * num_words}).")
+            return None
+        # The map outlives the file object
+        buffer = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    return PatternTable(path, buffer, num_words)
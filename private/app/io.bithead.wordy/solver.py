@@ -0,0 +1,167 @@
+#
+# Guess ranking
+#
+# Scores guesses by how much they are expected to tell about the answer.
+#
+# A guess splits the words that could still be the answer (the candidates)
+# by the pattern of hits, found letters and misses each would give it. A
+# pattern is one base 3 digit per letter, 0 miss, 1 found and 2 hit, so a
+# five letter word has 243 of them. The fewer candidates that share a
+# pattern, the more the guess narrows them down. A guess's score is the
+# entropy of its patterns, in bits: the number of halvings of the
+# candidates it is expected to make.
+#
+# Every word in the dictionary may be guessed, not just the candidates. With
+# a pattern table (see `patterns.py`), a guess's patterns are read from its
+# row. Without one, and with NumPy installed, they are computed for a block
+# of guesses against every candidate at once, from the packed `db.WORDS`
+# buffer. Otherwise, one pair at a time.
+#
+# Scoring every guess can take longer than a request should. Guesses are
+# scored in order of how many candidates share their letters, which tends
+# to put the best guesses first, until the time budget runs out.
+#
+
+import math
+import random
+import threading
+import time
+
+from .index import WordIndex
+from .patterns import PatternTable, pattern, pattern_matrix
+from collections import Counter
+from operator import itemgetter
+from typing import List, NamedTuple, Optional
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Candidates a guess is scored against. Beyond this, a fixed sample of them
+# estimates the score, as well as all of them would.
+SAMPLE_SIZE = 512
+# Guesses whose patterns are computed at once. Bounds the memory used to a
+# few arrays of (BLOCK_SIZE * SAMPLE_SIZE) bytes.
+BLOCK_SIZE = 64
+
+def entropy(counts: List[int], total: int) -> float:
+    """ Returns, in bits, the entropy of patterns shared by `counts` candidates each. """
+    return math.log2(total) - sum(c * math.log2(c) for c in counts if c) / total
+
+class RankedGuess(NamedTuple):
+    index: int
+    score: float
+    is_candidate: bool
+
+class Ranker:
+    """ Ranks every word of `index` as a guess.
+
+    @param index: Words that may be guessed, and that may be the answer
+    @param table: Patterns of `index`'s words, if they have been built
+    @param sample_size: Candidates to score guesses against
+    """
+
+    def __init__(self, index: WordIndex, table: Optional[PatternTable]=None, sample_size: int=SAMPLE_SIZE):
+        self.index = index
+        self.table = table
+        self.sample_size = sample_size
+        # Ranking of the empty board
+        self.first_guesses: Optional[List[RankedGuess]] = None
+        self.first_guesses_lock = threading.Lock()
+        if index.array is not None:
+            # (letters, words) of 1 where the word contains the letter
+            self.letters = numpy.array(list(index.contains_array.values()), dtype=numpy.float32)
+        else:
+            self.words = [index.words[i * index.word_len:(i + 1) * index.word_len] for i in range(index.num_words)]
+            self.letter_sets = [set(word) for word in self.words]
+
+    def rank(self, candidates: List[int], top: int, budget: float) -> List[RankedGuess]:
+        """ Returns the `top` guesses, best first, against `candidates`.
+
+        A guess that may be the answer is ranked above one as good that may
+        not. At least `top` guesses are scored, however long it takes.
+
+        @param candidates: Indices of the words that may be the answer
+        @param budget: Seconds to spend scoring guesses
+        """
+        if not candidates:
+            return []
+        deadline = time.monotonic() + budget
+        is_candidate = set(candidates)
+        if len(candidates) > self.sample_size:
+            candidates = sorted(random.Random(len(candidates)).sample(candidates, self.sample_size))
+
+        if self.index.array is not None:
+            scored = self._score_array(candidates, top, deadline)
+        else:
+            scored = self._score(candidates, top, deadline)
+
+        ranked = [RankedGuess(i, score, i in is_candidate) for i, score in scored]
+        ranked.sort(key=lambda r: (-round(r.score, 6), not r.is_candidate, r.index))
+        return ranked[:top]
+
+    def rank_first_guesses(self, top: int, budget: float) -> List[RankedGuess]:
+        """ Returns the `top` guesses against every word.
+
+        Every puzzle starts here, so it is ranked once, and no more than
+        `top` guesses are kept. A later request for more gets `top`.
+        """
+        with self.first_guesses_lock:
+            if self.first_guesses is None:
+                self.first_guesses = self.rank(list(range(self.index.num_words)), top, budget)
+        return self.first_guesses[:top]
+
+    def _order(self, frequency: List[float]) -> List[int]:
+        """ Returns guesses, those whose letters are in the most candidates first. """
+        scores = [sum(frequency[letter] for letter in letters) for letters in self.letter_sets]
+        return sorted(range(len(scores)), key=lambda i: -scores[i])
+
+    def _score(self, candidates: List[int], top: int, deadline: float) -> List[tuple]:
+        answers = [self.words[i] for i in candidates]
+        frequency = [0] * 256
+        for i in candidates:
+            for letter in self.letter_sets[i]:
+                frequency[letter] += 1
+
+        if len(candidates) > 1:
+            select = itemgetter(*candidates)
+        else:
+            select = lambda row: (row[candidates[0]],)
+
+        scored = []
+        for guess in self._order(frequency):
+            if len(scored) >= top and time.monotonic() > deadline:
+                break
+            if self.table is not None:
+                counts = Counter(select(self.table.row(guess)))
+            else:
+                word = self.words[guess]
+                counts = Counter(pattern(word, answer) for answer in answers)
+            scored.append((guess, entropy(counts.values(), len(answers))))
+        return scored
+
+    def _score_array(self, candidates: List[int], top: int, deadline: float) -> List[tuple]:
+        answers = self.index.array[candidates]
+        frequency = self.letters[:, candidates].sum(axis=1)
+        order = numpy.argsort(-(frequency @ self.letters), kind="stable")
+
+        scored = []
+        for start in range(0, len(order), BLOCK_SIZE):
+            if len(scored) >= top and time.monotonic() > deadline:
+                break
+            guesses = order[start:start + BLOCK_SIZE]
+            if self.table is not None:
+                patterns = self.table.array[numpy.ix_(guesses, candidates)]
+            else:
+                patterns = pattern_matrix(self.index.array[guesses], answers)
+            # Count each guess's patterns with one `bincount`, by offsetting its row
+            num_patterns = 3 ** self.index.word_len
+            offsets = numpy.arange(len(guesses), dtype=numpy.int64)[:, None] * num_patterns
+            counts = numpy.bincount((patterns + offsets).ravel(), minlength=len(guesses) * num_patterns)
+            counts = counts.reshape(len(guesses), num_patterns)
+            sums = (counts * numpy.log2(numpy.maximum(counts, 1))).sum(axis=1)
+            scores = math.log2(len(candidates)) - sums / len(candidates)
+            scored.extend(zip(guesses.tolist(), scores.tolist()))
+        return scored
+
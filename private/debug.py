@@ -16,15 +16,16 @@
 # PUT saves and GET restores, mirroring the Swift shape so both read the same.
 #
 # Restoring is a plain file copy here, where the Swift side has to restart its
-# database: these services open a connection per statement and hold none open,
-# so replacing the file underneath them is enough.
+# database: these services hold only pooled connections, which
+# `lib.database` closes before the file (and its WAL) is replaced. Saving goes
+# through SQLite's backup, because a committed write may still be only in the
+# WAL.
 #
 # **Mounted only when `env` is `dev`.** They destroy data by design.
 #
 
 import logging
 import os
-import shutil
 import sys
 
 from typing import List, Optional
@@ -32,7 +33,7 @@ from typing import List, Optional
 from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
 
-from lib import Environment, get_config
+from lib import Environment, database, get_config
 
 router = APIRouter(prefix="/api/debug/uitests")
 
@@ -140,7 +141,7 @@ async def save_snapshot(name: str, bundle: Optional[str] = None):
         if not os.path.isfile(source):
             continue
         logging.info(f"Saving snapshot ({name}) for ({app})")
-        shutil.copyfile(source, _snapshot_path(app, name))
+        database.backup(source, _snapshot_path(app, name))
         acted.append(app)
     return DebugResult(apps=acted)
 
@@ -164,7 +165,7 @@ async def load_snapshot(name: str, bundle: Optional[str] = None):
             # to restore, which is not an error for a multi-app request.
             continue
         logging.info(f"Restoring snapshot ({name}) for ({app})")
-        shutil.copyfile(snapshot, _db(app).get_db_path())
+        database.restore(_db(app).get_db_path(), snapshot)
         acted.append(app)
 
     if not acted:
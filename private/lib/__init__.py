@@ -47,7 +47,8 @@ class Config(object):
         media_path,
         log_path,
         login_enabled,
-        jira_url
+        jira_url,
+        options=None
     ):
         # Path to config file e.g. `~/.boss/config`
         self.path = path
@@ -61,6 +62,9 @@ class Config(object):
         self.log_path = log_path
         self.login_enabled = login_enabled
         self.jira_url = jira_url
+        # Every value in the config file, including the optional tuning keys
+        # that have a sensible default. Read with `get_option`.
+        self.options = options or {}
 
 def get_config_dir():
     home_path = os.path.expanduser("~")
@@ -109,10 +113,22 @@ def get_config():
         get("log_path"),
         get("login_enabled"),
         get("jira_url"),
+        options=cfg
     )
     CONFIG = config
     return config
 
+def get_option(key: str, default: any=None) -> any:
+    """ Returns optional config value for `key`, or `default` if it is not set.
+
+    Required values are attributes of `Config`. This is for tuning knobs, such
+    as pool sizes and timeouts, that every install does not need to set.
+    """
+    val = get_config().options.get(key, None)
+    if val is None:
+        return default
+    return val
+
 def check_dir(path, name):
     path = path.strip().rstrip("/")
     if not os.path.isdir(path):
@@ -193,7 +209,8 @@ def configure_logging(
     backup_count: int=None,
     enable_smtp: bool=None,
     ignore_init: bool=None,
-    log_to_console: bool=None
+    log_to_console: bool=None,
+    queued: bool=None
 ):
     """ Configure logging for a service or script.
 
@@ -203,6 +220,8 @@ def configure_logging(
     @param backup_count - the number of rolling logs to create
     @param enable_smtp - will send logs to email if `True`
     @param ignore_init - will not emit initialization logs w/ config info
+    @param queued - write logs on a listener thread. Defaults to `log_queue`.
+    See `lib/logqueue.py`.
     """
     if log_to_console is None:
         log_to_console = True
@@ -219,6 +238,12 @@ def configure_logging(
     logger.setLevel(logging.DEBUG)
     formatter = logging.Formatter('%(asctime)s.%(msecs)03d %(levelname)s %(module)s:%(funcName)s:%(lineno)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
     log_path = os.path.join(get_log_path(), os.path.basename(service_name).replace(".py", ".log"))
+    from lib.state import is_multi_worker, worker_slot
+    if is_multi_worker():
+        # Workers rotating the same file would each rotate it on their own,
+        # and lose lines. Each writes its own.
+        root, ext = os.path.splitext(log_path)
+        log_path = f"{root}-{worker_slot()}{ext}"
     if not ignore_init:
         logging.info(f"Rotating log @ ({log_path})")
     # Add console logger if in dev
@@ -239,6 +264,17 @@ def configure_logging(
     rotate_handler.setLevel(level)
     rotate_handler.setFormatter(formatter)
     logger.addHandler(rotate_handler)
+    from lib import logqueue
+    if queued is None:
+        queued = get_bool(get_option("log_queue", False))
+    logqueue.install(
+        logger,
+        queued,
+        size=int(get_option("log_queue_size", 10000)),
+        overflow=get_option("log_queue_overflow", "newest"),
+        rate=float(get_option("log_rate_limit", 0)),
+        sampling=get_option("log_sampling", {})
+    )
     # For now, ignore mail as it is not tested
     if True:
         return
@@ -0,0 +1,224 @@
+#
+# Admission control
+#
+# Every app shares one process. Without a limit, a handful of expensive calls
+# (a Jira sync, a large export, a CSV commit of thousands of rows) can take
+# every worker thread and connection, and an operator's tap waits behind them.
+#
+# Each request to an app is admitted through a gate for its bundle and its
+# class. A route is `interactive` unless it is marked as bulk:
+#
+# ```
+# @router.get("/job/{job_id}/export")
+# @bulk()
+# @require_admin()
+# async def export_job(...): ...
+# ```
+#
+# A gate runs at most `limit` requests at once, and holds at most `queue` more
+# waiting for a turn. Past that, a request is refused at once with a 503 and a
+# `Retry-After`, rather than timing out at the back of a queue. Bulk gates are
+# small, so bulk work can only ever take a few threads from everything else.
+#
+# Limits are set with `admission` in the BOSS config, by class, and optionally
+# by bundle:
+#
+# ```
+# admission:
+#   interactive: {limit: 64, queue: 256}
+#   bulk: {limit: 2, queue: 4}
+#   io.bithead.lean-visualizer:
+#     bulk: {limit: 1, queue: 1}
+# ```
+#
+# Time spent waiting at a gate, and requests refused, are exported on
+# `/api/metrics`.
+#
+# Gates are per process. With more than one worker (`api_workers`), each has
+# its own, so up to `api_workers` times `limit` requests of a class run at
+# once. Divide the limits by the number of workers to keep the same ceiling.
+#
+
+import asyncio
+import json
+import re
+import time
+
+from collections import deque
+from lib import get_option, metrics
+from lib.metrics import UNMATCHED, bundle_for_path, mounted_bundles
+from pydantic import BaseModel
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+
+# class -> (limit, queue)
+DEFAULT_LIMITS = {
+    INTERACTIVE: (64, 256),
+    BULK: (2, 4)
+}
+
+class AdmissionStats(BaseModel):
+    # Summed over every gate
+    active: int
+    queued: int
+    admitted: int
+    shed: int
+
+class Shed(Exception):
+    """ A gate's queue is full. """
+    pass
+
+class Gate:
+    """ Admits `limit` callers at once, and queues up to `queue` more. """
+
+    def __init__(self, limit: int, queue: int):
+        self.limit = limit
+        self.queue = queue
+        self.active = 0
+        self.waiting: deque[asyncio.Future] = deque()
+        self.admitted = 0
+        self.shed = 0
+
+    async def acquire(self):
+        """ Wait for a turn. Raises `Shed` if too many are waiting. """
+        if self.active < self.limit and not self.waiting:
+            self.active += 1
+            self.admitted += 1
+            return
+        if len(self.waiting) >= self.queue:
+            self.shed += 1
+            raise Shed()
+        turn = asyncio.get_running_loop().create_future()
+        self.waiting.append(turn)
+        try:
+            await turn
+        except asyncio.CancelledError:
+            if turn.done() and not turn.cancelled():
+                # Handed a turn as it was cancelled. Pass it on.
+                self.release()
+            elif turn in self.waiting:
+                self.waiting.remove(turn)
+            raise
+        self.admitted += 1
+
+    def release(self):
+        # The turn passes straight to the next waiter; `active` is unchanged
+        while self.waiting:
+            turn = self.waiting.popleft()
+            if not turn.done():
+                turn.set_result(None)
+                return
+        self.active -= 1
+
+def bulk() -> Callable:
+    """ Mark a route as bulk work, admitted through its bundle's bulk gate. """
+    def decorator(func: Callable) -> Callable:
+        func.__admission__ = BULK
+        return func
+    return decorator
+
+# Read from `admission` on first use
+LIMITS: Optional[dict] = None
+# (bundle, class) -> gate
+GATES: Dict[Tuple[str, str], Gate] = {}
+
+def _limits(bundle: str, klass: str) -> Tuple[int, int]:
+    global LIMITS
+    if LIMITS is None:
+        LIMITS = get_option("admission", {}) or {}
+    limit, queue = DEFAULT_LIMITS[klass]
+    for config in (LIMITS.get(klass), (LIMITS.get(bundle) or {}).get(klass)):
+        if config:
+            limit = int(config.get("limit", limit))
+            queue = int(config.get("queue", queue))
+    return limit, queue
+
+def _gate(bundle: str, klass: str) -> Gate:
+    gate = GATES.get((bundle, klass))
+    if gate is None:
+        gate = GATES[(bundle, klass)] = Gate(*_limits(bundle, klass))
+    return gate
+
+def reset():
+    """ Forget every gate, and read `admission` again. Used by tests. """
+    global LIMITS
+    LIMITS = None
+    GATES.clear()
+
+class AdmissionMiddleware:
+    """ Admits every request to an app through its gate. Install with `app.add_middleware`. """
+
+    def __init__(self, app):
+        self.app = app
+        # (path pattern, methods) of each bulk route. Read from the app's
+        # routes on the first request, once they are all added.
+        self.bulk: Optional[List[Tuple[re.Pattern, set]]] = None
+        # Bundle IDs of mounted apps, read with `bulk`
+        self.bundles: Optional[Set[str]] = None
+
+    def _class(self, scope) -> str:
+        if self.bulk is None:
+            routes = getattr(scope.get("app"), "routes", [])
+            self.bulk = [
+                (route.path_regex, route.methods or set())
+                for route in routes
+                if getattr(getattr(route, "endpoint", None), "__admission__", None) == BULK
+            ]
+        for pattern, methods in self.bulk:
+            if scope["method"] in methods and pattern.match(scope["path"]):
+                return BULK
+        return INTERACTIVE
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        if self.bundles is None:
+            self.bundles = mounted_bundles(scope.get("app"))
+        bundle = bundle_for_path(scope["path"], self.bundles)
+        if bundle in ("boss", UNMATCHED):
+            # BOSS's own routes, e.g. metrics and docs, and paths of no app,
+            # which are answered 404 at once. A gate per unknown app would
+            # let a scanner add gates without end.
+            await self.app(scope, receive, send)
+            return
+
+        klass = self._class(scope)
+        gate = _gate(bundle, klass)
+        start = time.perf_counter()
+        try:
+            await gate.acquire()
+        except Shed:
+            metrics.record_admission(bundle, klass, time.perf_counter() - start, shed=True)
+            await _busy(send)
+            return
+        metrics.record_admission(bundle, klass, time.perf_counter() - start)
+        try:
+            # Streamed responses hold their turn until the last byte is sent
+            await self.app(scope, receive, send)
+        finally:
+            gate.release()
+
+async def _busy(send):
+    body = json.dumps({"detail": "The server is busy. Please try again."}).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": 503,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode("latin-1")),
+            (b"retry-after", b"1")
+        ]
+    })
+    await send({"type": "http.response.body", "body": body})
+
+def get_admission_stats() -> AdmissionStats:
+    gates = list(GATES.values())
+    return AdmissionStats(
+        active=sum(gate.active for gate in gates),
+        queued=sum(len(gate.waiting) for gate in gates),
+        admitted=sum(gate.admitted for gate in gates),
+        shed=sum(gate.shed for gate in gates)
+    )
@@ -0,0 +1,105 @@
+#
+# In-process caches shared by the private services
+#
+
+import asyncio
+
+from cachetools import TTLCache
+from pydantic import BaseModel
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+# Distinguishes "not cached" from a cached `None`.
+MISSING = object()
+
+class CacheStats(BaseModel):
+    hits: int
+    misses: int
+    # Entries pushed out because the cache was full. A cache that evicts often
+    # is too small for its working set.
+    evictions: int
+    size: int
+    maxSize: int
+
+class Cache(TTLCache):
+    """ A bounded TTL cache that counts how well it is doing.
+
+    Not thread-safe. Every cache here is read and written from the event loop.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        super().__init__(maxsize, ttl)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(self, key: Hashable, default: Any=MISSING) -> Any:
+        """ Returns cached value for `key`, counting the hit or miss. """
+        value = self.get(key, MISSING)
+        if value is MISSING:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def popitem(self):
+        # Called only when an insert finds the cache full. Expired entries are
+        # removed by `expire`, which does not come through here.
+        item = super().popitem()
+        self.evictions += 1
+        return item
+
+    def stats(self) -> CacheStats:
+        return CacheStats(
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            size=len(self),
+            maxSize=self.maxsize
+        )
+
+class SingleFlightStats(BaseModel):
+    # Calls that did the work
+    started: int
+    # Calls that waited for a call already in flight instead
+    collapsed: int
+    inFlight: int
+
+class SingleFlight:
+    """ Shares one in-flight call between every caller asking the same thing.
+
+    The first caller for a key starts `func`; anyone asking for the same key
+    before it finishes awaits that call and gets its result, or its exception.
+    Nothing is kept once the call finishes, so this only removes duplicate
+    work that overlaps in time. Pair it with a `Cache` to go further.
+
+    Callers share the result object. Treat it as read-only, or copy it.
+    """
+
+    def __init__(self):
+        self.calls: Dict[Hashable, asyncio.Future] = {}
+        self.started = 0
+        self.collapsed = 0
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[Any]]) -> Any:
+        call = self.calls.get(key)
+        if call is None:
+            call = asyncio.ensure_future(func())
+            self.calls[key] = call
+            call.add_done_callback(lambda _: self._finished(key, call))
+            self.started += 1
+        else:
+            self.collapsed += 1
+        # Shielded, so a caller that is cancelled (e.g. its client went away)
+        # does not cancel the call for everyone else waiting on it.
+        return await asyncio.shield(call)
+
+    def _finished(self, key: Hashable, call: asyncio.Future):
+        if self.calls.get(key) is call:
+            del self.calls[key]
+        # Every waiter may have been cancelled, leaving no one to see the
+        # call's exception. Retrieve it, so asyncio does not log it as lost.
+        if not call.cancelled():
+            call.exception()
+
+    def stats(self) -> SingleFlightStats:
+        return SingleFlightStats(started=self.started, collapsed=self.collapsed, inFlight=len(self.calls))
@@ -0,0 +1,146 @@
+#
+# Conditional GET: ETag and If-None-Match
+#
+# Screens poll their data, and it is usually unchanged since the last poll.
+# A route that can tell cheaply whether its data changed (a revision counter,
+# the latest event id) declares how, and a poll that already has the current
+# data is answered `304 Not Modified` without the route running at all:
+#
+# ```
+# @router.get("/job/{job_id}", response_model=JobDetail)
+# @require_admin()
+# @etag(lambda job_id: db.get_revision())
+# async def get_job(job_id: int, request: Request):
+#     ...
+# ```
+#
+# The version function is called with whichever of the route's parameters it
+# names. What it returns, with the request's path and query, identifies the
+# response; it must change whenever the response would. Returning `None`
+# skips the check, and the route runs as usual.
+#
+# Put `@etag` after any auth decorator, so a caller is authorized before being
+# told nothing changed.
+#
+
+import functools
+import hashlib
+import inspect
+
+from fastapi import Request, Response
+from pydantic import BaseModel
+from typing import Any, Callable, List
+
+# Parameters added to a route that does not already take them
+REQUEST_PARAM = "etag_request"
+RESPONSE_PARAM = "etag_response"
+
+class ConditionalStats(BaseModel):
+    # Conditional requests answered `304`, and those whose data had changed
+    notModified: int
+    modified: int
+    # Requests without an `If-None-Match`
+    unconditional: int
+
+NOT_MODIFIED = 0
+MODIFIED = 0
+UNCONDITIONAL = 0
+
+def make_etag(request: Request, version: Any) -> str:
+    key = f"{request.url.path}?{request.url.query}#{version!r}"
+    return f'"{hashlib.blake2b(key.encode("utf-8"), digest_size=12).hexdigest()}"'
+
+def _parse_if_none_match(value: str) -> List[str]:
+    # Weak and strong tags compare alike for a GET
+    return [tag.strip().removeprefix("W/") for tag in value.split(",") if tag.strip()]
+
+def matches(request: Request, tag: str) -> bool:
+    """ Returns `True` if the client already has the response tagged `tag`. """
+    value = request.headers.get("if-none-match")
+    if not value:
+        return False
+    tags = _parse_if_none_match(value)
+    return "*" in tags or tag in tags
+
+def etag(version: Callable[..., Any]) -> Callable:
+    """ Answer `304 Not Modified` when the client has the current response.
+
+    Every response is sent with its `ETag`, and `Cache-Control: no-cache` so a
+    browser asks again rather than assuming it is fresh.
+
+    @param version: Returns what the response depends on, or `None`. Called
+        with the route's parameters it names. Keep it cheap: it runs on every
+        request, on the event loop of an async route.
+    """
+    version_params = list(inspect.signature(version).parameters)
+
+    def decorator(func: Callable) -> Callable:
+        # Resolved here, as FastAPI would resolve them in this module
+        sig = inspect.signature(func, eval_str=True)
+        params = list(sig.parameters.values())
+        unknown = set(version_params) - set(sig.parameters)
+        if unknown:
+            raise ValueError(f"ETag version of ({func.__name__}) takes parameters the route does not ({', '.join(sorted(unknown))})")
+        has_request = any(param.annotation is Request for param in params)
+        request_name = next((param.name for param in params if param.annotation is Request), REQUEST_PARAM)
+        keyword = inspect.Parameter.KEYWORD_ONLY
+        if not has_request:
+            params.append(inspect.Parameter(REQUEST_PARAM, keyword, annotation=Request))
+        params.append(inspect.Parameter(RESPONSE_PARAM, keyword, annotation=Response))
+
+        def check(kwargs: dict) -> tuple:
+            """ Returns (tag, `Response` if not modified). """
+            global NOT_MODIFIED, MODIFIED, UNCONDITIONAL
+            request = kwargs[request_name] if has_request else kwargs.pop(REQUEST_PARAM)
+            current = version(**{name: kwargs[name] for name in version_params})
+            if current is None:
+                return None, None
+            tag = make_etag(request, current)
+            if not request.headers.get("if-none-match"):
+                UNCONDITIONAL += 1
+            elif matches(request, tag):
+                NOT_MODIFIED += 1
+                return tag, Response(status_code=304, headers=_headers(tag))
+            else:
+                MODIFIED += 1
+            return tag, None
+
+        def tagged(result: Any, tag: str, response: Response) -> Any:
+            if tag is None:
+                return result
+            # A route's own response is sent as is; otherwise FastAPI copies
+            # these headers onto the one it builds.
+            headers = result.headers if isinstance(result, Response) else response.headers
+            headers.update(_headers(tag))
+            return result
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                response = kwargs.pop(RESPONSE_PARAM)
+                tag, not_modified = check(kwargs)
+                if not_modified is not None:
+                    return not_modified
+                return tagged(await func(*args, **kwargs), tag, response)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                response = kwargs.pop(RESPONSE_PARAM)
+                tag, not_modified = check(kwargs)
+                if not_modified is not None:
+                    return not_modified
+                return tagged(func(*args, **kwargs), tag, response)
+
+        wrapper.__signature__ = sig.replace(parameters=params)
+        return wrapper
+    return decorator
+
+def _headers(tag: str) -> dict:
+    return {"ETag": tag, "Cache-Control": "no-cache"}
+
+def get_conditional_stats() -> ConditionalStats:
+    return ConditionalStats(
+        notModified=NOT_MODIFIED,
+        modified=MODIFIED,
+        unconditional=UNCONDITIONAL
+    )
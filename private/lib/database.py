@@ -0,0 +1,235 @@
+#
+# Pooled SQLite connections shared by the private services
+#
+# Each app used to open a connection per statement and close it straight
+# after, paying for the open, the schema read and its PRAGMAs every time. Here
+# each database file gets a small pool of long-lived connections, configured
+# once when they are opened:
+#
+#   journal_mode=WAL     readers do not wait on the writer
+#   synchronous=NORMAL   safe in WAL; fsyncs at checkpoints, not every commit
+#   busy_timeout         a writer waits for the lock instead of failing
+#   mmap_size/cache_size reads are served from memory
+#
+# `connect` hands out a connection; `close()` on it returns it to the pool.
+# App code keeps its `try`/`finally: conn.close()` exactly as before.
+#
+# A returned connection that is still in a transaction is rolled back first.
+# That keeps the rule Production's `db.py` documents: a statement that fails
+# leaves its connection holding SQLite's write lock, and if that connection
+# went back to the pool as is, every later write would fail with "database is
+# locked". Rolled back, it holds nothing.
+#
+
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+
+from lib import get_option
+from pydantic import BaseModel
+from typing import Dict, List, Optional
+
+class PoolStats(BaseModel):
+    path: str
+    # Connections opened, and the times an open one was handed out again
+    opened: int
+    reused: int
+    idle: int
+    # Connections returned mid-transaction, and rolled back
+    rollbacks: int
+
+class DatabaseStats(BaseModel):
+    """ Every pool, summed. """
+    pools: int
+    opened: int
+    reused: int
+    idle: int
+    rollbacks: int
+
+class PooledConnection(sqlite3.Connection):
+    """ A connection whose `close` returns it to its pool. """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool: Optional["Pool"] = None
+        # The pool's generation when this was opened. See `Pool.close`.
+        self.generation = 0
+
+    def close(self):
+        if self.pool is None:
+            super().close()
+        else:
+            self.pool.release(self)
+
+    def discard(self):
+        """ Close for good. """
+        super().close()
+
+class Pool:
+    """ Idle connections to one database file.
+
+    Never blocks: when no connection is idle, a new one is opened. At most
+    `size` are kept idle; any more are closed as they are returned.
+
+    Connections are opened with `check_same_thread=False`, because a sync
+    route runs on a worker thread and the connection may have been opened on
+    another. Each is used by one thread at a time: whoever holds it.
+    """
+
+    def __init__(self, path: str, size: int, foreign_keys: bool, factory: type):
+        self.path = path
+        self.size = size
+        self.foreign_keys = foreign_keys
+        self.factory = factory
+        self.idle: List[PooledConnection] = []
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.opened = 0
+        self.reused = 0
+        self.rollbacks = 0
+
+    def acquire(self) -> PooledConnection:
+        with self.lock:
+            if self.idle:
+                self.reused += 1
+                return self.idle.pop()
+            generation = self.generation
+        conn = self._open()
+        conn.generation = generation
+        return conn
+
+    def _open(self) -> PooledConnection:
+        conn = sqlite3.connect(
+            self.path,
+            factory=self.factory,
+            check_same_thread=False,
+            cached_statements=int(get_option("sqlite_cached_statements", 256))
+        )
+        try:
+            conn.execute(f"PRAGMA busy_timeout = {int(get_option('sqlite_busy_timeout_ms', 5000))}")
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+            conn.execute(f"PRAGMA mmap_size = {int(get_option('sqlite_mmap_size', 64 * 1024 * 1024))}")
+            # Negative is KiB, not pages
+            conn.execute(f"PRAGMA cache_size = -{int(get_option('sqlite_cache_kib', 8192))}")
+            if self.foreign_keys:
+                conn.execute("PRAGMA foreign_keys = ON")
+        except Exception:
+            conn.discard()
+            raise
+        conn.pool = self
+        with self.lock:
+            self.opened += 1
+        return conn
+
+    def release(self, conn: PooledConnection):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+                with self.lock:
+                    self.rollbacks += 1
+            # Handed out as it was opened. Callers set their own.
+            conn.row_factory = None
+        except sqlite3.Error as error:
+            logging.warning(f"Discarding connection to ({self.path}): {error}")
+            conn.discard()
+            return
+        with self.lock:
+            if conn.generation == self.generation and len(self.idle) < self.size:
+                self.idle.append(conn)
+                return
+        conn.discard()
+
+    def close(self):
+        """ Close every idle connection. Those in use are closed when returned. """
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+            self.generation += 1
+        for conn in idle:
+            conn.discard()
+
+    def stats(self) -> PoolStats:
+        with self.lock:
+            return PoolStats(
+                path=self.path,
+                opened=self.opened,
+                reused=self.reused,
+                idle=len(self.idle),
+                rollbacks=self.rollbacks
+            )
+
+# Database path -> pool
+POOLS: Dict[str, Pool] = {}
+POOLS_LOCK = threading.Lock()
+
+def connect(path: str, foreign_keys: bool=False, factory: type=PooledConnection) -> sqlite3.Connection:
+    """ A connection to the database at `path`, from its pool.
+
+    `close()` it when done, in a `finally`, as with any connection.
+
+    @param foreign_keys: Enforce foreign keys
+    @param factory: Connection class. Must subclass `PooledConnection`.
+    NOTE: Both are fixed by the first connection made to `path`.
+    """
+    pool = POOLS.get(path)
+    if pool is None:
+        with POOLS_LOCK:
+            pool = POOLS.get(path)
+            if pool is None:
+                size = int(get_option("sqlite_pool_size", 4))
+                pool = POOLS[path] = Pool(path, size, foreign_keys, factory)
+    return pool.acquire()
+
+def close(path: Optional[str]=None):
+    """ Close every pooled connection to `path`, or to every database.
+
+    Do this before the file is removed or replaced. A connection left open
+    would keep reading the old file.
+    """
+    with POOLS_LOCK:
+        pools = [POOLS[path]] if path in POOLS else ([] if path else list(POOLS.values()))
+    for pool in pools:
+        pool.close()
+
+def _sidecars(path: str) -> List[str]:
+    return [path, f"{path}-wal", f"{path}-shm"]
+
+def remove(path: str):
+    """ Close the database at `path` and delete it, with its WAL files. """
+    close(path)
+    for file in _sidecars(path):
+        if os.path.isfile(file):
+            os.unlink(file)
+
+def backup(path: str, dest: str):
+    """ Copy the database at `path` to `dest`, including what is only in its WAL. """
+    source = sqlite3.connect(path)
+    target = sqlite3.connect(dest)
+    try:
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
+
+def restore(path: str, source: str):
+    """ Replace the database at `path` with the copy at `source`. """
+    remove(path)
+    shutil.copyfile(source, path)
+
+def get_pool_stats() -> List[PoolStats]:
+    with POOLS_LOCK:
+        pools = list(POOLS.values())
+    return [pool.stats() for pool in pools]
+
+def get_database_stats() -> DatabaseStats:
+    pools = get_pool_stats()
+    return DatabaseStats(
+        pools=len(pools),
+        opened=sum(pool.opened for pool in pools),
+        reused=sum(pool.reused for pool in pools),
+        idle=sum(pool.idle for pool in pools),
+        rollbacks=sum(pool.rollbacks for pool in pools)
+    )
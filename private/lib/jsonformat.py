@@ -0,0 +1,63 @@
+#
+# Formats JSON text
+#
+# Used by the JSON Formatter app, for documents of any size. Large documents
+# are formatted in a worker process (see `lib/workers.py`), so everything here
+# is a module-level function that takes and returns plain values.
+#
+# Text is parsed with `json`: `orjson` reads integers past 64 bits as floats,
+# which would change the numbers in a document. Minified text is written with
+# `orjson` if it is installed, which is several times faster, unless the
+# value is one `orjson` cannot write as it was (e.g. `NaN`, which it writes
+# as `null`).
+#
+
+import json
+
+from pydantic import BaseModel
+from typing import Any, Optional
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+INDENT = 4
+
+class FormatResult(BaseModel):
+    text: Optional[str] = None
+    decodeError: Optional[str] = None
+    # 1-based line and column of the decode error
+    decodeLine: Optional[int] = None
+    decodeColumn: Optional[int] = None
+
+def _dumps(value: Any, minify: bool, sort_keys: bool, constants: bool) -> str:
+    if minify:
+        if orjson is not None and not constants:
+            try:
+                option = orjson.OPT_SORT_KEYS if sort_keys else 0
+                return orjson.dumps(value, option=option).decode("utf-8")
+            except (TypeError, orjson.JSONEncodeError):
+                # e.g. an integer past 64 bits
+                pass
+        return json.dumps(value, separators=(",", ":"), sort_keys=sort_keys)
+    return json.dumps(value, indent=INDENT, sort_keys=sort_keys)
+
+def format_text(text: str, minify: bool=False, sort_keys: bool=False) -> FormatResult:
+    """ Format JSON text.
+
+    @param minify: Leave out all whitespace, rather than indenting
+    @param sort_keys: Sort the keys of every object
+    """
+    # `NaN`, `Infinity` and `-Infinity` read
+    constants = []
+
+    def parse_constant(name: str) -> float:
+        constants.append(name)
+        return float(name)
+
+    try:
+        value = json.loads(text, parse_constant=parse_constant)
+    except json.JSONDecodeError as exc:
+        return FormatResult(decodeError=str(exc), decodeLine=exc.lineno, decodeColumn=exc.colno)
+    return FormatResult(text=_dumps(value, minify, sort_keys, bool(constants)))
@@ -0,0 +1,190 @@
+#
+# Queued logging
+#
+# By default every log call writes to the log file, and sometimes rotates it,
+# on the thread that made it: a request waits on the disk to say it is being
+# handled. With `log_queue: true` in the BOSS config, a log call only puts the
+# record on a bounded queue, and a listener thread writes it out.
+#
+# Options:
+#
+#   log_queue           Queue records. Default `false`.
+#   log_queue_size      Most records waiting to be written. Default 10000.
+#   log_queue_overflow  What to drop when full. `newest` (default) drops the
+#                       record being logged; `oldest` the one waiting longest;
+#                       `block` waits for room, losing nothing.
+#   log_rate_limit      Most records per second from one line of code. Past
+#                       that, its records are dropped and counted, and the
+#                       next one written says how many were. Default 0, no
+#                       limit.
+#   log_sampling        Logger name -> fraction of its records to keep, e.g.
+#                       `{"uvicorn.access": 0.1}`.
+#
+# The limit and sampling apply below WARNING only, and with or without the
+# queue. A warning is never dropped by them.
+#
+# Records still queued are written at shutdown, by `stop_logging`, or at exit.
+#
+
+import atexit
+import logging
+import queue
+import random
+import threading
+import time
+
+from logging.handlers import QueueHandler, QueueListener
+from pydantic import BaseModel
+from typing import Dict, List, Optional, Tuple
+
+class LoggingStats(BaseModel):
+    queued: bool
+    # Records waiting to be written
+    depth: int
+    maxDepth: int
+    # Records dropped because the queue was full
+    dropped: int
+    # Records dropped by `log_rate_limit`, and by `log_sampling`
+    limited: int
+    sampled: int
+
+class RateLimitFilter(logging.Filter):
+    """ Limits records below WARNING, per line of code, and samples by logger.
+
+    @param rate: Records per second from one line. 0 for no limit.
+    @param sampling: Logger name -> fraction of records kept
+    """
+
+    def __init__(self, rate: float=0, sampling: Optional[Dict[str, float]]=None):
+        super().__init__()
+        self.rate = rate
+        self.sampling = sampling or {}
+        self.lock = threading.Lock()
+        # (path, line) -> (tokens, last refilled, dropped since last kept)
+        self.buckets: Dict[Tuple[str, int], Tuple[float, float, int]] = {}
+        self.limited = 0
+        self.sampled = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        # Without the queue, this filters each handler. Decide once per record.
+        keep = getattr(record, "boss_keep", None)
+        if keep is None:
+            keep = record.boss_keep = self._keep(record)
+        return keep
+
+    def _keep(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        fraction = self.sampling.get(record.name)
+        if fraction is not None and random.random() >= fraction:
+            with self.lock:
+                self.sampled += 1
+            return False
+        if not self.rate:
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self.lock:
+            tokens, refilled, dropped = self.buckets.get(key, (self.rate, now, 0))
+            # A second's worth of records may burst
+            tokens = min(self.rate, tokens + (now - refilled) * self.rate)
+            if tokens < 1:
+                self.buckets[key] = (tokens, now, dropped + 1)
+                self.limited += 1
+                return False
+            self.buckets[key] = (tokens - 1, now, 0)
+        if dropped:
+            record.msg = f"{record.msg} ({dropped} similar suppressed)"
+        return True
+
+class BoundedQueueHandler(QueueHandler):
+    """ Puts records on a bounded queue, dropping per `overflow` when full. """
+
+    def __init__(self, size: int, overflow: str):
+        if overflow not in ("newest", "oldest", "block"):
+            raise ValueError(f"Log queue overflow must be (newest), (oldest) or (block), not ({overflow})")
+        super().__init__(queue.Queue(size))
+        self.overflow = overflow
+        self.max_depth = 0
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        if self.overflow == "block":
+            self.queue.put(record)
+        else:
+            while True:
+                try:
+                    self.queue.put_nowait(record)
+                    break
+                except queue.Full:
+                    self.dropped += 1
+                    if self.overflow == "newest":
+                        return
+                    try:
+                        self.queue.get_nowait()
+                    except queue.Empty:
+                        pass
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+
+# Set by `configure_logging`
+LOGGER: Optional[logging.Logger] = None
+HANDLER: Optional[BoundedQueueHandler] = None
+LISTENER: Optional[QueueListener] = None
+FILTER: Optional[RateLimitFilter] = None
+
+def install(
+    logger: logging.Logger,
+    queued: bool,
+    size: int=10000,
+    overflow: str="newest",
+    rate: float=0,
+    sampling: Optional[Dict[str, float]]=None
+):
+    """ Limit `logger`'s handlers and, if `queued`, move them to a listener thread.
+
+    Called by `configure_logging`, once its handlers are attached.
+    """
+    global LOGGER, HANDLER, LISTENER, FILTER
+    # Configured again. The handlers being replaced are dropped with it.
+    if LISTENER is not None:
+        LISTENER.stop()
+        LISTENER = None
+    FILTER = RateLimitFilter(rate, sampling)
+    if not queued:
+        for handler in logger.handlers:
+            handler.addFilter(FILTER)
+        return
+    handlers: List[logging.Handler] = list(logger.handlers)
+    LOGGER = logger
+    HANDLER = BoundedQueueHandler(size, overflow)
+    HANDLER.addFilter(FILTER)
+    # Each handler still applies its own level and filters
+    LISTENER = QueueListener(HANDLER.queue, *handlers, respect_handler_level=True)
+    logger.handlers = [HANDLER]
+    LISTENER.start()
+
+def stop_logging():
+    """ Write every queued record, and stop the listener. """
+    global HANDLER, LISTENER
+    listener = LISTENER
+    LISTENER = None
+    if listener is None:
+        return
+    # Records logged from here on are written on the caller's thread
+    if HANDLER in LOGGER.handlers:
+        LOGGER.handlers = [handler for handler in LOGGER.handlers if handler is not HANDLER] + list(listener.handlers)
+        for handler in listener.handlers:
+            handler.addFilter(FILTER)
+    listener.stop()
+
+atexit.register(stop_logging)
+
+def get_logging_stats() -> LoggingStats:
+    return LoggingStats(
+        queued=LISTENER is not None,
+        depth=HANDLER.queue.qsize() if LISTENER is not None else 0,
+        maxDepth=HANDLER.max_depth if HANDLER is not None else 0,
+        dropped=HANDLER.dropped if HANDLER is not None else 0,
+        limited=FILTER.limited if FILTER is not None else 0,
+        sampled=FILTER.sampled if FILTER is not None else 0
+    )
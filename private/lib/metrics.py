@@ -0,0 +1,463 @@
+#
+# Request metrics, exported in Prometheus text format
+#
+# `MetricsMiddleware` times every `/api` request by route, app and status.
+# Time spent asking the Swift backend who the caller is (`record_auth`) is
+# split out from the time the route itself took, because that split is the
+# first question whenever a route is slow.
+#
+# Everything is kept in process, in fixed buckets, so recording a request is a
+# few additions. Percentiles are estimated from the buckets.
+#
+# SQL statements are timed too, when the `sql_metrics` option is on: each
+# app's `select`/`update`/`insert` go through `statement`. Each request's
+# statement count is recorded against its route, which is what makes an N+1
+# query visible.
+#
+# Metrics are per process. With more than one worker (`api_workers`), a scrape
+# is answered by whichever worker takes it, and reports only that worker's
+# requests. Sum `boss_http_requests_total` and the like over several scrapes,
+# or run one worker where exact totals matter.
+#
+# `/api/metrics` is for the scraper, not the public: it names SQL statements,
+# routes and the size of every cache. nginx denies it, and `is_scrape_allowed`
+# refuses anything but a scraper on this host, or one with the
+# `metrics_token` option as its bearer token.
+#
+
+import bisect
+import hmac
+import logging
+import sqlite3
+import threading
+import time
+
+from contextvars import ContextVar
+from functools import lru_cache
+from lib import get_option
+from pydantic import BaseModel
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+# Upper bounds of the latency buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Upper bounds of the buckets counting SQL statements per request
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+QUANTILES = (0.5, 0.9, 0.99)
+
+# Route label for a request that matched no route, and bundle label for a
+# path naming no mounted app. Unmatched paths are not used as labels, or every
+# scanner probing the server would add a series.
+UNMATCHED = "unmatched"
+
+class Histogram:
+    """ Counts observations in fixed buckets. """
+
+    __slots__ = ("buckets", "counts", "count", "sum")
+
+    def __init__(self, buckets: Tuple[float, ...]=BUCKETS):
+        self.buckets = buckets
+        # One more than `buckets`, for observations above the last bound
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """ Estimates the `q` quantile, interpolating within its bucket. """
+        if self.count == 0:
+            return 0.0
+        buckets = self.buckets
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count > 0:
+                lower = buckets[i - 1] if i > 0 else 0.0
+                # Nothing better is known above the last bound
+                if i == len(buckets):
+                    return lower
+                return lower + (buckets[i] - lower) * (rank - seen) / count
+            seen += count
+        return buckets[-1]
+
+class RequestMetrics:
+    """ What is recorded about the request being handled. """
+
+    __slots__ = ("auth", "queries", "sql")
+
+    def __init__(self):
+        # Seconds spent authenticating the caller
+        self.auth = 0.0
+        # SQL statements run, and the seconds they took. Only counted when
+        # `sql_metrics` is on.
+        self.queries = 0
+        self.sql = 0.0
+
+# The request being handled, if it is being measured
+CURRENT_REQUEST: ContextVar[Optional[RequestMetrics]] = ContextVar("boss_request_metrics", default=None)
+
+# (bundle, route, method) -> histogram
+LATENCY: Dict[Tuple[str, str, str], Histogram] = {}
+AUTH_LATENCY: Dict[Tuple[str, str, str], Histogram] = {}
+HANDLER_LATENCY: Dict[Tuple[str, str, str], Histogram] = {}
+QUERIES_PER_REQUEST: Dict[Tuple[str, str, str], Histogram] = {}
+SQL_PER_REQUEST: Dict[Tuple[str, str, str], Histogram] = {}
+# (bundle, route, method, status) -> count
+REQUESTS: Dict[Tuple[str, str, str, int], int] = {}
+
+# (bundle, statement) -> histogram. `statement` is the SQL, condensed.
+STATEMENT_LATENCY: Dict[Tuple[str, str], Histogram] = {}
+# (bundle, statement) -> rows returned or changed
+STATEMENT_ROWS: Dict[Tuple[str, str], int] = {}
+# Statements run on worker threads (sync routes), so their metrics are locked.
+STATEMENT_LOCK = threading.Lock()
+
+# Whether statements are timed. Read from `sql_metrics` on first use.
+SQL_ENABLED: Optional[bool] = None
+# Statements slower than this are logged. Read from `sql_slow_ms` on first use.
+SQL_SLOW_SECONDS: Optional[float] = None
+
+# (bundle, class) -> time requests waited to be admitted, and requests refused.
+# See `lib/admission.py`.
+ADMISSION_WAIT: Dict[Tuple[str, str], Histogram] = {}
+ADMISSION_SHED: Dict[Tuple[str, str], int] = {}
+
+# (bundle, phase) -> seconds an app took to import, start, or register its
+# routes. Not cleared by `reset`: boot happens once.
+BOOT_SECONDS: Dict[Tuple[str, str], float] = {}
+
+# name -> function returning a model of gauges. See `add_collector`.
+COLLECTORS: Dict[str, Callable[[], BaseModel]] = {}
+
+def record_auth(seconds: float):
+    """ Adds `seconds` of authentication to the current request. """
+    metrics = CURRENT_REQUEST.get()
+    if metrics is not None:
+        metrics.auth += seconds
+
+def record_admission(bundle: str, klass: str, waited: float, shed: bool=False):
+    """ Records a request admitted after `waited` seconds, or refused. """
+    if shed:
+        ADMISSION_SHED[(bundle, klass)] = ADMISSION_SHED.get((bundle, klass), 0) + 1
+    else:
+        _observe(ADMISSION_WAIT, (bundle, klass), waited)
+
+def record_boot(bundle: str, phase: str, seconds: float):
+    BOOT_SECONDS[(bundle, phase)] = seconds
+
+def add_collector(name: str, collect: Callable[[], BaseModel]):
+    """ Export the fields of the model `collect` returns as gauges.
+
+    Called at every scrape. Each number, including those of nested models, is
+    exported as `boss_<name>_<field>`.
+
+    @param name: snake_case name of what is collected. e.g. `outbox`
+    """
+    COLLECTORS[name] = collect
+
+def reset():
+    """ Forget everything recorded. """
+    for metrics in (LATENCY, AUTH_LATENCY, HANDLER_LATENCY, QUERIES_PER_REQUEST, SQL_PER_REQUEST,
+                    REQUESTS, STATEMENT_LATENCY, STATEMENT_ROWS, ADMISSION_WAIT, ADMISSION_SHED):
+        metrics.clear()
+
+# SQL
+
+def enable_sql_metrics(enabled: bool=True, slow_ms: Optional[float]=None):
+    """ Turn statement timing on or off, overriding `sql_metrics`. """
+    global SQL_ENABLED, SQL_SLOW_SECONDS
+    SQL_ENABLED = enabled
+    if slow_ms is not None:
+        SQL_SLOW_SECONDS = slow_ms / 1000
+
+def _sql_enabled() -> bool:
+    global SQL_ENABLED, SQL_SLOW_SECONDS
+    if SQL_ENABLED is None:
+        SQL_ENABLED = bool(get_option("sql_metrics", False))
+    if SQL_SLOW_SECONDS is None:
+        SQL_SLOW_SECONDS = float(get_option("sql_slow_ms", 100)) / 1000
+    return SQL_ENABLED
+
+@lru_cache(maxsize=1024)
+def _condense(query: str) -> str:
+    """ The SQL as one line, short enough to be a label. """
+    condensed = " ".join(query.split())
+    return condensed if len(condensed) <= 120 else condensed[:117] + "..."
+
+class Statement:
+    """ Times one statement. Set `rows` to what it returned or changed. """
+
+    __slots__ = ("bundle", "query", "rows", "start")
+
+    def __init__(self, bundle: str, query: str):
+        self.bundle = bundle
+        self.query = query
+        self.rows: Optional[int] = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        key = (self.bundle, _condense(self.query))
+        with STATEMENT_LOCK:
+            _observe(STATEMENT_LATENCY, key, elapsed)
+            if self.rows is not None and self.rows >= 0:
+                STATEMENT_ROWS[key] = STATEMENT_ROWS.get(key, 0) + self.rows
+        request = CURRENT_REQUEST.get()
+        if request is not None:
+            request.queries += 1
+            request.sql += elapsed
+        if elapsed >= SQL_SLOW_SECONDS:
+            logging.warning(f"Slow query ({elapsed * 1000:.1f}ms) ({self.bundle}) rows ({self.rows}): {key[1]}")
+        return False
+
+class _NoStatement:
+    """ Stands in for `Statement` when statements are not timed. """
+
+    __slots__ = ("rows",)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NO_STATEMENT = _NoStatement()
+
+def statement(bundle: str, query: str):
+    """ Context manager timing `query`, run by `bundle`'s database.
+
+    ```
+    with metrics.statement(BUNDLE_ID, query) as stmt:
+        records = cursor.execute(query, params).fetchall()
+        stmt.rows = len(records)
+    ```
+    """
+    if not _sql_enabled():
+        return NO_STATEMENT
+    return Statement(bundle, query)
+
+def instrumented_connection(bundle: str, base: type=sqlite3.Connection) -> type:
+    """ A `sqlite3.Connection` factory whose `execute` is timed.
+
+    For an app that runs statements on its connection rather than through
+    `select`/`update`/`insert`. Rows are counted only for writes; rows a
+    `SELECT` returns are not known until they are fetched.
+
+    ```
+    sqlite3.connect(path, factory=metrics.instrumented_connection(BUNDLE_ID))
+    ```
+
+    @param base: Connection class to time. e.g. `lib.database.PooledConnection`
+    """
+    class InstrumentedConnection(base):
+        def execute(self, sql, parameters=(), /):
+            with statement(bundle, sql) as stmt:
+                cursor = super().execute(sql, parameters)
+                stmt.rows = cursor.rowcount
+            return cursor
+
+        def executemany(self, sql, parameters, /):
+            with statement(bundle, sql) as stmt:
+                cursor = super().executemany(sql, parameters)
+                stmt.rows = cursor.rowcount
+            return cursor
+
+    return InstrumentedConnection
+
+def _observe(metrics: Dict[Tuple, Histogram], key: Tuple, value: float, buckets: Tuple[float, ...]=BUCKETS):
+    histogram = metrics.get(key)
+    if histogram is None:
+        histogram = metrics[key] = Histogram(buckets)
+    histogram.observe(value)
+
+def _bundle_id(path: str) -> Optional[str]:
+    parts = path.split("/", 3)
+    if len(parts) > 2 and parts[1] == "api" and "." in parts[2]:
+        return parts[2]
+    return None
+
+def mounted_bundles(app) -> Set[str]:
+    """ Bundle IDs of the apps with routes on `app`. """
+    bundles = set()
+    for route in getattr(app, "routes", []):
+        bundle_id = _bundle_id(getattr(route, "path", ""))
+        if bundle_id is not None:
+            bundles.add(bundle_id)
+    return bundles
+
+def bundle_for_path(path: str, bundles: Set[str]) -> str:
+    """ App a path belongs to. e.g. `/api/io.bithead.wordy/guess` -> `io.bithead.wordy`
+
+    `boss` for BOSS's own routes, and `UNMATCHED` for an app that is not
+    one of `bundles`, those mounted.
+    """
+    bundle_id = _bundle_id(path)
+    if bundle_id is None:
+        return "boss"
+    if bundle_id not in bundles:
+        return UNMATCHED
+    return bundle_id
+
+class MetricsMiddleware:
+    """ Times every `/api` request. Install with `app.add_middleware`. """
+
+    def __init__(self, app):
+        self.app = app
+        # Endpoint function -> route path, e.g. `/api/io.bithead.wordy/guess`
+        self.routes: Dict[Callable, str] = {}
+        # Bundle IDs of mounted apps. Read on the first request, once every
+        # route is added.
+        self.bundles: Optional[Set[str]] = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith("/api"):
+            await self.app(scope, receive, send)
+            return
+
+        metrics = RequestMetrics()
+        token = CURRENT_REQUEST.set(metrics)
+        status = 500
+        start = time.perf_counter()
+
+        async def send_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            CURRENT_REQUEST.reset(token)
+            if self.bundles is None:
+                self.bundles = mounted_bundles(scope.get("app"))
+            key = (bundle_for_path(scope["path"], self.bundles), self._route(scope), scope["method"])
+            REQUESTS[key + (status,)] = REQUESTS.get(key + (status,), 0) + 1
+            _observe(LATENCY, key, elapsed)
+            if metrics.auth:
+                _observe(AUTH_LATENCY, key, metrics.auth)
+            _observe(HANDLER_LATENCY, key, elapsed - metrics.auth)
+            if SQL_ENABLED:
+                _observe(QUERIES_PER_REQUEST, key, metrics.queries, QUERY_BUCKETS)
+                _observe(SQL_PER_REQUEST, key, metrics.sql)
+
+    def _route(self, scope) -> str:
+        # Set by the router once a route matches
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return UNMATCHED
+        path = self.routes.get(endpoint)
+        if path is None:
+            # Routes are added after the middleware is, so look them up late
+            app = scope.get("app")
+            routes = getattr(app, "routes", [])
+            self.routes = {route.endpoint: route.path for route in routes if hasattr(route, "endpoint")}
+            path = self.routes.setdefault(endpoint, getattr(endpoint, "__name__", UNMATCHED))
+        return path
+
+# Prometheus text format
+
+def _labels(**labels) -> str:
+    pairs = []
+    for name, value in labels.items():
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+def _histogram(lines: List[str], name: str, help: str, metrics: Dict[Tuple, Histogram], label_names=("bundle", "route", "method")):
+    lines.append(f"# HELP {name} {help}")
+    lines.append(f"# TYPE {name} histogram")
+    for key, histogram in sorted(metrics.items()):
+        names = dict(zip(label_names, key))
+        cumulative = 0
+        for bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append(f"{name}_bucket{_labels(**names, le=le)} {cumulative}")
+        labels = _labels(**names)
+        lines.append(f"{name}_sum{labels} {histogram.sum}")
+        lines.append(f"{name}_count{labels} {histogram.count}")
+
+def _snake(name: str) -> str:
+    return "".join(f"_{c.lower()}" if c.isupper() else c for c in name)
+
+def _gauges(lines: List[str], prefix: str, model: BaseModel):
+    for field, value in model:
+        name = f"{prefix}_{_snake(field)}"
+        if isinstance(value, BaseModel):
+            _gauges(lines, name, value)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+
+# Hosts a scrape may come from directly. A request proxied by nginx comes
+# from 127.0.0.1 too, but carries the client's address in `X-Forwarded-For`.
+LOCAL_HOSTS = ("127.0.0.1", "::1", "localhost")
+
+def is_scrape_allowed(request) -> bool:
+    """ Returns `True` if `request` may read `/api/metrics`.
+
+    With the `metrics_token` option, the request must have it as its bearer
+    token. Without it, the request must come from this host, not through a
+    proxy.
+    """
+    token = get_option("metrics_token", None)
+    if token:
+        expected = f"Bearer {token}"
+        return hmac.compare_digest(request.headers.get("authorization", "").encode(), expected.encode())
+    if "x-forwarded-for" in request.headers or "x-real-ip" in request.headers:
+        return False
+    return request.client is not None and request.client.host in LOCAL_HOSTS
+
+def render() -> str:
+    """ Everything recorded, in Prometheus text format. """
+    lines = []
+    lines.append("# HELP boss_http_requests_total Requests handled, by response status")
+    lines.append("# TYPE boss_http_requests_total counter")
+    for (bundle, route, method, status), count in sorted(REQUESTS.items()):
+        lines.append(f"boss_http_requests_total{_labels(bundle=bundle, route=route, method=method, status=status)} {count}")
+
+    _histogram(lines, "boss_http_request_duration_seconds", "Time to handle a request", LATENCY)
+    _histogram(lines, "boss_http_auth_duration_seconds", "Time spent authenticating the caller with BOSS", AUTH_LATENCY)
+    _histogram(lines, "boss_http_handler_duration_seconds", "Time to handle a request, less authentication", HANDLER_LATENCY)
+    _histogram(lines, "boss_http_queries_per_request", "SQL statements run by a request", QUERIES_PER_REQUEST)
+    _histogram(lines, "boss_http_sql_duration_seconds", "Time a request spent running SQL", SQL_PER_REQUEST)
+    with STATEMENT_LOCK:
+        statements = {key: histogram for key, histogram in STATEMENT_LATENCY.items()}
+        rows = dict(STATEMENT_ROWS)
+    _histogram(lines, "boss_sql_statement_duration_seconds", "Time to run a SQL statement", statements, ("bundle", "statement"))
+    lines.append("# HELP boss_sql_statement_rows_total Rows returned or changed by a SQL statement")
+    lines.append("# TYPE boss_sql_statement_rows_total counter")
+    for (bundle, query), count in sorted(rows.items()):
+        lines.append(f"boss_sql_statement_rows_total{_labels(bundle=bundle, statement=query)} {count}")
+
+    name = "boss_http_request_duration_estimate_seconds"
+    lines.append(f"# HELP {name} Request duration percentiles, estimated from the histogram buckets")
+    lines.append(f"# TYPE {name} gauge")
+    for (bundle, route, method), histogram in sorted(LATENCY.items()):
+        for q in QUANTILES:
+            lines.append(f"{name}{_labels(bundle=bundle, route=route, method=method, quantile=q)} {histogram.quantile(q)}")
+
+    _histogram(lines, "boss_admission_wait_seconds", "Time a request waited to be admitted", ADMISSION_WAIT, ("bundle", "class"))
+    lines.append("# HELP boss_admission_shed_total Requests refused because too many were waiting")
+    lines.append("# TYPE boss_admission_shed_total counter")
+    for (bundle, klass), count in sorted(ADMISSION_SHED.items()):
+        lines.append(f"boss_admission_shed_total{_labels(bundle=bundle, **{'class': klass})} {count}")
+
+    lines.append("# HELP boss_app_boot_seconds Time an app took to import, start, or register its routes")
+    lines.append("# TYPE boss_app_boot_seconds gauge")
+    for (bundle, phase), seconds in sorted(BOOT_SECONDS.items()):
+        lines.append(f"boss_app_boot_seconds{_labels(bundle=bundle, phase=phase)} {seconds}")
+
+    for collector, collect in sorted(COLLECTORS.items()):
+        _gauges(lines, f"boss_{collector}", collect())
+    return "\n".join(lines) + "\n"
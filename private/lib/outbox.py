@@ -0,0 +1,209 @@
+#
+# Outbox for fire-and-forget calls to the Swift backend
+#
+# A route that announces something (an event, a notification) should not make
+# its caller wait while the backend hears about it. The route puts the message
+# here and returns; a background task sends everything that arrived within a
+# short window as one request.
+#
+
+import asyncio
+import httpx
+import logging
+import time
+
+from collections import deque
+from pydantic import BaseModel
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+class OutboxStats(BaseModel):
+    # Messages waiting to be sent
+    depth: int
+    maxDepth: int
+    enqueued: int
+    sent: int
+    # Messages thrown away because the outbox was full
+    dropped: int
+    # Messages given up on after their retries ran out, or that the backend
+    # refused outright
+    failed: int
+    # Requests made to the backend. `sent / batches` is how well the outbox
+    # is coalescing.
+    batches: int
+    retries: int
+    # Time from a batch's oldest message being enqueued to the batch being
+    # delivered, in milliseconds
+    lastFlushMs: float
+    maxFlushMs: float
+
+# Sends a batch. Called with the batch's kind, the headers it was enqueued
+# with, and its items in the order they were enqueued.
+Deliver = Callable[[str, Dict[str, str], List[Any]], Awaitable[None]]
+
+class Outbox:
+    """ Bounded queue of messages, sent in batches by a background task.
+
+    Messages are batched by `(kind, headers)`, so a batch is only ever sent
+    with the credentials its messages were enqueued with.
+
+    The task starts on the first `put` and is bound to the event loop it was
+    started on. `close` sends whatever is left and stops it.
+
+    @param deliver: Sends one batch. Raising `httpx.RequestError` or an
+        `httpx.HTTPStatusError` for a 5xx or 429 retries the batch; anything else
+        fails it.
+    @param max_size: Most messages waiting at once
+    @param window: Seconds to wait after the first message, for others to join
+        its batch
+    @param retries: Times a batch is retried before it is given up on
+    @param backoff: Seconds before the first retry. Doubles on each retry.
+    @param overflow: What to drop when full. `oldest` keeps the most recent
+        state flowing to clients; `newest` keeps what was promised first.
+    """
+
+    def __init__(
+        self,
+        deliver: Deliver,
+        max_size: int=10000,
+        window: float=0.05,
+        retries: int=3,
+        backoff: float=0.2,
+        overflow: str="oldest"
+    ):
+        if overflow not in ("oldest", "newest"):
+            raise ValueError(f"Outbox overflow must be (oldest) or (newest), not ({overflow})")
+        self.deliver = deliver
+        self.max_size = max_size
+        self.window = window
+        self.retries = retries
+        self.backoff = backoff
+        self.overflow = overflow
+
+        # (kind, headers, item, enqueued at)
+        self.pending: deque[Tuple[str, Dict[str, str], Any, float]] = deque()
+        self.task: Optional[asyncio.Task] = None
+        self.wakeup: Optional[asyncio.Event] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        # The flush the task is in the middle of, if any
+        self.flushing: Optional[asyncio.Future] = None
+
+        self.max_depth = 0
+        self.enqueued = 0
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+        self.batches = 0
+        self.retried = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+
+    def put(self, kind: str, headers: Dict[str, str], item: Any) -> bool:
+        """ Enqueue `item` to be sent. Returns `False` if it was dropped.
+
+        Must be called from the event loop.
+        """
+        if len(self.pending) >= self.max_size:
+            self.dropped += 1
+            if self.overflow == "newest":
+                logging.warning(f"Outbox is full ({self.max_size}). Dropping ({kind}).")
+                return False
+            dropped = self.pending.popleft()
+            logging.warning(f"Outbox is full ({self.max_size}). Dropping oldest ({dropped[0]}).")
+        self.pending.append((kind, headers, item, time.monotonic()))
+        self.enqueued += 1
+        self.max_depth = max(self.max_depth, len(self.pending))
+        self._start()
+        self.wakeup.set()
+        return True
+
+    def _start(self):
+        loop = asyncio.get_running_loop()
+        if self.task is not None and not self.task.done() and self.loop is loop:
+            return
+        self.loop = loop
+        self.wakeup = asyncio.Event()
+        self.task = loop.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await self.wakeup.wait()
+            await asyncio.sleep(self.window)
+            self.wakeup.clear()
+            # Shielded, so `close` cannot cancel a batch half-sent
+            self.flushing = asyncio.ensure_future(self.flush())
+            try:
+                await asyncio.shield(self.flushing)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # `flush` handles delivery errors. This is a bug, and must not
+                # stop every later message from being sent.
+                logging.exception("Outbox failed to flush")
+
+    async def flush(self):
+        """ Send everything enqueued so far. """
+        batches: Dict[Hashable, Tuple[str, Dict[str, str], List[Any], float]] = {}
+        while self.pending:
+            kind, headers, item, enqueued_at = self.pending.popleft()
+            key = (kind, tuple(sorted(headers.items())))
+            if key not in batches:
+                batches[key] = (kind, headers, [], enqueued_at)
+            batches[key][2].append(item)
+        if batches:
+            await asyncio.gather(*[self._send(*batch) for batch in batches.values()])
+
+    async def _send(self, kind: str, headers: Dict[str, str], items: List[Any], enqueued_at: float):
+        attempt = 0
+        while True:
+            self.batches += 1
+            try:
+                await self.deliver(kind, headers, items)
+                break
+            except Exception as error:
+                if not _is_transient(error) or attempt >= self.retries:
+                    self.failed += len(items)
+                    logging.warning(f"Outbox failed to send ({len(items)}) ({kind}) after ({attempt + 1}) attempts: {error}")
+                    return
+                await asyncio.sleep(self.backoff * (2 ** attempt))
+                attempt += 1
+                self.retried += 1
+        self.sent += len(items)
+        self.last_flush_ms = (time.monotonic() - enqueued_at) * 1000
+        self.max_flush_ms = max(self.max_flush_ms, self.last_flush_ms)
+
+    async def close(self):
+        """ Send what is left, then stop the background task. """
+        # A task started on another loop died with it
+        if self.task is not None and self.task.get_loop() is asyncio.get_running_loop():
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            if self.flushing is not None:
+                await self.flushing
+        self.task = None
+        self.flushing = None
+        await self.flush()
+
+    def stats(self) -> OutboxStats:
+        return OutboxStats(
+            depth=len(self.pending),
+            maxDepth=self.max_depth,
+            enqueued=self.enqueued,
+            sent=self.sent,
+            dropped=self.dropped,
+            failed=self.failed,
+            batches=self.batches,
+            retries=self.retried,
+            lastFlushMs=self.last_flush_ms,
+            maxFlushMs=self.max_flush_ms
+        )
+
+def _is_transient(error: Exception) -> bool:
+    """ Returns `True` if sending again might work. """
+    if isinstance(error, httpx.RequestError):
+        return True
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500 or error.response.status_code == 429
+    return False
@@ -0,0 +1,86 @@
+#
+# Fast JSON responses for large payloads
+#
+# A route with a `response_model` that returns models pays for them three
+# times: FastAPI dumps each model to a dict, validates the dicts against the
+# `response_model` again, walks the result with `jsonable_encoder`, and only
+# then encodes it with `json`. For a job with thousands of work units, that is
+# most of the time the request takes.
+#
+# A route whose models are already valid can skip all of it:
+#
+# ```
+# @router.get("/job/{job_id}/work-units", response_model=List[WorkUnitSummary])
+# @require_admin()
+# @fast_json
+# async def get_work_units(...):
+#     return lib.list_work_units(...)
+# ```
+#
+# `response_model` still documents the route. What the route returns is
+# serialized once, as is, and is not checked against it. Return exactly the
+# models it names: extra fields of a subclass are not filtered out.
+#
+# Models are serialized straight to bytes by pydantic's compiled serializer.
+# Anything else is encoded with `orjson` if it is installed, else `json`.
+#
+
+import functools
+import inspect
+import json
+import pydantic_core
+
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+from starlette.responses import Response
+from typing import Any, Callable
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def _default(value: Any) -> Any:
+    """ Encodes what the JSON encoder does not know, e.g. a model in a dict. """
+    if isinstance(value, BaseModel):
+        return value.model_dump(mode="json")
+    return pydantic_core.to_jsonable_python(value)
+
+def dumps(content: Any) -> bytes:
+    """ Serialize `content` to compact JSON. """
+    if isinstance(content, BaseModel) or (
+        isinstance(content, (list, tuple)) and content and isinstance(content[0], BaseModel)
+    ):
+        return pydantic_core.to_json(content)
+    if orjson is not None:
+        return orjson.dumps(content, default=_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, default=_default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+class FastJSONResponse(JSONResponse):
+    """ A `JSONResponse` serialized with `dumps`. """
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+def fast_json(func: Callable) -> Callable:
+    """ Return what `func` returns as a `FastJSONResponse`.
+
+    A `Response` is returned as is, so a route may still return its own.
+    Keeps a sync `func` sync, so FastAPI still runs it on a thread.
+    """
+    def respond(content: Any) -> Any:
+        if isinstance(content, Response):
+            return content
+        return FastJSONResponse(content)
+
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            return respond(await func(*args, **kwargs))
+    else:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return respond(func(*args, **kwargs))
+    # FastAPI resolves string annotations in the wrapper's module, not `func`'s
+    wrapper.__signature__ = inspect.signature(func, eval_str=True)
+    return wrapper
@@ -1,9 +1,14 @@
+import asyncio
 import httpx
 import logging
 import os
+import time
 
-from lib import get_config
+from lib import get_config, get_option
+from lib import metrics
+from lib.cache import Cache, CacheStats, MISSING, SingleFlight, SingleFlightStats
 from lib.model import *
+from lib.outbox import Outbox, OutboxStats
 from fastapi import Depends, HTTPException, Request
 from functools import wraps, update_wrapper
 from inspect import Signature, signature, Parameter
@@ -17,6 +22,173 @@ VERIFY_ENDPOINT = "http://127.0.0.1:8081/private/acl/verify"
 SEND_NOTIFICATIONS_ENDPOINT = "http://127.0.0.1:8081/private/send/notifications"
 SEND_EVENTS_ENDPOINT = "http://127.0.0.1:8081/private/send/events"
 
+# BOSS's super user (`Global.superUserId`). The only user the backend lists
+# every other user to.
+SUPER_USER_ID = 1
+
+# Every call to the Swift backend goes through one pooled client, created and
+# closed by `api.py`'s lifespan. A client per call pays for a new TCP
+# connection on every request, and an operator tap makes two or three of them.
+BACKEND_CLIENT: Optional[httpx.AsyncClient] = None
+# The event loop the client was created on. Its connections belong to that loop.
+BACKEND_CLIENT_LOOP = None
+# Replaces the network when set. See `open_backend_client`.
+BACKEND_TRANSPORT: Optional[httpx.AsyncBaseTransport] = None
+
+class BackendClientStats(BaseModel):
+    # Requests sent to the backend
+    requests: int = 0
+    # Requests waiting on a response right now
+    inFlight: int = 0
+    # The most requests that have been in flight at once. If this reaches
+    # `maxConnections` requests are queueing for a connection.
+    maxInFlight: int = 0
+    # Requests that failed before a response arrived (refused, timed out)
+    errors: int = 0
+    # Number of times the client has been created. More than one means the
+    # client is being recreated, which defeats the pool.
+    clientsCreated: int = 0
+    # Clients dropped because they were opened on another event loop. Only a
+    # script or test that runs more than one loop should see this go up.
+    clientsDiscarded: int = 0
+    maxConnections: int = 0
+    maxKeepalive: int = 0
+
+BACKEND_CLIENT_STATS = BackendClientStats()
+
+# Users resolved from a session cookie, keyed by `(cookie, bundle_id, feature)`.
+# `require_user`, `require_admin` and `require_acl` each ask the backend who
+# is signed in, and a dashboard asks several times a second with the same
+# cookie. Created on first use, from `session_cache_size` and
+# `session_cache_ttl` (seconds).
+#
+# The TTL bounds how long a signed-out or demoted user keeps access through
+# this process, so keep it short. Call `invalidate_session` or
+# `invalidate_user` when a change must take effect immediately.
+SESSIONS: Optional[Cache] = None
+
+# Cookies the backend rejected (401), with the reason. A client that has lost
+# its session usually retries in a burst, and each retry would otherwise be a
+# round trip to learn the same thing. TTL is `session_denied_ttl` (seconds).
+DENIED_SESSIONS: Optional[Cache] = None
+
+# Identical lookups in flight at the same time. A dashboard fans out several
+# requests at once, each authenticating with the same cookie; they share one
+# call to the backend instead of sending a burst of the same request.
+LOOKUPS = SingleFlight()
+
+# Events and notifications waiting to be sent. Created on first use, from
+# the `outbox_*` options. See `queue_events`.
+OUTBOX: Optional[Outbox] = None
+
+class UserDirectoryStats(BaseModel):
+    size: int
+    refreshes: int
+    failures: int
+    # Seconds since the directory was last refreshed. `None` until it is loaded.
+    ageSeconds: Optional[float]
+
+class UserDirectory:
+    """ Every BOSS user, by id, shared by all apps.
+
+    Naming people (a dashboard, an export) needs every user, and asking the
+    backend for all of them on every poll is a large response for a map that
+    rarely changes. The directory is loaded once, and then served as is:
+
+    - Younger than `refresh_interval`, it is fresh.
+    - Older, it is returned as is while one refresh runs in the background,
+      with the credentials of the request that noticed.
+    - Older than `max_stale`, the caller waits for the refresh. If that fails,
+      it still gets what is known, and the failure is logged.
+
+    The backend lists everyone only to the super user; anyone else is given
+    themselves. A listing from the super user replaces the directory, and makes
+    it fresh; any other is merged into it, and leaves its age as it was. Because the directory is shared, resolve names only for
+    callers allowed to see them.
+
+    Callers share the `User` records. Treat them as read-only.
+    """
+
+    def __init__(self, refresh_interval: float, max_stale: float):
+        self.refresh_interval = refresh_interval
+        self.max_stale = max_stale
+        self.users: Dict[int, User] = {}
+        self.refreshed_at: Optional[float] = None
+        self.refreshing: Optional[asyncio.Task] = None
+        self.refreshes = 0
+        self.failures = 0
+
+    def age(self) -> Optional[float]:
+        if self.refreshed_at is None:
+            return None
+        return time.monotonic() - self.refreshed_at
+
+    async def get(self, request: Request) -> Dict[int, User]:
+        age = self.age()
+        if age is None or age > self.max_stale:
+            try:
+                await self.refresh(request)
+            except Exception as error:
+                if not self.users:
+                    raise error
+                age = "never loaded" if age is None else f"({age:.0f}) seconds old"
+                logging.warning(f"User directory is {age} and could not be refreshed: {error}")
+        elif age > self.refresh_interval:
+            self._refresh_in_background(get_headers(request))
+        return self.users
+
+    async def refresh(self, request: Request):
+        """ Load every user the request's caller can see, now. """
+        await self._refresh(get_headers(request))
+
+    async def _refresh(self, headers: Dict[str, str]):
+        try:
+            users = await LOOKUPS.do(("user_details", headers["Cookie"]), lambda: _get_user_details(headers))
+        except Exception:
+            self.failures += 1
+            raise
+        self.refreshes += 1
+        if len(users) != 1 or users[0].id == SUPER_USER_ID:
+            self.users = {user.id: user for user in users}
+            # Only a listing of everyone makes the directory fresh
+            self.refreshed_at = time.monotonic()
+        else:
+            # Swapped, not mutated, so a caller holding the old map is not
+            # changed under it
+            self.users = {**self.users, users[0].id: users[0]}
+
+    def _refresh_in_background(self, headers: Dict[str, str]):
+        task = self.refreshing
+        if task is not None and not task.done() and task.get_loop() is asyncio.get_running_loop():
+            return
+        self.refreshing = asyncio.ensure_future(self._refresh_quietly(headers))
+
+    async def _refresh_quietly(self, headers: Dict[str, str]):
+        try:
+            await self._refresh(headers)
+        except Exception as error:
+            logging.warning(f"Failed to refresh user directory: {error}")
+
+    def clear(self):
+        self.users = {}
+        self.refreshed_at = None
+
+    def stats(self) -> UserDirectoryStats:
+        return UserDirectoryStats(
+            size=len(self.users),
+            refreshes=self.refreshes,
+            failures=self.failures,
+            ageSeconds=self.age()
+        )
+
+# Created on first use, from `user_directory_refresh` and
+# `user_directory_max_stale` (seconds).
+USER_DIRECTORY: Optional[UserDirectory] = None
+
+class SessionCacheStats(BaseModel):
+    sessions: CacheStats
+    denied: CacheStats
+
 # Models
 
 class ACLApp(BaseModel):
@@ -55,6 +227,110 @@ class NotificationEvent(BaseModel):
 class SendEvents(BaseModel):
     events: List[NotificationEvent]
 
+# Backend client
+
+def open_backend_client(transport: Optional[httpx.AsyncBaseTransport]=None) -> httpx.AsyncClient:
+    """ Create the pooled client used for every call to the Swift backend.
+
+    Pool limits, keep-alive and timeouts are read from the BOSS config:
+    `backend_max_connections`, `backend_max_keepalive`,
+    `backend_keepalive_expiry` (seconds) and `backend_timeout` (seconds).
+
+    @param transport - replaces the network. Used to point the client at an
+    in-process stand-in for the backend. It is kept for every client created
+    after this one.
+    """
+    global BACKEND_CLIENT, BACKEND_CLIENT_LOOP, BACKEND_TRANSPORT
+    if transport is not None:
+        BACKEND_TRANSPORT = transport
+    if BACKEND_CLIENT is not None:
+        return BACKEND_CLIENT
+    max_connections = int(get_option("backend_max_connections", 100))
+    max_keepalive = int(get_option("backend_max_keepalive", 20))
+    limits = httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=max_keepalive,
+        keepalive_expiry=float(get_option("backend_keepalive_expiry", 30))
+    )
+    timeout = httpx.Timeout(float(get_option("backend_timeout", 10)))
+    BACKEND_CLIENT = httpx.AsyncClient(
+        limits=limits,
+        timeout=timeout,
+        transport=BACKEND_TRANSPORT
+    )
+    BACKEND_CLIENT_LOOP = _running_loop()
+    BACKEND_CLIENT_STATS.clientsCreated += 1
+    BACKEND_CLIENT_STATS.maxConnections = max_connections
+    BACKEND_CLIENT_STATS.maxKeepalive = max_keepalive
+    return BACKEND_CLIENT
+
+async def close_backend_client():
+    """ Close the pooled client and every connection it holds. """
+    global BACKEND_CLIENT
+    if BACKEND_CLIENT is None:
+        return
+    client = BACKEND_CLIENT
+    BACKEND_CLIENT = None
+    await client.aclose()
+
+def _running_loop():
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+def _discard_backend_client():
+    """ Drop the client opened on another event loop.
+
+    Its connections can only be closed on that loop. If it is still running,
+    the client is closed there. If it has stopped, there is nothing left to
+    close them with, and they are dropped with the client.
+    """
+    global BACKEND_CLIENT
+    client, loop = BACKEND_CLIENT, BACKEND_CLIENT_LOOP
+    BACKEND_CLIENT = None
+    BACKEND_CLIENT_STATS.clientsDiscarded += 1
+    if loop.is_running() and not loop.is_closed():
+        logging.warning("Closing the backend client of another event loop")
+        asyncio.run_coroutine_threadsafe(client.aclose(), loop)
+    else:
+        logging.info("Discarding the backend client of a stopped event loop")
+
+def get_backend_client() -> httpx.AsyncClient:
+    """ Returns the pooled client to the Swift backend.
+
+    `api.py` opens the client when it starts. A script or test that never ran
+    the lifespan gets one created on first use.
+
+    Pooled connections belong to the event loop that opened them. A test that
+    calls `asyncio.run` more than once gets a fresh client per loop rather
+    than one whose connections point at a loop that has closed. The old
+    client is discarded (see `_discard_backend_client`).
+    """
+    if BACKEND_CLIENT is not None and BACKEND_CLIENT_LOOP is not None and BACKEND_CLIENT_LOOP is not _running_loop():
+        _discard_backend_client()
+    if BACKEND_CLIENT is None:
+        return open_backend_client()
+    return BACKEND_CLIENT
+
+async def backend_request(method: str, url: str, **kwargs) -> httpx.Response:
+    """ Send a request to the backend over the pooled client. """
+    stats = BACKEND_CLIENT_STATS
+    stats.requests += 1
+    stats.inFlight += 1
+    if stats.inFlight > stats.maxInFlight:
+        stats.maxInFlight = stats.inFlight
+    try:
+        return await get_backend_client().request(method, url, **kwargs)
+    except httpx.RequestError:
+        stats.errors += 1
+        raise
+    finally:
+        stats.inFlight -= 1
+
+def get_backend_client_stats() -> BackendClientStats:
+    return BACKEND_CLIENT_STATS.model_copy()
+
 # Functions
 
 async def _authenticate_admin(request: Request) -> User:
@@ -69,9 +345,12 @@ async def _authenticate_admin(request: Request) -> User:
     # `None`, and every admin route silently loses the identity of its caller.
     return user
 
-async def get_user_with_client(client, headers) -> User:
+async def get_user_with_headers(headers) -> User:
+    return await LOOKUPS.do(("user", headers["Cookie"]), lambda: _get_user_with_headers(headers))
+
+async def _get_user_with_headers(headers) -> User:
     try:
-        response = await client.get(USER_ENDPOINT, headers=headers)
+        response = await backend_request("GET", USER_ENDPOINT, headers=headers)
         response.raise_for_status()
     except httpx.HTTPStatusError as e:
         raise HTTPException(status_code=e.response.status_code, detail=e.response.text)
@@ -93,27 +372,29 @@ def get_headers(request: Request) -> Dict[str, str]:
 async def get_user(request: Request) -> User:
     """ Get signed in user. """
     headers = get_headers(request)
-    async with httpx.AsyncClient() as client:
-        return await get_user_with_client(client, headers)
+    return await get_user_with_headers(headers)
 
 async def verify_user(request: Request, bundle_id: str, feature: Optional[str]) -> User:
     """ Get signed in user and compare ACL. """
     headers = get_headers(request)
-    async with httpx.AsyncClient() as client:
-        try:
-            body = VerifyACL(catalog="python", bundleId=bundle_id, feature=feature)
-            response = await client.post(VERIFY_ENDPOINT, body=body, headers=headers)
-            response.raise_for_status()
-        except httpx.HTTPStatusError as e:
-            raise HTTPException(status_code=e.response.status_code, detail=e.response.text)
-        except httpx.RequestError as e:
-            raise HTTPException(status_code=500, detail=str(e))
-
-        body = response.json()
-        user = body.get("user", None)
-        if user is None:
-            raise HTTPException(status_code=401, detail="Please sign in before accessing this resource")
-        return make_user(user)
+    key = ("verify", headers["Cookie"], bundle_id, feature)
+    return await LOOKUPS.do(key, lambda: _verify_user(headers, bundle_id, feature))
+
+async def _verify_user(headers, bundle_id: str, feature: Optional[str]) -> User:
+    try:
+        body = VerifyACL(catalog="python", bundleId=bundle_id, feature=feature)
+        response = await backend_request("POST", VERIFY_ENDPOINT, json=body.model_dump(), headers=headers)
+        response.raise_for_status()
+    except httpx.HTTPStatusError as e:
+        raise HTTPException(status_code=e.response.status_code, detail=e.response.text)
+    except httpx.RequestError as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    body = response.json()
+    user = body.get("user", None)
+    if user is None:
+        raise HTTPException(status_code=401, detail="Please sign in before accessing this resource")
+    return make_user(user)
 
 async def get_friends(request: Request) -> (User, List[Friend]):
     """ Get user's friends.
@@ -121,18 +402,21 @@ async def get_friends(request: Request) -> (User, List[Friend]):
     This also authenticates the user.
     """
     headers = get_headers(request)
-    async with httpx.AsyncClient() as client:
-        user = await get_user_with_client(client, headers)
-        try:
-            response = await client.get(FRIENDS_ENDPOINT, headers=headers)
-            response.raise_for_status()
-        except httpx.HTTPStatusError as e:
-            raise HTTPException(status_code=e.response.status_code, detail=e.response.text)
-        except httpx.RequestError as e:
-            raise HTTPException(status_code=500, detail=str(e))
+    user = await get_user_with_headers(headers)
+    friends = await LOOKUPS.do(("friends", headers["Cookie"]), lambda: _get_friends(headers))
+    return (user, friends)
+
+async def _get_friends(headers) -> List[Friend]:
+    try:
+        response = await backend_request("GET", FRIENDS_ENDPOINT, headers=headers)
+        response.raise_for_status()
+    except httpx.HTTPStatusError as e:
+        raise HTTPException(status_code=e.response.status_code, detail=e.response.text)
+    except httpx.RequestError as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
-        body = response.json()
-    return (user, [make_friend(friend) for friend in body.get("friends", [])])
+    body = response.json()
+    return [make_friend(friend) for friend in body.get("friends", [])]
 
 async def get_user_details(request: Request) -> List[User]:
     """ Returns all users in BOSS system, as whole records.
@@ -142,12 +426,38 @@ async def get_user_details(request: Request) -> List[User]:
     instead.
     """
     headers = get_headers(request)
-    async with httpx.AsyncClient() as client:
-        response = await client.get(USER_DETAILS_ENDPOINT, headers=headers)
-        response.raise_for_status()
-        body = response.json()
+    return await LOOKUPS.do(("user_details", headers["Cookie"]), lambda: _get_user_details(headers))
+
+async def _get_user_details(headers) -> List[User]:
+    response = await backend_request("GET", USER_DETAILS_ENDPOINT, headers=headers)
+    response.raise_for_status()
+    body = response.json()
     return [make_user(user) for user in body.get("users", [])]
 
+def _make_notifications(
+    user_ids: List[int],
+    deep_link: Optional[str],
+    title: Optional[str],
+    body: Optional[str],
+    metadata: Optional[dict[str, str]],
+    persist: bool
+) -> List[Notification]:
+    return [
+        Notification(
+            controller=None,
+            deepLink=deep_link,
+            title=title,
+            body=body,
+            metadata=metadata,
+            userId=user_id,
+            persist=persist
+        )
+        for user_id in user_ids
+    ]
+
+def _make_events(name: str, data: dict[str, str], user_ids: List[int]) -> List[NotificationEvent]:
+    return [NotificationEvent(name=name, userId=user_id, data=data) for user_id in user_ids]
+
 async def send_notifications(
     request: Request,
     user_ids: List[int],
@@ -157,65 +467,206 @@ async def send_notifications(
     metadata: Optional[dict[str, str]]=None,
     persist: bool=False
 ):
-    """ Send (the same) notification to users. """
-    headers = get_headers(request)
+    """ Send (the same) notification to users.
 
-    notifs = []
-    for user_id in user_ids:
-        notif = Notification(
-            controller=None,
-            deepLink=deep_link,
-            title=title,
-            body=body,
-            metadata=metadata,
-            userId=user_id,
-            persist=False
-        )
-        notifs.append(notif)
-    payload = SendNotifications(notifications=notifs)
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            SEND_NOTIFICATIONS_ENDPOINT,
-            json=payload.model_dump(),
-            headers=headers
-        )
-        response.raise_for_status()
+    Waits for the backend. A route should `queue_notifications` instead.
+    """
+    notifs = _make_notifications(user_ids, deep_link, title, body, metadata, persist)
+    await _deliver("notifications", get_headers(request), notifs)
 
 async def send_events(request: Request, name: str, data: dict[str, str], user_ids: List[int]):
-    """ Send (the same) notification to users. """
+    """ Send (the same) event to users.
+
+    Waits for the backend. A route should `queue_events` instead.
+    """
+    await _deliver("events", get_headers(request), _make_events(name, data, user_ids))
+
+async def _deliver(kind: str, headers: Dict[str, str], items: List[Any]):
+    """ Send a batch of events or notifications in one request. """
+    if kind == "events":
+        url = SEND_EVENTS_ENDPOINT
+        payload = SendEvents(events=items)
+    else:
+        url = SEND_NOTIFICATIONS_ENDPOINT
+        payload = SendNotifications(notifications=items)
+    response = await backend_request("POST", url, json=payload.model_dump(), headers=headers)
+    response.raise_for_status()
+
+# Outbox
+
+def _outbox() -> Outbox:
+    global OUTBOX
+    if OUTBOX is None:
+        OUTBOX = Outbox(
+            _deliver,
+            max_size=int(get_option("outbox_size", 10000)),
+            window=float(get_option("outbox_window_ms", 50)) / 1000,
+            retries=int(get_option("outbox_retries", 3)),
+            backoff=float(get_option("outbox_backoff_ms", 200)) / 1000,
+            overflow=get_option("outbox_overflow", "oldest")
+        )
+    return OUTBOX
+
+def queue_notifications(
+    request: Request,
+    user_ids: List[int],
+    deep_link: Optional[str]=None,
+    title: Optional[str]=None,
+    body: Optional[str]=None,
+    metadata: Optional[dict[str, str]]=None,
+    persist: bool=False
+) -> bool:
+    """ Send (the same) notification to users, without waiting for it.
+
+    Returns `False` if the outbox was full and the notifications were dropped.
+    """
     headers = get_headers(request)
-    events = []
-    for user_id in user_ids:
-        event = NotificationEvent(
-            name=name,
-            userId=user_id,
-            data=data
+    notifs = _make_notifications(user_ids, deep_link, title, body, metadata, persist)
+    return all([_outbox().put("notifications", headers, notif) for notif in notifs])
+
+def queue_events(request: Request, name: str, data: dict[str, str], user_ids: List[int]) -> bool:
+    """ Send (the same) event to users, without waiting for it.
+
+    Returns `False` if the outbox was full and the events were dropped.
+    """
+    headers = get_headers(request)
+    return all([_outbox().put("events", headers, event) for event in _make_events(name, data, user_ids)])
+
+async def flush_outbox():
+    """ Send everything queued so far, and wait for it. """
+    await _outbox().flush()
+
+async def close_outbox():
+    """ Send everything queued so far and stop sending. Called at shutdown. """
+    if OUTBOX is not None:
+        await OUTBOX.close()
+
+def get_outbox_stats() -> OutboxStats:
+    return _outbox().stats()
+
+# User directory
+
+def _user_directory() -> UserDirectory:
+    global USER_DIRECTORY
+    if USER_DIRECTORY is None:
+        USER_DIRECTORY = UserDirectory(
+            refresh_interval=float(get_option("user_directory_refresh", 60)),
+            max_stale=float(get_option("user_directory_max_stale", 3600))
         )
-        events.append(event)
-    payload = SendEvents(events=events)
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            SEND_EVENTS_ENDPOINT,
-            json=payload.model_dump(),
-            headers=headers
+    return USER_DIRECTORY
+
+async def get_user_directory(request: Request) -> Dict[int, User]:
+    """ Every user the directory knows, by id. See `UserDirectory`. """
+    return await _user_directory().get(request)
+
+async def resolve_names(request: Request) -> Dict[int, str]:
+    """ User id to full name, for every user the directory knows. """
+    return {user_id: user.fullName for user_id, user in (await get_user_directory(request)).items()}
+
+async def refresh_user_directory(request: Request):
+    """ Reload the directory now, e.g. after a user was added or renamed. """
+    await _user_directory().refresh(request)
+
+def clear_user_directory():
+    _user_directory().clear()
+
+def get_user_directory_stats() -> UserDirectoryStats:
+    return _user_directory().stats()
+
+# Session cache
+
+def _sessions() -> Cache:
+    global SESSIONS
+    if SESSIONS is None:
+        SESSIONS = Cache(
+            maxsize=int(get_option("session_cache_size", 4096)),
+            ttl=float(get_option("session_cache_ttl", 30))
         )
-        response.raise_for_status()
+    return SESSIONS
+
+def _denied_sessions() -> Cache:
+    global DENIED_SESSIONS
+    if DENIED_SESSIONS is None:
+        DENIED_SESSIONS = Cache(
+            maxsize=int(get_option("session_cache_size", 4096)),
+            ttl=float(get_option("session_denied_ttl", 5))
+        )
+    return DENIED_SESSIONS
+
+def _session_key(request: Request, bundle_id: Optional[str], feature: Optional[str]) -> Optional[tuple]:
+    """ Cache key for a request's session, or `None` if it has no cookies.
+
+    The key is every cookie the backend is sent, because that is what it
+    decides on.
+    """
+    cookie = get_headers(request)["Cookie"]
+    if not cookie:
+        return None
+    return (cookie, bundle_id, feature)
+
+def invalidate_session(request: Request):
+    """ Forget everything cached about the request's session. """
+    cookie = get_headers(request)["Cookie"]
+    for cache in (_sessions(), _denied_sessions()):
+        for key in [key for key in cache.keys() if key[0] == cookie]:
+            cache.pop(key, None)
+
+def invalidate_user(user_id: int):
+    """ Forget every cached session that resolved to `user_id`.
+
+    Use when a user's access changes, so the next request asks the backend.
+    """
+    cache = _sessions()
+    for key in [key for key, user in cache.items() if user.id == user_id]:
+        cache.pop(key, None)
+
+def clear_session_cache():
+    _sessions().clear()
+    _denied_sessions().clear()
+
+def get_lookup_stats() -> SingleFlightStats:
+    """ How many backend lookups were shared with one already in flight. """
+    return LOOKUPS.stats()
+
+def get_session_cache_stats() -> SessionCacheStats:
+    return SessionCacheStats(sessions=_sessions().stats(), denied=_denied_sessions().stats())
 
 async def _authenticate_user(request: Request, bundle_id: str=None, feature: str=None) -> User:
+    """ Authenticate the user, counting the time against the request. See `_authenticate`. """
+    start = time.perf_counter()
+    try:
+        return await _authenticate(request, bundle_id, feature)
+    finally:
+        metrics.record_auth(time.perf_counter() - start)
+
+async def _authenticate(request: Request, bundle_id: str=None, feature: str=None) -> User:
     """ Authenticate the user with the Swift backend.
 
     The Swift backend will return the signed in user who has already been
-    authenticated via BOSS.
+    authenticated via BOSS. The answer is cached per session; see `SESSIONS`.
 
     It is assumed that if login is disabled, this is a private server.
     Therefore, an admin user is returned when login is disabled.
     """
+    key = _session_key(request, bundle_id, feature)
+    if key is not None:
+        user = _sessions().lookup(key)
+        if user is not MISSING:
+            # A copy, so a route that changes its `boss_user` does not change
+            # the next request's.
+            return user.model_copy()
+        detail = _denied_sessions().lookup(key)
+        if detail is not MISSING:
+            raise HTTPException(status_code=401, detail=detail)
+
     try:
         if bundle_id:
-            return await verify_user(request, bundle_id, feature)
+            user = await verify_user(request, bundle_id, feature)
         else:
-            return await get_user(request)
+            user = await get_user(request)
     except HTTPException as exc:
+        if exc.status_code == 401 and key is not None:
+            _denied_sessions()[key] = exc.detail
         cfg = get_config()
         # If the server is not running and login is not required,
         # return Admin user.
@@ -230,6 +681,11 @@ async def _authenticate_user(request: Request, bundle_id: str=None, feature: str
                 avatarUrl=None
             )
         raise exc
+    # The stand-in admin above is not cached. It answers "the backend is
+    # down", which should be asked again on the next request.
+    if key is not None:
+        _sessions()[key] = user
+    return user.model_copy()
 
 def get_boss_path() -> str:
     """ Get path to project bundle path. """
@@ -283,18 +739,18 @@ async def register_acl_with_boss():
     headers = {"Content-Type": "application/json"}
     logging.debug(f"Registering ACL catalog ({payload}) REGISTERED_APPS ({REGISTERED_APPS})")
 
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.post(
-                REGISTER_ACL_ENDPOINT,
-                json=payload.model_dump(),
-                headers=headers
-            )
-            response.raise_for_status()
-        except httpx.HTTPStatusError as e:
-            raise HTTPException(status_code=e.response.status_code, detail=e.response.text)
-        except httpx.RequestError as e:
-            raise HTTPException(status_code=500, detail=str(e))
+    try:
+        response = await backend_request(
+            "POST",
+            REGISTER_ACL_ENDPOINT,
+            json=payload.model_dump(),
+            headers=headers
+        )
+        response.raise_for_status()
+    except httpx.HTTPStatusError as e:
+        raise HTTPException(status_code=e.response.status_code, detail=e.response.text)
+    except httpx.RequestError as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
     # TODO: The response could be used in the future
     #body = response.json()
@@ -0,0 +1,160 @@
+#
+# App startup
+#
+# `api.py` imports every app, then runs their `start()` hooks. Each app owns
+# its own database and state, so the hooks do not depend on one another and
+# run at the same time, on threads. Boot takes as long as the slowest app, not
+# the sum of them.
+#
+# An app whose `start()` is not needed to serve the others, and is slow, may
+# declare
+#
+# ```
+# LAZY_START = True
+# ```
+#
+# Its `start()` then runs on the first request to one of its routes, which
+# waits for it. Every other app is served from boot.
+#
+# How long each app took to import, start and register its routes is logged
+# once booted, and exported on `/api/metrics`.
+#
+# An app's `shutdown()`, sync or async, is called when the server stops.
+#
+
+import inspect
+import logging
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import HTTPException
+from lib import metrics
+from lib.state import exclusive
+from lib.workers import run_sync
+from pydantic import BaseModel
+from typing import Callable, Dict, List, Optional
+
+# Phases of an app's boot, in order
+IMPORT = "import"
+START = "start"
+ROUTER = "router"
+
+class AppBoot(BaseModel):
+    bundleId: str
+    # Seconds taken by each phase. A lazily started app has no `start` until
+    # its first request.
+    phases: Dict[str, float] = {}
+    lazy: bool = False
+    error: Optional[str] = None
+
+# Bundle ID -> boot, in the order apps were loaded
+BOOT: Dict[str, AppBoot] = {}
+BOOT_LOCK = threading.Lock()
+# Bundle ID -> `shutdown()`
+SHUTDOWNS: Dict[str, Callable] = {}
+
+def record(bundle_id: str, phase: str, seconds: float):
+    with BOOT_LOCK:
+        BOOT.setdefault(bundle_id, AppBoot(bundleId=bundle_id)).phases[phase] = seconds
+    metrics.record_boot(bundle_id, phase, seconds)
+
+def _failed(bundle_id: str, error: Exception):
+    with BOOT_LOCK:
+        BOOT.setdefault(bundle_id, AppBoot(bundleId=bundle_id)).error = str(error)
+
+def _start(bundle_id: str, start: Callable[[], None]):
+    """ Run an app's `start()`, one worker process at a time. """
+    began = time.perf_counter()
+    try:
+        with exclusive(f"start-{bundle_id}"):
+            start()
+    except Exception as error:
+        _failed(bundle_id, error)
+        raise
+    finally:
+        record(bundle_id, START, time.perf_counter() - began)
+
+def start_apps(starts: Dict[str, Callable[[], None]]):
+    """ Run each app's `start()` concurrently, and wait for all of them.
+
+    Raises the first app's error, as a serial start would have, once every
+    other app has finished starting.
+
+    @param starts: Bundle ID -> `start()`
+    """
+    if not starts:
+        return
+    with ThreadPoolExecutor(max_workers=len(starts), thread_name_prefix="boss-start") as executor:
+        futures = {bundle_id: executor.submit(_start, bundle_id, start) for bundle_id, start in starts.items()}
+    for bundle_id, future in futures.items():
+        error = future.exception()
+        if error is not None:
+            logging.error(f"Failed to start app ({bundle_id}): {error}")
+            raise error
+
+class LazyStart:
+    """ Router dependency that runs an app's `start()` on its first request.
+
+    Concurrent first requests wait for the same start. A start that fails
+    refuses the request with a 503 and is tried again by the next one.
+    """
+
+    def __init__(self, bundle_id: str, start: Callable[[], None]):
+        self.bundle_id = bundle_id
+        self.start = start
+        self.started = False
+        self.lock = threading.Lock()
+        with BOOT_LOCK:
+            BOOT.setdefault(bundle_id, AppBoot(bundleId=bundle_id)).lazy = True
+
+    def _start_once(self):
+        with self.lock:
+            if self.started:
+                return
+            logging.info(f"Starting app ({self.bundle_id}) on its first request")
+            _start(self.bundle_id, self.start)
+            self.started = True
+
+    async def __call__(self):
+        if self.started:
+            return
+        try:
+            await run_sync(self._start_once)
+        except HTTPException:
+            raise
+        except Exception as error:
+            logging.exception(f"Failed to start app ({self.bundle_id})")
+            raise HTTPException(
+                status_code=503,
+                detail=f"App ({self.bundle_id}) failed to start. Please try again.",
+                headers={"Retry-After": "1"}
+            ) from error
+
+def on_shutdown(bundle_id: str, shutdown: Callable):
+    """ Call an app's `shutdown()` when the server stops. """
+    SHUTDOWNS[bundle_id] = shutdown
+
+async def shutdown_apps():
+    """ Call each app's `shutdown()`. One that fails does not stop the others. """
+    for bundle_id, shutdown in SHUTDOWNS.items():
+        try:
+            result = shutdown()
+            if inspect.isawaitable(result):
+                await result
+        except Exception:
+            logging.exception(f"Failed to shut down app ({bundle_id})")
+
+def get_boot_report() -> List[AppBoot]:
+    with BOOT_LOCK:
+        return [boot.model_copy(deep=True) for boot in BOOT.values()]
+
+def log_boot_report(total: float):
+    """ Log how long each app took to boot, slowest first. """
+    report = sorted(get_boot_report(), key=lambda boot: sum(boot.phases.values()), reverse=True)
+    logging.info(f"Booted ({len(report)}) apps in ({total * 1000:.0f}ms)")
+    for boot in report:
+        phases = ", ".join(f"{phase} ({seconds * 1000:.0f}ms)" for phase, seconds in boot.phases.items())
+        lazy = " [lazy]" if boot.lazy else ""
+        error = f" [failed: {boot.error}]" if boot.error else ""
+        logging.info(f"  ({boot.bundleId}){lazy}: {phases}{error}")
@@ -0,0 +1,277 @@
+#
+# State shared by every worker process
+#
+# `api.py` can serve with several uvicorn workers (`api_workers`). Each is its
+# own process with its own memory, so anything an app keeps between requests
+# in a module global is seen by only one of them: a CSV previewed by one worker
+# cannot be committed on another, and a puzzle cached by one goes stale when
+# another records a guess.
+#
+# State that must survive from one request to the next goes through
+# `shared_state` instead. With one worker it is an in-memory TTL map, exactly
+# what the app kept before. With several, it is a table in a SQLite file every
+# worker opens, so each sees the others' writes.
+#
+# Plain caches of data that never changes (e.g. a word's letters) do not need
+# this. Each worker can keep its own.
+#
+
+import fcntl
+import json
+import os
+import threading
+import time
+import uuid
+
+from abc import ABC, abstractmethod
+from cachetools import TTLCache
+from contextlib import contextmanager
+from lib import database, get_config
+from pydantic import BaseModel
+from typing import Any, Dict, Hashable, Iterator, Optional, Type
+
+# Set by `api.py` before it starts its workers, so every worker knows.
+WORKERS_ENV = "BOSS_API_WORKERS"
+# Identifies one start of the server, shared by all of its workers
+BOOT_ID_ENV = "BOSS_BOOT_ID"
+
+STATE_DB_NAME = "state.sqlite3"
+
+# Used when no boot id was given, e.g. a single worker started without `api.py`
+_PROCESS_BOOT_ID = uuid.uuid4().hex
+
+def is_multi_worker() -> bool:
+    """ Returns `True` if this process is one of several serving the API. """
+    return int(os.environ.get(WORKERS_ENV, "1")) > 1
+
+def get_boot_id() -> str:
+    return os.environ.get(BOOT_ID_ENV, _PROCESS_BOOT_ID)
+
+def get_state_db_path() -> str:
+    return os.path.join(get_config().db_path, STATE_DB_NAME)
+
+class SharedState(ABC):
+    """ A namespaced key/value map with optional expiry.
+
+    Keys are converted to strings. When values are stored out of process,
+    they are stored as JSON: a `model` is stored with `model_dump` and read
+    back with `model_validate`; anything else must be JSON-serializable.
+    """
+
+    @abstractmethod
+    def get(self, key: Hashable, default: Any=None) -> Any:
+        ...
+
+    @abstractmethod
+    def __setitem__(self, key: Hashable, value: Any):
+        ...
+
+    @abstractmethod
+    def pop(self, key: Hashable, default: Any=None) -> Any:
+        ...
+
+    @abstractmethod
+    def claim(self, key: Hashable, ttl: Optional[float]=None) -> bool:
+        """ Set `key` if it is not already set. Returns `True` if this call set it.
+
+        Exactly one caller, across all workers, gets `True`.
+        """
+
+    @abstractmethod
+    def clear(self):
+        ...
+
+class MemoryState(SharedState):
+    """ In-process state. Values are kept as is, not copied. """
+
+    def __init__(self, ttl: Optional[float]=None, maxsize: int=1024):
+        # A plain dict never expires or evicts anything, as before.
+        self.values: Dict[str, Any] = TTLCache(maxsize, ttl=ttl) if ttl else {}
+        self.lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any=None) -> Any:
+        return self.values.get(str(key), default)
+
+    def __setitem__(self, key: Hashable, value: Any):
+        self.values[str(key)] = value
+
+    def pop(self, key: Hashable, default: Any=None) -> Any:
+        return self.values.pop(str(key), default)
+
+    def claim(self, key: Hashable, ttl: Optional[float]=None) -> bool:
+        with self.lock:
+            if str(key) in self.values:
+                return False
+            self.values[str(key)] = True
+            return True
+
+    def clear(self):
+        self.values.clear()
+
+class SQLiteState(SharedState):
+    """ State in a SQLite table, shared by every process that opens `path`.
+
+    Expired rows are ignored when read and removed as others are written.
+    There is no size bound; give values a `ttl`.
+    """
+
+    def __init__(self, path: str, namespace: str, ttl: Optional[float]=None, model: Optional[Type[BaseModel]]=None):
+        self.path = path
+        self.namespace = namespace
+        self.ttl = ttl
+        self.model = model
+        _create_state_table(path)
+
+    def _expires(self, ttl: Optional[float]) -> Optional[float]:
+        ttl = ttl if ttl is not None else self.ttl
+        return time.time() + ttl if ttl else None
+
+    def _encode(self, value: Any) -> str:
+        if self.model is not None:
+            return value.model_dump_json()
+        return json.dumps(value)
+
+    def _decode(self, value: str) -> Any:
+        if self.model is not None:
+            return self.model.model_validate_json(value)
+        return json.loads(value)
+
+    def get(self, key: Hashable, default: Any=None) -> Any:
+        conn = database.connect(self.path)
+        try:
+            row = conn.execute(
+                "SELECT value FROM state WHERE namespace = ? AND key = ? AND (expires IS NULL OR expires > ?)",
+                (self.namespace, str(key), time.time())
+            ).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return default
+        return self._decode(row[0])
+
+    def __setitem__(self, key: Hashable, value: Any):
+        conn = database.connect(self.path)
+        try:
+            conn.execute("DELETE FROM state WHERE namespace = ? AND expires <= ?", (self.namespace, time.time()))
+            conn.execute(
+                "INSERT OR REPLACE INTO state (namespace, key, value, expires) VALUES (?, ?, ?, ?)",
+                (self.namespace, str(key), self._encode(value), self._expires(None))
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+    def pop(self, key: Hashable, default: Any=None) -> Any:
+        conn = database.connect(self.path)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT value FROM state WHERE namespace = ? AND key = ? AND (expires IS NULL OR expires > ?)",
+                (self.namespace, str(key), time.time())
+            ).fetchone()
+            conn.execute("DELETE FROM state WHERE namespace = ? AND key = ?", (self.namespace, str(key)))
+            conn.commit()
+        finally:
+            conn.close()
+        if row is None:
+            return default
+        return self._decode(row[0])
+
+    def claim(self, key: Hashable, ttl: Optional[float]=None) -> bool:
+        conn = database.connect(self.path)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "DELETE FROM state WHERE namespace = ? AND key = ? AND expires <= ?",
+                (self.namespace, str(key), time.time())
+            )
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO state (namespace, key, value, expires) VALUES (?, ?, ?, ?)",
+                (self.namespace, str(key), "true", self._expires(ttl))
+            )
+            claimed = cursor.rowcount == 1
+            conn.commit()
+            return claimed
+        finally:
+            conn.close()
+
+    def clear(self):
+        conn = database.connect(self.path)
+        try:
+            conn.execute("DELETE FROM state WHERE namespace = ?", (self.namespace,))
+            conn.commit()
+        finally:
+            conn.close()
+
+def _create_state_table(path: str):
+    conn = database.connect(path)
+    try:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS state (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                expires REAL,
+                PRIMARY KEY (namespace, key)
+            )
+        """)
+        conn.commit()
+    finally:
+        conn.close()
+
+def shared_state(
+    namespace: str,
+    ttl: Optional[float]=None,
+    maxsize: int=1024,
+    model: Optional[Type[BaseModel]]=None
+) -> SharedState:
+    """ State named `namespace`, shared by every worker.
+
+    In memory when there is one worker; see the module comment.
+
+    @param namespace: Unique name, prefixed by the app's bundle id
+    @param ttl: Seconds a value is kept. `None` keeps it until removed.
+    @param maxsize: Most values kept in memory. Unbounded out of process.
+    @param model: Type of value, when values are models
+    """
+    if is_multi_worker():
+        return SQLiteState(get_state_db_path(), namespace, ttl=ttl, model=model)
+    return MemoryState(ttl=ttl, maxsize=maxsize)
+
+@contextmanager
+def exclusive(name: str) -> Iterator[None]:
+    """ Held by one worker at a time. e.g. to migrate a database once.
+
+    A no-op with one worker.
+    """
+    if not is_multi_worker():
+        yield
+        return
+    path = os.path.join(get_config().db_path, f".{name}.lock")
+    with open(path, "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def worker_slot() -> str:
+    """ Returns a name for this worker that no other running worker has.
+
+    Workers claim "0" up to `api_workers` - 1 on each start of the server, so
+    the names, e.g. of log files, are the same from one start to the next. A
+    worker started after every number is taken, e.g. to replace one that died,
+    is named by its process id.
+    """
+    workers = int(os.environ.get(WORKERS_ENV, "1"))
+    for slot in range(workers):
+        if once_per_boot(f"worker-slot-{slot}"):
+            return str(slot)
+    return f"pid{os.getpid()}"
+
+def once_per_boot(name: str) -> bool:
+    """ Returns `True` to exactly one worker per start of the server. """
+    if not is_multi_worker():
+        return True
+    # Kept a day, long past any start, so the table does not keep every boot
+    return SQLiteState(get_state_db_path(), "boss.boot").claim(f"{name}:{get_boot_id()}", ttl=60 * 60 * 24)
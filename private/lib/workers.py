@@ -0,0 +1,307 @@
+#
+# Bounded thread pool for blocking work done by async routes
+#
+# An `async def` route runs on the event loop, so a rule that blocks on SQLite
+# or the disk blocks every other request while it runs: one large export
+# stalls every operator's tap. Such a rule is handed to this pool instead:
+#
+# ```
+# return await run_sync(lib.get_job_dashboard, job_id, names=names)
+# ```
+#
+# or, for a function that is always called this way, decorated:
+#
+# ```
+# @blocking
+# def build_report(...): ...
+#
+# report = await build_report(...)
+# ```
+#
+# The pool is sized by `worker_threads`. At most `worker_queue` calls wait for
+# a thread; past that a call is refused with a 503, because a queue that grows
+# without bound only turns overload into timeouts.
+#
+# Work runs with the caller's context, so request metrics (e.g. SQL statements)
+# are still counted against the request that asked for it.
+#
+# CPU-bound work, e.g. parsing a large document, holds the GIL and slows every
+# thread, the event loop's included. It is run in a separate process instead:
+#
+# ```
+# result = await run_in_process(parse, text)
+# ```
+#
+# The process pool is sized by `worker_processes`, and queues at most
+# `worker_process_queue` calls. If a process dies, e.g. killed for memory, its
+# calls are refused with a 503 and the pool starts new processes. `func`, its
+# arguments and its result are pickled, so `func` must be a module-level
+# function of a module importable by name (e.g. one under `lib/`), and should
+# be handed and return no more than it needs.
+#
+
+import asyncio
+import concurrent.futures
+import contextvars
+import functools
+import logging
+import multiprocessing
+import threading
+import time
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from fastapi import HTTPException
+from lib import get_option
+from pydantic import BaseModel
+from typing import Any, Callable, Optional
+
+class WorkerStats(BaseModel):
+    threads: int
+    # Calls running, and calls waiting for a thread
+    active: int
+    queued: int
+    maxQueued: int
+    completed: int
+    # Calls refused because too many were waiting
+    rejected: int
+    # Time the last call, and the longest, waited for a thread, in milliseconds
+    lastWaitMs: float
+    maxWaitMs: float
+
+class ProcessStats(BaseModel):
+    processes: int
+    # Calls running or waiting for a process
+    pending: int
+    completed: int
+    # Calls that raised, or whose process died
+    failed: int
+    rejected: int
+
+def _busy() -> HTTPException:
+    return HTTPException(
+        status_code=503,
+        detail="The server is busy. Please try again.",
+        headers={"Retry-After": "1"}
+    )
+
+class WorkerPool:
+    """ A thread pool that refuses work instead of queueing it forever. """
+
+    def __init__(self, threads: int, queue: int):
+        self.threads = threads
+        self.queue = queue
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="boss-worker")
+        self.lock = threading.Lock()
+        # Calls submitted and not yet finished
+        self.pending = 0
+        self.active = 0
+        self.max_queued = 0
+        self.completed = 0
+        self.rejected = 0
+        self.last_wait_ms = 0.0
+        self.max_wait_ms = 0.0
+
+    async def run(self, func: Callable, *args, **kwargs) -> Any:
+        with self.lock:
+            if self.pending >= self.threads + self.queue:
+                self.rejected += 1
+                raise _busy()
+            self.pending += 1
+            self.max_queued = max(self.max_queued, self.pending - self.threads)
+
+        submitted = time.perf_counter()
+        context = contextvars.copy_context()
+
+        def work():
+            waited = (time.perf_counter() - submitted) * 1000
+            with self.lock:
+                self.active += 1
+                self.last_wait_ms = waited
+                self.max_wait_ms = max(self.max_wait_ms, waited)
+            try:
+                return context.run(func, *args, **kwargs)
+            finally:
+                with self.lock:
+                    self.active -= 1
+                    self.pending -= 1
+                    self.completed += 1
+
+        try:
+            future = asyncio.get_running_loop().run_in_executor(self.executor, work)
+        except RuntimeError:
+            # The pool is shut down. `work` will never run to count itself out.
+            with self.lock:
+                self.pending -= 1
+            raise
+        # A cancelled caller stops waiting; the work still runs, and counts
+        # itself out.
+        return await future
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+    def stats(self) -> WorkerStats:
+        with self.lock:
+            return WorkerStats(
+                threads=self.threads,
+                active=self.active,
+                queued=max(0, self.pending - self.active),
+                maxQueued=self.max_queued,
+                completed=self.completed,
+                rejected=self.rejected,
+                lastWaitMs=self.last_wait_ms,
+                maxWaitMs=self.max_wait_ms
+            )
+
+class ProcessPool:
+    """ A process pool that refuses work instead of queueing it forever.
+
+    Processes are started on first use, by a fork server where there is one.
+    Forking the server itself would copy its threads' locks in whatever state
+    they were in, and a child could block on one forever.
+
+    A call is counted out when its process is done with it, not when its
+    caller stops waiting, so a cancelled caller does not make room for more
+    work than the processes can run.
+    """
+
+    def __init__(self, processes: int, queue: int):
+        self.processes = processes
+        self.queue = queue
+        self.executor = self._make_executor()
+        # Counted out by the executor's thread
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    def _make_executor(self) -> ProcessPoolExecutor:
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        return ProcessPoolExecutor(max_workers=self.processes, mp_context=multiprocessing.get_context(method))
+
+    def _done(self, future: concurrent.futures.Future):
+        with self.lock:
+            self.pending -= 1
+            if future.cancelled():
+                return
+            if future.exception() is None:
+                self.completed += 1
+            else:
+                self.failed += 1
+
+    def _broken(self, executor: ProcessPoolExecutor) -> HTTPException:
+        """ Replace `executor`, whose process died, and refuse the call. """
+        if self.executor is executor:
+            logging.error("A worker process died. Starting new processes.")
+            self.executor = self._make_executor()
+            executor.shutdown(wait=False, cancel_futures=True)
+        return _busy()
+
+    async def run(self, func: Callable, *args, **kwargs) -> Any:
+        with self.lock:
+            if self.pending >= self.processes + self.queue:
+                self.rejected += 1
+                raise _busy()
+            self.pending += 1
+
+        executor = self.executor
+        try:
+            future = executor.submit(func, *args, **kwargs)
+        except BrokenProcessPool:
+            with self.lock:
+                self.pending -= 1
+            raise self._broken(executor)
+        except RuntimeError:
+            # The pool is shut down
+            with self.lock:
+                self.pending -= 1
+            raise
+        future.add_done_callback(self._done)
+        try:
+            # Cancelling the caller cancels `future`, if it has not started
+            return await asyncio.wrap_future(future)
+        except BrokenProcessPool:
+            raise self._broken(executor)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def stats(self) -> ProcessStats:
+        with self.lock:
+            return ProcessStats(
+                processes=self.processes,
+                pending=self.pending,
+                completed=self.completed,
+                failed=self.failed,
+                rejected=self.rejected
+            )
+
+# Created on first use, from `worker_threads` and `worker_queue`
+WORKERS: Optional[WorkerPool] = None
+WORKERS_LOCK = threading.Lock()
+# Created on first use, from `worker_processes` and `worker_process_queue`
+PROCESSES: Optional[ProcessPool] = None
+
+def _workers() -> WorkerPool:
+    global WORKERS
+    if WORKERS is None:
+        with WORKERS_LOCK:
+            if WORKERS is None:
+                WORKERS = WorkerPool(
+                    threads=int(get_option("worker_threads", 8)),
+                    queue=int(get_option("worker_queue", 64))
+                )
+    return WORKERS
+
+async def run_sync(func: Callable, *args, **kwargs) -> Any:
+    """ Run blocking `func` on the worker pool and wait for its result.
+
+    Raises whatever `func` raises, or a 503 if too many calls are waiting.
+    """
+    return await _workers().run(func, *args, **kwargs)
+
+def blocking(func: Callable) -> Callable:
+    """ Make blocking `func` awaitable, running it on the worker pool. """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run_sync(func, *args, **kwargs)
+    return wrapper
+
+def _processes() -> ProcessPool:
+    global PROCESSES
+    if PROCESSES is None:
+        PROCESSES = ProcessPool(
+            processes=int(get_option("worker_processes", 2)),
+            queue=int(get_option("worker_process_queue", 8))
+        )
+    return PROCESSES
+
+async def run_in_process(func: Callable, *args, **kwargs) -> Any:
+    """ Run CPU-bound `func` in a worker process and wait for its result.
+
+    Raises whatever `func` raises, or a 503 if too many calls are waiting or
+    its process died.
+    """
+    return await _processes().run(func, *args, **kwargs)
+
+def shutdown_workers():
+    """ Wait for running work to finish, then stop the pools. Called at shutdown. """
+    global WORKERS, PROCESSES
+    with WORKERS_LOCK:
+        workers = WORKERS
+        WORKERS = None
+    if workers is not None:
+        workers.shutdown()
+    processes, PROCESSES = PROCESSES, None
+    if processes is not None:
+        processes.shutdown()
+
+def get_worker_stats() -> WorkerStats:
+    return _workers().stats()
+
+def get_process_stats() -> ProcessStats:
+    if PROCESSES is None:
+        return ProcessStats(processes=int(get_option("worker_processes", 2)), pending=0, completed=0, failed=0, rejected=0)
+    return PROCESSES.stats()
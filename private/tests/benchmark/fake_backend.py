@@ -0,0 +1,95 @@
+#
+# A local stand-in for the Swift backend
+#
+# Answers the endpoints `lib/server.py` calls, the way the backend does, with
+# one signed-in admin and a directory of users. It is an ASGI app, so the
+# benchmark hands it to the pooled client as its transport and no server has
+# to run on :8081:
+#
+# ```
+# backend = FakeBackend(latency=0.002)
+# server.open_backend_client(transport=httpx.ASGITransport(app=backend.app))
+# ```
+#
+# Every call is counted by path, to report how many backend calls each
+# request to BOSS costs.
+#
+
+import asyncio
+
+from collections import Counter
+from fastapi import FastAPI, Request
+
+ADMIN = {"id": 1, "system": 0, "fullName": "Ada Admin", "email": "ada@example.com",
+         "verified": True, "enabled": True}
+
+class FakeBackend:
+    """ The backend's endpoints, answered from memory.
+
+    @param latency: Seconds each call takes, as a backend on the same host
+        would. 0 measures BOSS alone.
+    @param users: Users in the directory, and friends of the admin
+    """
+
+    def __init__(self, latency: float=0.0, users: int=50):
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self.users = [ADMIN] + [
+            {"id": i, "system": 0, "fullName": f"User {i}", "email": f"user{i}@example.com",
+             "verified": True, "enabled": True}
+            for i in range(2, users + 1)
+        ]
+        self.app = self._make_app()
+
+    def _make_app(self) -> FastAPI:
+        app = FastAPI()
+
+        @app.middleware("http")
+        async def count(request: Request, call_next):
+            self.calls[request.url.path] += 1
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            return await call_next(request)
+
+        @app.get("/heartbeat")
+        async def heartbeat(request: Request):
+            return {"isSignedIn": "accessToken" in request.cookies, "isSecurityEnabled": True}
+
+        @app.get("/account/user")
+        async def get_user():
+            return {"user": ADMIN}
+
+        @app.post("/private/acl/verify")
+        async def verify():
+            return {"user": ADMIN}
+
+        @app.post("/private/acl/register")
+        async def register():
+            return {}
+
+        @app.get("/friend")
+        async def get_friends():
+            return {"friends": [
+                {"id": user["id"], "userId": user["id"], "name": user["fullName"]}
+                for user in self.users[1:]
+            ]}
+
+        @app.get("/account/users/details")
+        async def get_user_details():
+            return {"users": self.users}
+
+        @app.post("/private/send/events")
+        async def send_events():
+            return {}
+
+        @app.post("/private/send/notifications")
+        async def send_notifications():
+            return {}
+
+        return app
+
+    def reset(self):
+        self.calls.clear()
+
+    def total_calls(self) -> int:
+        return sum(self.calls.values())
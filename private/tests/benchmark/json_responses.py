@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+#
+# Benchmarks FastAPI's default response path against `@fast_json`
+#
+# Serves Production's work unit list, at the sizes real jobs reach, both
+# ways through the same app, and prints the time per request. Nothing is read
+# from a database; the route returns rows built up front, so only the
+# response is measured.
+#
+# Run from `private/`:
+#
+#   PYTHONPATH=.:tests python tests/benchmark/json_responses.py
+#
+
+import argparse
+import asyncio
+import httpx
+import time
+
+from fastapi import APIRouter, FastAPI
+from libtest import get_app_module
+from lib import responses
+from lib.responses import fast_json
+from typing import List
+
+get_app_module("io.bithead.production")
+from io.bithead.production.model import WorkUnitSummary
+
+SIZES = (100, 1000, 10000)
+
+def work_units(count: int) -> List[WorkUnitSummary]:
+    return [
+        WorkUnitSummary(
+            id=i,
+            label=f"SN-{i:06d}",
+            rowOrder=i,
+            input={"serial": f"SN-{i:06d}", "customer": "Acme Manufacturing", "color": "Red", "size": "L"},
+            state="complete" if i % 3 else "in_progress",
+            currentStep=i % 7,
+            lineId=i % 12,
+            startedAt="2025-03-04T08:15:00",
+            completedAt="2025-03-04T09:02:00" if i % 3 else None,
+            failedAt=None,
+            failedStep=None,
+            requeuedAt=None,
+            operator="Dana Operator"
+        )
+        for i in range(count)
+    ]
+
+def make_app(rows: List[WorkUnitSummary]) -> FastAPI:
+    router = APIRouter()
+
+    @router.get("/default", response_model=List[WorkUnitSummary])
+    async def get_default():
+        return rows
+
+    @router.get("/fast", response_model=List[WorkUnitSummary])
+    @fast_json
+    async def get_fast():
+        return rows
+
+    app = FastAPI()
+    app.include_router(router)
+    return app
+
+async def measure(client: httpx.AsyncClient, path: str, repeat: int) -> float:
+    await client.get(path)
+    began = time.perf_counter()
+    for _ in range(repeat):
+        response = await client.get(path)
+        response.raise_for_status()
+    return (time.perf_counter() - began) / repeat
+
+async def main(repeat: int):
+    encoder = "orjson" if responses.orjson is not None else "json"
+    print(f"Other data encoded with ({encoder})")
+    print(f"{'units':>8} {'default ms':>12} {'fast ms':>10} {'speedup':>8}")
+    for size in SIZES:
+        app = make_app(work_units(size))
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+            default = await measure(client, "/default", repeat)
+            fast = await measure(client, "/fast", repeat)
+        print(f"{size:>8} {default * 1000:>12.2f} {fast * 1000:>10.2f} {default / fast:>7.1f}x")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark JSON responses")
+    parser.add_argument("--repeat", type=int, default=10, help="Requests per measurement")
+    args = parser.parse_args()
+    asyncio.run(main(args.repeat))
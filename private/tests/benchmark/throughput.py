@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+#
+# Benchmarks the throughput of every app, as BOSS serves them
+#
+# Starts `api.py`'s app in-process, with every app mounted and started and
+# every middleware in place, against a local stand-in for the Swift backend
+# (see `fake_backend.py`). Each scenario is a request a screen makes. It is
+# sent by many clients at once, and its requests per second, latency
+# percentiles and backend calls per request are printed.
+#
+# Apps' databases are created in a temporary directory, not the one in the
+# BOSS config.
+#
+# Run from `private/`:
+#
+#   PYTHONPATH=.:tests python tests/benchmark/throughput.py
+#   PYTHONPATH=.:tests python tests/benchmark/throughput.py --app io.bithead.boss --concurrency 64
+#
+# To catch regressions, save a run and compare a later one with it. A run
+# whose throughput fell, or whose p99 rose, by more than `--tolerance` exits
+# with 1:
+#
+#   PYTHONPATH=.:tests python tests/benchmark/throughput.py --save baseline.json
+#   PYTHONPATH=.:tests python tests/benchmark/throughput.py --baseline baseline.json
+#
+
+import argparse
+import asyncio
+import httpx
+import json
+import logging
+import sys
+import tempfile
+import time
+
+from fake_backend import FakeBackend
+from lib import get_config, server
+from pydantic import BaseModel
+from typing import Any, Dict, List, NamedTuple, Optional
+
+class Scenario(NamedTuple):
+    bundle_id: str
+    name: str
+    method: str
+    path: str
+    body: Optional[Any] = None
+
+DOCUMENT = json.dumps({"rows": [{"id": i, "name": f"row {i}", "tags": ["a", "b"]} for i in range(50)]})
+
+SCENARIOS = [
+    Scenario("io.bithead.boss", "heartbeat", "GET", "/api/io.bithead.boss/heartbeat"),
+    Scenario("io.bithead.boss", "workspace", "GET", "/api/io.bithead.boss/workspace/1"),
+    Scenario("io.bithead.boss", "restore defaults", "POST", "/api/io.bithead.boss/defaults/query",
+             {"userId": 1, "bundleIds": ["io.bithead.wordy"]}),
+    Scenario("io.bithead.boss", "set default", "POST", "/api/io.bithead.boss/defaults",
+             {"bundleId": "io.bithead.wordy", "userId": 1, "key": "theme", "value": "dark"}),
+    Scenario("io.bithead.json-formatter", "format", "POST", "/api/io.bithead.json-formatter/", {"text": DOCUMENT}),
+    Scenario("io.bithead.production", "me", "GET", "/api/io.bithead.production/me"),
+    Scenario("io.bithead.production", "jobs", "GET", "/api/io.bithead.production/jobs"),
+    Scenario("io.bithead.production", "production lines", "GET", "/api/io.bithead.production/production-lines"),
+    Scenario("io.bithead.scheduler", "me", "GET", "/api/io.bithead.scheduler/me"),
+    # Starts the user's puzzle, which their friends' results are read for
+    Scenario("io.bithead.wordy", "puzzle", "GET", "/api/io.bithead.wordy/word"),
+    Scenario("io.bithead.wordy", "statistics", "GET", "/api/io.bithead.wordy/statistics"),
+    Scenario("io.bithead.wordy", "friends", "GET", "/api/io.bithead.wordy/friends"),
+    Scenario("io.bithead.lean-visualizer", "model", "GET", "/api/io.bithead.lean-visualizer/model"),
+    Scenario("io.bithead.lean-visualizer", "metrics", "GET", "/api/io.bithead.lean-visualizer/metrics"),
+]
+
+class Result(BaseModel):
+    requests: int
+    errors: int
+    rps: float
+    p50Ms: float
+    p90Ms: float
+    p99Ms: float
+    maxMs: float
+    backendCallsPerRequest: float
+
+def percentile(latencies: List[float], fraction: float) -> float:
+    """ Returns the latency `fraction` of requests were faster than, in milliseconds. """
+    index = min(len(latencies) - 1, int(len(latencies) * fraction))
+    return latencies[index] * 1000
+
+async def run_scenario(client: httpx.AsyncClient, backend: FakeBackend, scenario: Scenario, requests: int,
+                       concurrency: int) -> Result:
+    async def send() -> httpx.Response:
+        return await client.request(scenario.method, scenario.path, json=scenario.body)
+
+    # Warm caches and lazily started apps, as a running server would be
+    for _ in range(min(10, requests)):
+        await send()
+
+    backend.reset()
+    latencies: List[float] = []
+    errors = 0
+    remaining = requests
+
+    async def client_loop():
+        nonlocal remaining, errors
+        while remaining > 0:
+            remaining -= 1
+            began = time.perf_counter()
+            response = await send()
+            latencies.append(time.perf_counter() - began)
+            if response.status_code >= 400:
+                errors += 1
+
+    began = time.perf_counter()
+    await asyncio.gather(*[client_loop() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - began
+
+    latencies.sort()
+    return Result(
+        requests=requests,
+        errors=errors,
+        rps=requests / elapsed,
+        p50Ms=percentile(latencies, 0.50),
+        p90Ms=percentile(latencies, 0.90),
+        p99Ms=percentile(latencies, 0.99),
+        maxMs=latencies[-1] * 1000,
+        backendCallsPerRequest=backend.total_calls() / requests
+    )
+
+def compare(results: Dict[str, Result], baseline: Dict[str, dict], tolerance: float) -> List[str]:
+    """ Returns a line for each scenario slower than it was in `baseline`. """
+    regressions = []
+    for key, result in results.items():
+        before = baseline.get(key)
+        if before is None:
+            continue
+        if result.rps < before["rps"] * (1 - tolerance):
+            regressions.append(f"{key}: ({result.rps:.0f}) requests/s, was ({before['rps']:.0f})")
+        if result.p99Ms > before["p99Ms"] * (1 + tolerance):
+            regressions.append(f"{key}: p99 ({result.p99Ms:.2f}ms), was ({before['p99Ms']:.2f}ms)")
+    return regressions
+
+async def main(args) -> int:
+    backend = FakeBackend(latency=args.backend_latency / 1000, users=args.users)
+    server.BACKEND_CLIENT = None
+    server.open_backend_client(transport=httpx.ASGITransport(app=backend.app))
+
+    # Keep benchmark data out of the configured databases
+    get_config().db_path = tempfile.mkdtemp(prefix="boss-benchmark-")
+
+    import api
+    # Request logs would be most of what is measured
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    scenarios = [
+        scenario for scenario in SCENARIOS
+        if (not args.app or scenario.bundle_id in args.app)
+        and (not args.scenario or args.scenario in scenario.name)
+    ]
+    results: Dict[str, Result] = {}
+
+    async with api.app.router.lifespan_context(api.app):
+        # A route that fails is counted as an error, and does not stop the run
+        transport = httpx.ASGITransport(app=api.app, raise_app_exceptions=False)
+        async with httpx.AsyncClient(transport=transport, base_url="http://boss", cookies={"accessToken": "benchmark"}) as client:
+            print(f"({args.concurrency}) clients, ({args.requests}) requests per scenario, "
+                  f"backend latency ({args.backend_latency}ms)")
+            print(f"{'scenario':<44} {'req/s':>8} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8} {'errors':>7} {'backend':>8}")
+            for scenario in scenarios:
+                key = f"{scenario.bundle_id} {scenario.name}"
+                result = await run_scenario(client, backend, scenario, args.requests, args.concurrency)
+                results[key] = result
+                print(f"{key:<44} {result.rps:>8.0f} {result.p50Ms:>8.2f} {result.p90Ms:>8.2f} {result.p99Ms:>8.2f} "
+                      f"{result.maxMs:>8.2f} {result.errors:>7} {result.backendCallsPerRequest:>8.2f}")
+
+    if args.save:
+        with open(args.save, "w") as fh:
+            json.dump({key: result.model_dump() for key, result in results.items()}, fh, indent=2)
+        print(f"Saved results to ({args.save})")
+
+    if args.baseline:
+        with open(args.baseline, "r") as fh:
+            baseline = json.load(fh)
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            return 1
+        print(f"No regressions against ({args.baseline})")
+    return 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the throughput of every app")
+    parser.add_argument("--requests", type=int, default=2000, help="Requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=16, help="Clients sending requests at once")
+    parser.add_argument("--backend-latency", type=float, default=1.0, help="Milliseconds each backend call takes")
+    parser.add_argument("--users", type=int, default=50, help="Users in the backend's directory")
+    parser.add_argument("--app", action="append", help="Only this app's scenarios. May be repeated.")
+    parser.add_argument("--scenario", help="Only scenarios whose name contains this")
+    parser.add_argument("--save", help="Write results to this JSON file")
+    parser.add_argument("--baseline", help="Compare with results saved by --save")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Fraction a result may worsen by")
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+#
+# Benchmarks the Wordy solver's index against the SQL it replaced
+#
+# Installs a Wordy database in a temporary directory, from a dictionary of
+# random five letter words the size of the real one, and times the same
+# solver queries through `LIKE` and through the index. Both must return the
+# same words.
+#
+# It then times scoring every guess by expected information (see
+# `solver.py`), on the empty board and after one guess, with and without
+# NumPy. A ranking request stops at its time budget. With `--table`, or
+# NumPy, it builds the pattern table (see `patterns.py`) and times scoring
+# from it as well.
+#
+# Run from `private/`:
+#
+#   PYTHONPATH=.:tests python tests/benchmark/wordy_solver.py
+#
+
+import argparse
+import os
+import random
+import string
+import tempfile
+import time
+
+from libtest import get_app_module
+from lib import get_config
+
+get_app_module("io.bithead.wordy")
+from io.bithead.wordy import db, index, patterns, solver
+
+def make_dictionary(path: str, size: int, rng: random.Random):
+    # Weighted towards common letters, so queries match as many words as real ones do
+    letters = "eeeaaarrriiooottnnsslcudpmhgbfywkvxzjq"
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(letters) for _ in range(db.WORD_LEN)))
+    with open(path, "w") as fh:
+        fh.write("\n".join(sorted(words)))
+
+def make_queries(count: int, rng: random.Random) -> list:
+    queries = []
+    for _ in range(count):
+        hits = [rng.choice("aeiorstln") if rng.random() < 0.25 else None for _ in range(db.WORD_LEN)]
+        found = rng.sample("aeiorstln", rng.randint(0, 2))
+        misses = rng.sample("cdpmhgbfyw", rng.randint(0, 4))
+        queries.append((hits, found, misses))
+    return queries
+
+def measure(solve, queries: list, repeat: int) -> float:
+    began = time.perf_counter()
+    for _ in range(repeat):
+        for hits, found, misses in queries:
+            solve(hits, found, misses)
+    return (time.perf_counter() - began) / (repeat * len(queries))
+
+def main(words: int, queries: int, repeat: int, table: bool):
+    rng = random.Random(42)
+    directory = tempfile.mkdtemp(prefix="boss-wordy-benchmark-")
+    get_config().db_path = directory
+    dictionary = os.path.join(directory, "dictionary.csv")
+    make_dictionary(dictionary, words, rng)
+
+    db.set_dictionary_name(dictionary)
+    db.set_database_name("benchmark.sqlite3")
+    db.delete_database()
+    began = time.perf_counter()
+    db.start_database()
+    print(f"Installed and indexed ({db.NUM_WORDS}) words in ({(time.perf_counter() - began) * 1000:.0f}ms)")
+
+    queries = make_queries(queries, rng)
+    for hits, found, misses in queries:
+        if sorted(db.query_possible_words(hits, found, misses)) != db.get_possible_words(hits, found, misses):
+            raise Exception(f"Index and SQL disagree on ({hits}, {found}, {misses})")
+
+    pure = index.WordIndex(db.WORDS, db.WORD_LEN, use_numpy=False)
+    implementations = [("sql LIKE", db.query_possible_words), ("bitset index", pure.match)]
+    if db.INDEX.array is not None:
+        implementations.append(("numpy index", db.INDEX.match))
+
+    baseline = None
+    print(f"{'solver':<14} {'ms/query':>10} {'speedup':>8}")
+    for name, solve in implementations:
+        seconds = measure(solve, queries, repeat)
+        baseline = baseline or seconds
+        print(f"{name:<14} {seconds * 1000:>10.3f} {baseline / seconds:>7.1f}x")
+
+    rankers = [("python ranker", solver.Ranker(pure))]
+    if db.INDEX.array is not None:
+        rankers.append(("numpy ranker", solver.Ranker(db.INDEX)))
+    if table or patterns.numpy is not None:
+        began = time.perf_counter()
+        patterns.build_table(db.WORDS, db.WORD_LEN, db.get_patterns_path())
+        print(f"Built pattern table in ({time.perf_counter() - began:.1f}s)")
+        db.cache_words()
+        rankers.append(("python + table", solver.Ranker(pure, db.TABLE)))
+        if db.INDEX.array is not None:
+            rankers.append(("numpy + table", solver.Ranker(db.INDEX, db.TABLE)))
+    after_one_guess = db.INDEX.indices([None, None, "r", None, None], ["e"], ["a", "s", "t"])
+    print(f"Scoring every guess, against a sample of at most ({solver.SAMPLE_SIZE}) candidates")
+    print(f"{'ranker':<14} {'empty board':>12} {f'{len(after_one_guess)} left':>12}")
+    for name, ranker in rankers:
+        line = f"{name:<14}"
+        for candidates in (list(range(db.NUM_WORDS)), after_one_guess):
+            began = time.perf_counter()
+            # At least `top` guesses are scored, so this is every guess
+            ranker.rank(candidates, top=db.NUM_WORDS, budget=0)
+            line += f" {(time.perf_counter() - began) * 1000:>10.0f}ms"
+        print(line)
+    db.delete_database()
+    if os.path.exists(db.get_patterns_path()):
+        os.remove(db.get_patterns_path())
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the Wordy solver")
+    parser.add_argument("--words", type=int, default=10000, help="Words in the dictionary")
+    parser.add_argument("--queries", type=int, default=200, help="Solver queries per measurement")
+    parser.add_argument("--repeat", type=int, default=3, help="Times each query is run")
+    parser.add_argument("--table", action="store_true", help="Build the pattern table without NumPy. Takes minutes.")
+    args = parser.parse_args()
+    main(args.words, args.queries, args.repeat, args.table)
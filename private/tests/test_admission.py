@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+#
+# Tests admission control of requests to apps
+#
+
+import asyncio
+import httpx
+
+from fastapi import APIRouter, FastAPI
+from libtest import *
+from lib import admission, metrics
+from lib.admission import AdmissionMiddleware, Gate, Shed, bulk
+
+
+def test_gate():
+    async def run():
+        gate = Gate(limit=1, queue=1)
+        await gate.acquire()
+        waiting = asyncio.ensure_future(gate.acquire())
+        await asyncio.sleep(0)
+        assert not waiting.done(), "it: queues past its limit"
+        try:
+            await gate.acquire()
+            assert False, "it: refuses past its queue"
+        except Shed:
+            pass
+        gate.release()
+        await waiting
+        assert gate.active == 1, "it: hands the turn to the next in line"
+
+        # describe: a waiter gives up
+        cancelled = asyncio.ensure_future(gate.acquire())
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.sleep(0)
+        assert len(gate.waiting) == 0, "it: leaves the queue"
+        gate.release()
+        assert gate.active == 0
+
+    asyncio.run(run())
+
+
+def test_middleware():
+    admission.reset()
+    admission.LIMITS = {"bulk": {"limit": 1, "queue": 1}}
+    metrics.reset()
+    release = None
+
+    router = APIRouter(prefix="/api/io.bithead.test")
+
+    @router.get("/export")
+    @bulk()
+    async def export():
+        await release.wait()
+        return {"exported": True}
+
+    @router.get("/tap")
+    async def tap():
+        return {"tapped": True}
+
+    app = FastAPI()
+    app.add_middleware(AdmissionMiddleware)
+    app.include_router(router)
+
+    async def call():
+        nonlocal release
+        release = asyncio.Event()
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            exports = [asyncio.ensure_future(client.get("/api/io.bithead.test/export")) for _ in range(3)]
+            await asyncio.sleep(0.05)
+            tap = await client.get("/api/io.bithead.test/tap")
+            release.set()
+            return tap, await asyncio.gather(*exports)
+
+    tap, exports = asyncio.run(call())
+
+    # describe: bulk work fills its gate
+    assert tap.status_code == 200, "it: still admits interactive requests"
+    statuses = sorted(response.status_code for response in exports)
+    assert statuses == [200, 200, 503], "it: runs one, queues one and refuses the rest"
+    refused = next(response for response in exports if response.status_code == 503)
+    assert refused.headers["retry-after"] == "1"
+
+    text = metrics.render()
+    assert 'boss_admission_shed_total{bundle="io.bithead.test",class="bulk"} 1' in text, "it: counts what it refused"
+    assert 'boss_admission_wait_seconds_count{bundle="io.bithead.test",class="bulk"} 2' in text, "it: times the wait"
+
+    # describe: requests to apps that are not mounted
+    async def scan():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            return [await client.get(f"/api/scan{i}.x/") for i in range(20)]
+
+    assert all(response.status_code == 404 for response in asyncio.run(scan()))
+    assert {bundle for bundle, _ in admission.GATES} == {"io.bithead.test"}, "it: adds no gate for them"
+    admission.reset()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+#
+# Tests conditional GET with ETag and If-None-Match
+#
+
+import asyncio
+import httpx
+
+from fastapi import APIRouter, FastAPI, Request
+from libtest import *
+from lib import server
+from lib.conditional import etag, get_conditional_stats
+from lib.model import User
+from lib.responses import fast_json
+from lib.server import require_user
+from pydantic import BaseModel
+from test_server import fake_backend, users
+
+
+class Item(BaseModel):
+    id: int
+    revision: int
+
+
+def test_etag():
+    fake_backend(users)
+    server.clear_session_cache()
+    revisions = {1: 1, 2: 1}
+    built = []
+
+    router = APIRouter()
+
+    @router.get("/item/{item_id}", response_model=Item)
+    @require_user()
+    @etag(lambda item_id: revisions[item_id])
+    async def get_item(item_id: int, request: Request, boss_user: User):
+        built.append(item_id)
+        return Item(id=item_id, revision=revisions[item_id])
+
+    @router.get("/sync/{item_id}", response_model=Item)
+    @etag(lambda item_id: revisions[item_id])
+    @fast_json
+    def get_sync(item_id: int):
+        built.append(item_id)
+        return Item(id=item_id, revision=revisions[item_id])
+
+    app = FastAPI()
+    app.include_router(router)
+
+    async def call(path, tag=None):
+        headers = {"If-None-Match": tag} if tag else {}
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test",
+                                     cookies={"accessToken": "abc"}) as client:
+            return await client.get(path, headers=headers)
+
+    # describe: first poll
+    first = asyncio.run(call("/item/1"))
+    tag = first.headers["etag"]
+    assert first.status_code == 200 and first.json() == {"id": 1, "revision": 1}
+    assert first.headers["cache-control"] == "no-cache", "it: tells the browser to ask again"
+
+    # describe: poll again, nothing changed
+    built.clear()
+    stats = get_conditional_stats()
+    again = asyncio.run(call("/item/1", tag))
+    assert again.status_code == 304 and again.content == b"", "it: is not modified"
+    assert again.headers["etag"] == tag
+    assert built == [], "it: does not build the response"
+    assert get_conditional_stats().notModified == stats.notModified + 1
+    assert asyncio.run(call("/item/1", f'"other", W/{tag}')).status_code == 304, "it: matches any tag in the list"
+
+    # describe: another resource with the same version
+    assert asyncio.run(call("/item/2", tag)).status_code == 200, "it: is tagged by its path too"
+
+    # describe: the data changes
+    revisions[1] = 2
+    changed = asyncio.run(call("/item/1", tag))
+    assert changed.status_code == 200 and changed.json()["revision"] == 2, "it: builds the new response"
+    assert changed.headers["etag"] != tag
+
+    # describe: a sync route returning its own response
+    first = asyncio.run(call("/sync/1"))
+    assert first.status_code == 200 and first.json() == {"id": 1, "revision": 2}
+    assert asyncio.run(call("/sync/1", first.headers["etag"])).status_code == 304, "it: tags it too"
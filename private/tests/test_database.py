@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+#
+# Tests the pooled SQLite connections every app shares
+#
+
+import os
+import pytest
+import sqlite3
+
+from libtest import *
+from lib import database
+
+
+def a_database(tmp_path) -> str:
+    path = str(tmp_path / "test.sqlite3")
+    conn = database.connect(path, foreign_keys=True)
+    try:
+        conn.execute("CREATE TABLE items (id INTEGER PRIMARY KEY, name TEXT NOT NULL)")
+        conn.commit()
+    finally:
+        conn.close()
+    return path
+
+
+def test_pool(tmp_path):
+    path = a_database(tmp_path)
+
+    # describe: a connection is returned and asked for again
+    conn = database.connect(path)
+    try:
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal", "it: is configured when opened"
+        assert conn.execute("PRAGMA foreign_keys").fetchone()[0] == 1
+        conn.row_factory = sqlite3.Row
+    finally:
+        conn.close()
+    again = database.connect(path)
+    assert again is conn, "it: is reused"
+    assert again.row_factory is None, "it: is handed out as it was opened"
+    again.close()
+
+    # describe: a statement fails mid-transaction
+    conn = database.connect(path)
+    try:
+        conn.execute("INSERT INTO items (name) VALUES (?)", ("one",))
+        with pytest.raises(sqlite3.IntegrityError):
+            conn.execute("INSERT INTO items (name) VALUES (?)", (None,))
+    finally:
+        conn.close()
+    other = sqlite3.connect(path, timeout=0)
+    try:
+        other.execute("INSERT INTO items (name) VALUES (?)", ("two",))
+        other.commit()
+    finally:
+        other.close()
+    conn = database.connect(path)
+    try:
+        names = [row[0] for row in conn.execute("SELECT name FROM items")]
+    finally:
+        conn.close()
+    assert names == ["two"], "it: is rolled back, releasing the write lock"
+    assert database.POOLS[path].stats().rollbacks == 1
+
+    # describe: the database is removed while a connection is in use
+    held = database.connect(path)
+    database.remove(path)
+    held.close()
+    assert database.POOLS[path].stats().idle == 0, "it: closes the connection when it is returned"
+    assert not os.path.exists(path)
+    database.close(path)
+
+
+def test_backup(tmp_path):
+    path = a_database(tmp_path)
+    conn = database.connect(path)
+    try:
+        conn.execute("INSERT INTO items (name) VALUES (?)", ("one",))
+        conn.commit()
+    finally:
+        conn.close()
+
+    # describe: a snapshot taken while the write is only in the WAL
+    snapshot = str(tmp_path / "snapshot.sqlite3")
+    database.backup(path, snapshot)
+    conn = database.connect(path)
+    try:
+        conn.execute("DELETE FROM items")
+        conn.commit()
+    finally:
+        conn.close()
+
+    database.restore(path, snapshot)
+    conn = database.connect(path)
+    try:
+        assert conn.execute("SELECT name FROM items").fetchall() == [("one",)], "it: includes the write"
+    finally:
+        conn.close()
+    database.close(path)
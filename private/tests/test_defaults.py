@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+#
+# Tests the BOSS user defaults store, and the workspaces kept in it
+#
+
+import aiodbm
+import asyncio
+import pytest
+
+from libtest import *
+
+get_app_module("io.bithead.boss")
+from io.bithead.boss import workspace
+from io.bithead.boss.defaults import DefaultsStore, make_key
+from io.bithead.boss.workspace import AppLink
+
+
+def test_defaults_store(tmp_path):
+    path = str(tmp_path / "boss.dbm")
+
+    async def seed():
+        async with aiodbm.open(path, "c") as db:
+            await db.set(make_key("io.bithead.wordy", 1, "theme"), "dark")
+            await db.set(make_key("io.bithead.wordy", 1, "window/size"), "100,100")
+            await db.set(make_key("io.bithead.wordy", 2, "theme"), "light")
+            await db.set("desktop/1", "{}")
+
+    async def on_disk(db_key):
+        async with aiodbm.open(path, "c") as db:
+            value = await db.get(db_key)
+        return value and value.decode("utf-8")
+
+    asyncio.run(seed())
+
+    async def run():
+        store = DefaultsStore(path, window=0.05)
+
+        # describe: listing a bundle's defaults
+        assert await store.keys("io.bithead.wordy", 1) == ["theme", "window/size"], "it: lists them from the index"
+        assert await store.keys("io.bithead.json-formatter", 1) == []
+
+        # describe: reading
+        theme = make_key("io.bithead.wordy", 1, "theme")
+        missing = make_key("io.bithead.wordy", 1, "missing")
+        values = await store.get_many([theme, missing])
+        assert values == {theme: "dark", missing: None}
+        await store.get_many([theme, missing])
+        stats = store.get_stats()
+        assert (stats.misses, stats.hits) == (2, 2), "it: reads each key from the file once"
+
+        # describe: writing
+        volume = make_key("io.bithead.wordy", 1, "volume")
+        await store.set_many({theme: "light", volume: "11"})
+        await store.delete(make_key("io.bithead.wordy", 1, "window/size"))
+        assert await store.get(theme) == "light", "it: reads its own writes at once"
+        assert await store.keys("io.bithead.wordy", 1) == ["theme", "volume"], "it: indexes the change"
+        assert await on_disk(theme) == "dark", "it: holds writes for the window"
+
+        await asyncio.sleep(0.15)
+        assert await on_disk(theme) == "light"
+        assert await on_disk(volume) == "11"
+        assert store.get_stats().flushes == 1, "it: writes a burst in one flush"
+
+        # describe: closing
+        await store.set(theme, "dusk")
+        await store.close()
+        assert await on_disk(theme) == "dusk", "it: writes what is waiting"
+
+        # describe: shared with other workers
+        shared = DefaultsStore(path, shared=True)
+        await shared.set(volume, "3")
+        assert await on_disk(volume) == "3", "it: writes through"
+        assert await shared.keys("io.bithead.wordy", 1) == ["theme", "volume"]
+        assert await shared.get(theme) == "dusk"
+        assert shared.get_stats().cached == 0, "it: caches nothing"
+
+        # describe: a key is written while it is read
+        race = DefaultsStore(path, window=0.05)
+        try:
+            mood = make_key("io.bithead.wordy", 1, "mood")
+            await race.set(mood, "old")
+            await race.flush()
+            race.cache.clear()
+            await asyncio.gather(race.get(mood), race.set(mood, "new"))
+            await asyncio.sleep(0.15)
+            assert await on_disk(mood) == "new"
+            assert await race.get(mood) == "new", "it: does not cache the older value it read"
+
+            # describe: a key is written while a flush is writing
+            started, release = asyncio.Event(), asyncio.Event()
+            write = race._write
+
+            async def slow_write(db, values):
+                started.set()
+                await release.wait()
+                await write(db, values)
+
+            race._write = slow_write
+            await race.set(mood, "calm")
+            await started.wait()
+            await race.set(theme, "night")
+            release.set()
+            await asyncio.sleep(0.2)
+            assert await on_disk(theme) == "night", "it: flushes it one window later"
+            assert race.get_stats().dirty == 0
+        finally:
+            await race.close()
+
+        # describe: the file cannot be opened
+        broken = DefaultsStore(str(tmp_path / "missing" / "boss.dbm"))
+        for _ in range(2):
+            with pytest.raises(OSError):
+                await broken.keys("io.bithead.wordy", 1)
+        assert broken.opening is None, "it: tries again on the next call"
+        (tmp_path / "missing").mkdir()
+        assert await broken.keys("io.bithead.wordy", 1) == []
+        await broken.close()
+
+    asyncio.run(run())
+
+
+def test_workspace(tmp_path):
+    path = str(tmp_path / "boss.dbm")
+    workspace.clear_workspaces()
+    wordy = AppLink(bundleId="io.bithead.wordy", name="Wordy", icon="icon.svg")
+    music = AppLink(bundleId="io.bithead.music", name="Music", icon="icon.svg")
+
+    async def run():
+        store = DefaultsStore(path)
+        # A record written before links were compact
+        await store.set("desktop/2", '{"desktop": [{"bundleId": "io.bithead.wordy", "name": "Wordy", "icon": "icon.svg"}], "dock": []}')
+
+        # describe: a user without a workspace
+        default = await workspace.get_workspace(store, 1)
+        assert default == workspace.default_workspace(), "it: is the default workspace"
+
+        # describe: adding and removing links
+        await workspace.add_link(store, 1, workspace.DOCK, music)
+        changed = await workspace.remove_link(store, 1, workspace.DESKTOP, "io.bithead.wordy")
+        assert [link.bundleId for link in changed.dock] == ["io.bithead.scheduler", "io.bithead.music"]
+        assert "io.bithead.wordy" not in [link.bundleId for link in changed.desktop]
+        assert len(default.dock) == 1, "it: does not change a workspace already handed out"
+        assert await workspace.get_workspace(store, 1) is changed, "it: keeps the workspace in memory"
+        renamed = await workspace.add_link(store, 1, workspace.DOCK, AppLink(bundleId="io.bithead.music", name="Tunes", icon="icon.svg"))
+        assert [link.name for link in renamed.dock] == ["Scheduler", "Tunes"], "it: replaces a link in place"
+
+        # describe: changes made at the same time
+        await asyncio.gather(*[
+            workspace.add_link(store, 3, workspace.DESKTOP, AppLink(bundleId=f"io.bithead.app{i}", name="App", icon="icon.svg"))
+            for i in range(5)
+        ])
+        assert len((await workspace.get_workspace(store, 3)).desktop) == 4 + 5, "it: loses none of them"
+
+        # describe: reading the records back
+        await store.close()
+        workspace.clear_workspaces()
+        store = DefaultsStore(path)
+        assert await store.get("desktop/1") == workspace.encode_workspace(renamed), "it: stores a compact record"
+        assert await workspace.get_workspace(store, 1) == renamed
+        assert (await workspace.get_workspace(store, 2)).desktop == [wordy], "it: reads the old records"
+        await store.close()
+
+    asyncio.run(run())
+    workspace.clear_workspaces()
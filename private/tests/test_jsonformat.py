@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+#
+# Tests the JSON Formatter, of small and large documents
+#
+
+import asyncio
+import httpx
+import json
+
+from fastapi import FastAPI
+from libtest import *
+from lib import workers
+from lib.jsonformat import format_text
+
+formatter = get_app_module("io.bithead.json-formatter")
+
+
+def test_format_text():
+    result = format_text('{"b": 1, "a": [1, 2]}')
+    assert result.text == json.dumps({"b": 1, "a": [1, 2]}, indent=4), "it: indents as it always has"
+    assert format_text('{"b": 1, "a": [1, 2]}', minify=True, sort_keys=True).text == '{"a":[1,2],"b":1}'
+    assert format_text(f'[{2 ** 70}]', minify=True).text == f'[{2 ** 70}]', "it: keeps large integers"
+    assert format_text('[NaN, 1.5]', minify=True).text == '[NaN,1.5]'
+
+    # describe: text that is not JSON
+    result = format_text('{\n  "a": 1,\n  "b": }')
+    assert result.text is None
+    assert (result.decodeLine, result.decodeColumn) == (3, 8), "it: says where"
+    assert "line 3 column 8" in result.decodeError
+
+
+def test_large_documents(monkeypatch):
+    monkeypatch.setattr(formatter, "inline_bytes", lambda: 16)
+    monkeypatch.setattr(formatter, "max_bytes", lambda: 64 * 1024)
+    monkeypatch.setattr(formatter, "CHUNK_SIZE", 1024)
+    document = {"rows": [{"id": i, "name": f"row {i}"} for i in range(500)]}
+    text = json.dumps(document)
+
+    app = FastAPI()
+    app.include_router(formatter.router)
+
+    async def call():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            formatted = await client.post("/api/io.bithead.json-formatter/", json={"text": text, "sortKeys": True})
+            streamed = await client.post("/api/io.bithead.json-formatter/stream?minify=true", content=text)
+            wrong = await client.post("/api/io.bithead.json-formatter/stream", content="[1, 2,]")
+            huge = await client.post("/api/io.bithead.json-formatter/stream", content="[" + "1," * 40000 + "1]")
+            return formatted, streamed, wrong, huge
+
+    try:
+        before = workers.get_process_stats().completed
+        formatted, streamed, wrong, huge = asyncio.run(call())
+        assert workers.get_process_stats().completed - before == 2, "it: formats large text in a process"
+    finally:
+        workers.shutdown_workers()
+
+    assert formatted.json()["text"] == json.dumps(document, indent=4, sort_keys=True)
+    assert streamed.status_code == 200
+    assert streamed.text == json.dumps(document, separators=(",", ":")), "it: streams the text as is"
+
+    # describe: text that is not JSON
+    assert wrong.status_code == 422
+    assert wrong.json()["detail"]["decodeColumn"] == 7
+
+    # describe: text that is too large
+    assert huge.status_code == 413
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+#
+# Tests queued, rate limited logging
+#
+
+import logging
+import threading
+
+from libtest import *
+from lib import logqueue
+from lib.logqueue import BoundedQueueHandler, RateLimitFilter
+
+
+class Collect(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+        self.threads = set()
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+        self.threads.add(threading.current_thread().name)
+
+
+def a_logger(name: str) -> logging.Logger:
+    logger = logging.getLogger(name)
+    logger.propagate = False
+    logger.handlers = []
+    logger.setLevel(logging.DEBUG)
+    return logger
+
+
+def test_queue():
+    logger = a_logger("test.queue")
+    collect = Collect()
+    logger.addHandler(collect)
+
+    # describe: records are queued
+    logqueue.install(logger, queued=True)
+    for i in range(100):
+        logger.info(f"line {i}")
+    logqueue.stop_logging()
+    assert collect.messages == [f"line {i}" for i in range(100)], "it: writes every record, in order, by shutdown"
+    assert threading.current_thread().name not in collect.threads, "it: writes on the listener thread"
+    assert logger.handlers == [collect], "it: writes later records directly"
+
+    # describe: the queue is full
+    newest = BoundedQueueHandler(2, "newest")
+    oldest = BoundedQueueHandler(2, "oldest")
+    for i in range(4):
+        record = logging.LogRecord("test", logging.INFO, __file__, 1, f"line {i}", None, None)
+        newest.enqueue(record)
+        oldest.enqueue(record)
+    assert [newest.queue.get().msg for _ in range(2)] == ["line 0", "line 1"], "it: drops the newest"
+    assert [oldest.queue.get().msg for _ in range(2)] == ["line 2", "line 3"], "it: drops the oldest"
+    assert newest.dropped == 2 and oldest.dropped == 2, "it: counts what it dropped"
+
+
+def test_rate_limit():
+    logger = a_logger("test.rate_limit")
+    collect = Collect()
+    other = Collect()
+    logger.addHandler(collect)
+    logger.addHandler(other)
+
+    # describe: a line logs faster than the limit
+    logqueue.install(logger, queued=False, rate=5, sampling={"test.rate_limit.sampled": 0})
+    for i in range(20):
+        logger.info("busy")
+    logger.warning("careful")
+    assert collect.messages == ["busy"] * 5 + ["careful"], "it: drops what is past the limit, but never a warning"
+    assert other.messages == collect.messages, "it: limits every handler alike"
+    assert logqueue.get_logging_stats().limited == 15, "it: counts what it dropped"
+
+    # describe: the line logs again after the limit refills
+    limit = RateLimitFilter(rate=1)
+    keep = lambda: limit.filter(logging.LogRecord("test", logging.INFO, __file__, 1, "busy", None, None))
+    assert keep()
+    assert not keep() and not keep()
+    limit.buckets[(__file__, 1)] = (1, limit.buckets[(__file__, 1)][1], 2)
+    record = logging.LogRecord("test", logging.INFO, __file__, 1, "busy", None, None)
+    assert limit.filter(record)
+    assert record.getMessage() == "busy (2 similar suppressed)", "it: says how many were dropped"
+
+    # describe: a logger is sampled
+    sampled = logging.getLogger("test.rate_limit.sampled")
+    sampled.info("noise")
+    assert "noise" not in collect.messages, "it: keeps its share of records"
+    assert logqueue.get_logging_stats().sampled == 1
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+#
+# Tests request metrics and their Prometheus export
+#
+
+import asyncio
+import httpx
+import logging
+import sqlite3
+
+from fastapi import APIRouter, FastAPI, Request
+from libtest import *
+from lib import metrics, server
+from lib.metrics import Histogram, MetricsMiddleware
+from lib.model import User
+from lib.server import require_user
+from test_server import fake_backend, users
+
+
+def test_histogram():
+    histogram = Histogram()
+    for _ in range(90):
+        histogram.observe(0.004)
+    for _ in range(10):
+        histogram.observe(0.2)
+
+    assert histogram.count == 100
+    assert 0.0025 < histogram.quantile(0.5) <= 0.005, "it: finds the bucket holding the median"
+    assert 0.1 < histogram.quantile(0.99) <= 0.25
+    assert Histogram().quantile(0.5) == 0.0
+
+
+def test_middleware():
+    fake_backend(users)
+    server.clear_session_cache()
+    metrics.reset()
+
+    router = APIRouter(prefix="/api/io.bithead.test")
+
+    @router.get("/item/{item_id}")
+    @require_user()
+    async def get_item(item_id: int, request: Request, boss_user: User):
+        return {"id": item_id}
+
+    app = FastAPI()
+    app.add_middleware(MetricsMiddleware)
+    app.include_router(router)
+    metrics.add_collector("session_cache", server.get_session_cache_stats)
+    hits = server.get_session_cache_stats().sessions.hits
+
+    async def call():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test",
+                                     cookies={"accessToken": "abc"}) as client:
+            for item_id in range(3):
+                await client.get(f"/api/io.bithead.test/item/{item_id}")
+            await client.get("/api/io.bithead.test/nothing")
+            for i in range(20):
+                await client.get(f"/api/scan{i}.x/")
+
+    asyncio.run(call())
+    text = metrics.render()
+
+    # describe: requests to a route
+    assert 'boss_http_requests_total{bundle="io.bithead.test",route="/api/io.bithead.test/item/{item_id}",method="GET",status="200"} 3' in text, "it: labels by route, not path"
+    assert 'boss_http_auth_duration_seconds_count{bundle="io.bithead.test",route="/api/io.bithead.test/item/{item_id}",method="GET"} 3' in text, "it: times authentication"
+    assert 'boss_http_handler_duration_seconds_count{bundle="io.bithead.test",route="/api/io.bithead.test/item/{item_id}",method="GET"} 3' in text
+    assert 'quantile="0.99"' in text
+
+    # describe: a request that matches no route
+    assert 'route="unmatched",method="GET",status="404"} 1' in text, "it: does not label by path"
+
+    # describe: a request to an app that is not mounted
+    assert 'bundle="unmatched",route="unmatched",method="GET",status="404"} 20' in text, "it: does not label by bundle"
+    assert "scan" not in text
+
+    # describe: collectors
+    assert f"boss_session_cache_sessions_hits {hits + 2}" in text, "it: exports their numbers"
+    metrics.COLLECTORS.pop("session_cache")
+    server.clear_session_cache()
+
+
+def test_sql(caplog):
+    metrics.reset()
+    metrics.enable_sql_metrics(True, slow_ms=0)
+
+    router = APIRouter(prefix="/api/io.bithead.test")
+    connect = metrics.instrumented_connection("io.bithead.test")
+
+    @router.get("/items")
+    def get_items():
+        conn = sqlite3.connect(":memory:", factory=connect)
+        try:
+            conn.execute("CREATE TABLE items (id INTEGER)")
+            for item_id in range(3):
+                conn.execute("INSERT INTO items (id) VALUES (?)", (item_id,))
+            return [row[0] for row in conn.execute("SELECT id FROM items")]
+        finally:
+            conn.close()
+
+    app = FastAPI()
+    app.add_middleware(MetricsMiddleware)
+    app.include_router(router)
+
+    async def call():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            return await client.get("/api/io.bithead.test/items")
+
+    with caplog.at_level(logging.WARNING):
+        assert asyncio.run(call()).json() == [0, 1, 2]
+    metrics.enable_sql_metrics(False)
+    text = metrics.render()
+
+    # describe: a request running statements
+    assert 'boss_http_queries_per_request_sum{bundle="io.bithead.test",route="/api/io.bithead.test/items",method="GET"} 5' in text, "it: counts them against the route"
+    assert 'boss_sql_statement_duration_seconds_count{bundle="io.bithead.test",statement="INSERT INTO items (id) VALUES (?)"} 3' in text, "it: times each statement"
+    assert 'boss_sql_statement_rows_total{bundle="io.bithead.test",statement="INSERT INTO items (id) VALUES (?)"} 3' in text, "it: counts changed rows"
+    assert "Slow query" in caplog.text, "it: logs statements over the threshold"
+
+    # describe: statement timing is off
+    metrics.reset()
+    with metrics.statement("io.bithead.test", "SELECT 1") as stmt:
+        stmt.rows = 1
+    assert not metrics.STATEMENT_LATENCY, "it: records nothing"
+
+
+def test_scrape(monkeypatch):
+    app = FastAPI()
+
+    @app.get("/api/metrics")
+    async def get_metrics(request: Request):
+        return {"allowed": metrics.is_scrape_allowed(request)}
+
+    async def call(headers={}, client=("127.0.0.1", 123)):
+        transport = httpx.ASGITransport(app=app, client=client)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return (await client.get("/api/metrics", headers=headers)).json()["allowed"]
+
+    options = {}
+    monkeypatch.setattr(metrics, "get_option", lambda key, default=None: options.get(key, default))
+
+    # describe: no token
+    assert asyncio.run(call()), "it: allows a scrape from this host"
+    assert not asyncio.run(call(headers={"X-Forwarded-For": "10.0.0.1"})), "it: does not allow one through a proxy"
+    assert not asyncio.run(call(headers={"X-Real-IP": "10.0.0.1"}))
+    assert not asyncio.run(call(client=("10.0.0.1", 123))), "it: does not allow one from another host"
+
+    # describe: a token
+    options["metrics_token"] = "secret"
+    assert not asyncio.run(call()), "it: requires the token, even from this host"
+    assert not asyncio.run(call(headers={"Authorization": "Bearer wrong"}))
+    assert asyncio.run(call(headers={"Authorization": "Bearer secret"}, client=("10.0.0.1", 123))), "it: allows a scrape with the token"
@@ -16,7 +16,10 @@
 # The single exception is the pair of time-travel helpers below.
 #
 
+import asyncio
 import pytest
+import threading
+import time
 
 from lib import configure_logging
 from libtest import *
@@ -1042,6 +1045,42 @@ def test_routes_are_wired():
         f"it: all {len(routes)} routes answer rather than erroring"
 
 
+def test_writes_are_one_at_a_time():
+    fresh_database()
+    production = get_app_module("io.bithead.production")
+
+    lock = threading.Lock()
+    running = [0, 0]
+
+    def write(name):
+        with lock:
+            running[0] += 1
+            running[1] = max(running)
+        save_pool(ADMIN, None, name)
+        time.sleep(0.02)
+        with lock:
+            running[0] -= 1
+
+    async def write_at_once():
+        await asyncio.gather(*(production._write(write, f"Pool {i}") for i in range(4)))
+
+    asyncio.run(write_at_once())
+    # A design edit and a job starting (which freezes the version) must not
+    # interleave, and neither may a tap and either of them. The write lock is
+    # SQLite's, so this holds across worker processes too.
+    assert running[1] == 1, "it: runs rules that write one at a time, off the loop"
+    assert len(list_pools()) == 4
+
+    # describe: a rule that fails part way
+    def save_then_fail():
+        save_pool(ADMIN, None, "Half done")
+        raise ValidationError("Refused")
+
+    with pytest.raises(ValidationError):
+        asyncio.run(production._write(save_then_fail))
+    assert "Half done" not in [pool.name for pool in list_pools()], "it: writes nothing"
+
+
 def test_a_failure_names_who_failed_it():
     """A failed unit says who failed it, not who last completed a step.
 
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+#
+# Tests fast JSON responses
+#
+
+import asyncio
+import httpx
+import json
+
+from datetime import datetime
+from fastapi import APIRouter, FastAPI
+from fastapi.responses import PlainTextResponse
+from libtest import *
+from lib import responses
+from lib.responses import dumps, fast_json
+from pydantic import BaseModel
+from typing import Dict, List, Optional
+
+
+class Unit(BaseModel):
+    id: int
+    label: str
+    input: Dict[str, str]
+    startedAt: Optional[str]
+
+
+class Board(BaseModel):
+    name: str
+    units: List[Unit]
+
+
+def a_unit(i: int) -> Unit:
+    return Unit(id=i, label=f"SN-{i}", input={"serial": f"SN-{i}", "note": "ünïcode"}, startedAt=None)
+
+
+def test_dumps():
+    units = [a_unit(i) for i in range(3)]
+
+    # describe: models
+    assert json.loads(dumps(units)) == [unit.model_dump() for unit in units], "it: serializes a list of models"
+    assert json.loads(dumps(Board(name="b", units=units))) == Board(name="b", units=units).model_dump()
+
+    # describe: other data
+    data = {1: units[0], "at": datetime(2025, 1, 2, 3, 4, 5)}
+    expected = {"1": units[0].model_dump(), "at": "2025-01-02T03:04:05"}
+    assert json.loads(dumps(data)) == expected, "it: serializes models, dates and int keys inside it"
+    encoder = responses.orjson
+    responses.orjson = None
+    try:
+        assert json.loads(dumps(data)) == expected, "it: falls back to json"
+    finally:
+        responses.orjson = encoder
+
+
+def test_fast_json():
+    router = APIRouter()
+
+    @router.get("/default", response_model=List[Unit])
+    async def get_default():
+        return [a_unit(i) for i in range(3)]
+
+    @router.get("/fast", response_model=List[Unit])
+    @fast_json
+    async def get_fast():
+        return [a_unit(i) for i in range(3)]
+
+    @router.get("/fast-sync", response_model=Board)
+    @fast_json
+    def get_fast_sync(name: str):
+        return Board(name=name, units=[a_unit(1)])
+
+    @router.get("/own", response_model=List[Unit])
+    @fast_json
+    async def get_own():
+        return PlainTextResponse("mine")
+
+    app = FastAPI()
+    app.include_router(router)
+
+    async def call():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            return [await client.get(path) for path in ("/default", "/fast", "/fast-sync?name=b", "/own")]
+
+    default, fast, fast_sync, own = asyncio.run(call())
+    assert fast.json() == default.json(), "it: returns what the default path returns"
+    assert fast.headers["content-type"] == "application/json"
+    assert fast_sync.json() == {"name": "b", "units": [a_unit(1).model_dump()]}, "it: keeps sync routes' parameters"
+    assert own.text == "mine", "it: returns a route's own response as is"
+    schema = app.openapi()["paths"]["/fast"]["get"]["responses"]["200"]["content"]["application/json"]["schema"]
+    assert schema["items"]["$ref"].endswith("/Unit"), "it: documents the response model"
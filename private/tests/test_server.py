@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+#
+# Tests the calls every app makes to the Swift backend
+#
+# The backend is replaced by an `httpx.MockTransport`, so these run without a
+# server on :8081. Each test counts what reached the "backend", because that
+# traffic is what the helpers exist to keep down.
+#
+
+import asyncio
+import gc
+import httpx
+import json
+import pytest
+import threading
+
+from fastapi import HTTPException
+from libtest import *
+from lib import server
+from lib.cache import SingleFlight
+from lib.outbox import Outbox
+from starlette.requests import Request
+
+ADMIN = {"id": 1, "system": 0, "fullName": "Ada Admin", "email": "ada@example.com",
+         "verified": True, "enabled": True}
+
+
+def a_request(cookie="accessToken=abc"):
+    """A request as a signed-in browser sends it."""
+    headers = [(b"cookie", cookie.encode())] if cookie else []
+    return Request({"type": "http", "method": "GET", "path": "/", "headers": headers})
+
+
+def fake_backend(handler):
+    """Point every helper at `handler` through a fresh pooled client.
+
+    Returns the list of requests the backend received.
+    """
+    received = []
+
+    def record(request):
+        received.append(request)
+        return handler(request)
+
+    asyncio.run(server.close_backend_client())
+    server.BACKEND_CLIENT = None
+    server.open_backend_client(transport=httpx.MockTransport(record))
+    return received
+
+
+def users(request):
+    if request.url.path in ("/account/user", "/private/acl/verify"):
+        return httpx.Response(200, json={"user": ADMIN})
+    if request.url.path == "/friend":
+        return httpx.Response(200, json={"friends": [{"id": 1, "userId": 2, "name": "Sam"}]})
+    if request.url.path == "/account/users/details":
+        return httpx.Response(200, json={"users": [ADMIN]})
+    return httpx.Response(200, json={})
+
+
+def test_backend_client():
+    received = fake_backend(users)
+
+    async def calls():
+        before = server.get_backend_client_stats()
+        user = await server.get_user(a_request())
+        user_again, friends = await server.get_friends(a_request())
+        await server.send_events(a_request(), "io.bithead.test", {"a": "b"}, [2])
+        return before, user, user_again, friends, server.get_backend_client_stats()
+
+    before, user, user_again, friends, after = asyncio.run(calls())
+
+    # describe: several helpers in one request
+    assert user.fullName == "Ada Admin"
+    assert friends[0].name == "Sam"
+    assert [r.url.path for r in received][-1] == "/private/send/events"
+    assert after.requests - before.requests == len(received), "it: counts every call"
+    assert after.inFlight == 0, "it: takes finished calls out of flight"
+    assert received[0].headers["cookie"] == "accessToken=abc", "it: forwards the caller's cookie"
+
+    # describe: the backend is down
+    def down(request):
+        raise httpx.ConnectError("refused", request=request)
+    fake_backend(down)
+    errors = server.get_backend_client_stats().errors
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(server.get_user(a_request()))
+    assert exc.value.status_code == 500
+    assert server.get_backend_client_stats().errors == errors + 1, "it: counts the failure"
+    assert server.get_backend_client_stats().inFlight == 0
+
+
+def test_backend_client_loops():
+    fake_backend(users)
+    asyncio.run(server.close_backend_client())
+
+    async def client():
+        return server.get_backend_client()
+
+    # describe: the loop that opened the client has stopped
+    discarded = server.get_backend_client_stats().clientsDiscarded
+    first = asyncio.run(client())
+    second = asyncio.run(client())
+    assert second is not first, "it: opens a client for the new loop"
+    assert server.get_backend_client_stats().clientsDiscarded == discarded + 1, "it: counts the discard"
+
+    # describe: the loop that opened the client is still running
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever)
+    thread.start()
+    try:
+        other = asyncio.run_coroutine_threadsafe(client(), loop).result()
+        asyncio.run(client())
+        asyncio.run_coroutine_threadsafe(asyncio.sleep(0.05), loop).result()
+        assert other.is_closed, "it: closes the old client on its loop"
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+    assert server.get_backend_client_stats().clientsDiscarded == discarded + 3
+    asyncio.run(server.close_backend_client())
+
+
+def test_session_cache():
+    received = fake_backend(users)
+    server.clear_session_cache()
+
+    async def twice(request):
+        first = await server._authenticate_user(request)
+        second = await server._authenticate_user(request)
+        return first, second
+
+    # describe: a signed-in session
+    first, second = asyncio.run(twice(a_request()))
+    assert first == second
+    assert len(received) == 1, "it: asks the backend once"
+    second.fullName = "Changed"
+    assert asyncio.run(server._authenticate_user(a_request())).fullName == "Ada Admin", "it: hands out copies"
+
+    # describe: a different ACL check for the same session
+    asyncio.run(server._authenticate_user(a_request(), "io.bithead.test", None))
+    assert len(received) == 2, "it: is cached separately"
+
+    # describe: the user is invalidated
+    server.invalidate_user(1)
+    asyncio.run(server._authenticate_user(a_request()))
+    assert len(received) == 3, "it: asks the backend again"
+
+    # describe: a rejected session
+    def rejected(request):
+        return httpx.Response(401, json={"error": {"message": "Signed out"}})
+    received = fake_backend(rejected)
+    for _ in range(3):
+        with pytest.raises(HTTPException) as exc:
+            asyncio.run(server._authenticate_user(a_request("accessToken=old")))
+        assert exc.value.status_code == 401
+    assert len(received) == 1, "it: remembers the rejection"
+    server.invalidate_session(a_request("accessToken=old"))
+    with pytest.raises(HTTPException):
+        asyncio.run(server._authenticate_user(a_request("accessToken=old")))
+    assert len(received) == 2, "it: forgets the rejection when invalidated"
+
+    stats = server.get_session_cache_stats()
+    assert stats.sessions.hits >= 2
+    assert stats.denied.hits == 2
+    server.clear_session_cache()
+
+
+def test_single_flight():
+    received = fake_backend(users)
+
+    async def burst():
+        before = server.get_lookup_stats()
+        results = await asyncio.gather(
+            *[server.get_user(a_request()) for _ in range(5)],
+            server.get_user(a_request("accessToken=other")),
+            *[server.get_friends(a_request()) for _ in range(3)],
+        )
+        return before, results, server.get_lookup_stats()
+
+    before, results, after = asyncio.run(burst())
+
+    # describe: a burst of the same lookups
+    paths = [r.url.path for r in received]
+    assert paths.count("/account/user") == 2, "it: asks once per cookie"
+    assert paths.count("/friend") == 1
+    assert all(user.fullName == "Ada Admin" for user in results[:6]), "it: gives every caller the result"
+    # get_friends authenticates too, so joins the five get_user calls
+    assert after.collapsed - before.collapsed == 7 + 2
+    assert after.inFlight == 0, "it: keeps nothing once the call is done"
+
+    # describe: a failed lookup
+    def down(request):
+        raise httpx.ConnectError("refused", request=request)
+    received = fake_backend(down)
+
+    async def failing():
+        return await asyncio.gather(*[server.get_user(a_request()) for _ in range(3)], return_exceptions=True)
+
+    errors = asyncio.run(failing())
+    assert len(received) == 1
+    assert all(isinstance(e, HTTPException) and e.status_code == 500 for e in errors), "it: gives every caller the error"
+
+    # describe: every caller is cancelled, then the call fails
+    flights = SingleFlight()
+    unhandled = []
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise ValueError("no")
+
+    async def abandoned():
+        asyncio.get_running_loop().set_exception_handler(lambda loop, context: unhandled.append(context))
+        waiter = asyncio.ensure_future(flights.do("key", fail))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.sleep(0.05)
+        gc.collect()
+
+    asyncio.run(abandoned())
+    assert unhandled == [], "it: does not leave the exception unretrieved"
+
+
+def test_outbox():
+    received = fake_backend(users)
+
+    async def queue():
+        before = server.get_outbox_stats()
+        server.queue_events(a_request(), "io.bithead.test", {"a": "1"}, [2, 3])
+        server.queue_events(a_request(), "io.bithead.test", {"a": "2"}, [2])
+        server.queue_events(a_request("accessToken=other"), "io.bithead.test", {"a": "3"}, [4])
+        server.queue_notifications(a_request(), [2], title="Hi")
+        queued = len(received)
+        await server.close_outbox()
+        return before, queued, server.get_outbox_stats()
+
+    before, queued, after = asyncio.run(queue())
+
+    # describe: events queued by a route
+    assert queued == 0, "it: returns before anything is sent"
+    paths = [r.url.path for r in received]
+    assert paths.count("/private/send/events") == 2, "it: sends one batch per caller"
+    assert paths.count("/private/send/notifications") == 1
+    batch = [r for r in received if r.headers["cookie"] == "accessToken=abc" and r.url.path.endswith("events")][0]
+    assert [e["data"]["a"] for e in json.loads(batch.content)["events"]] == ["1", "1", "2"], "it: keeps the order"
+    assert after.sent - before.sent == 5
+    assert after.depth == 0
+
+    # describe: the backend is briefly down
+    calls = []
+    async def flaky(kind, headers, items):
+        calls.append(items)
+        if len(calls) == 1:
+            raise httpx.ConnectError("refused")
+    outbox = Outbox(flaky, backoff=0)
+    asyncio.run(_put_and_close(outbox, 1))
+    assert calls == [[1], [1]], "it: retries"
+    assert outbox.stats().sent == 1
+
+    # describe: the backend refuses
+    async def refuse(kind, headers, items):
+        raise httpx.HTTPStatusError("bad", request=None, response=httpx.Response(400))
+    outbox = Outbox(refuse, backoff=0)
+    asyncio.run(_put_and_close(outbox, 1))
+    assert outbox.stats().failed == 1, "it: does not retry"
+    assert outbox.stats().batches == 1
+
+    # describe: the outbox is full
+    calls = []
+    async def accept(kind, headers, items):
+        calls.append(items)
+    outbox = Outbox(accept, max_size=2)
+    asyncio.run(_put_and_close(outbox, 1, 2, 3))
+    assert outbox.stats().dropped == 1
+    assert calls == [[2, 3]], "it: drops the oldest"
+
+
+async def _put_and_close(outbox, *items):
+    for item in items:
+        outbox.put("events", {}, item)
+    await outbox.close()
+
+
+def test_user_directory():
+    directory = {"users": [ADMIN, {**ADMIN, "id": 2, "fullName": "Sam"}]}
+    received = fake_backend(lambda request: httpx.Response(200, json=directory))
+    server.clear_user_directory()
+
+    # describe: a user who is not the super user loads it first
+    pat = {**ADMIN, "id": 3, "fullName": "Pat"}
+    everyone = directory["users"]
+    directory["users"] = [pat]
+    asyncio.run(server.refresh_user_directory(a_request("accessToken=pat")))
+    assert server.get_user_directory_stats().ageSeconds is None, "it: is not fresh"
+    directory["users"] = everyone
+
+    # describe: the first lookup
+    names = asyncio.run(server.resolve_names(a_request()))
+    assert names == {1: "Ada Admin", 2: "Sam"}
+    assert len(received) == 2, "it: lists everyone"
+
+    # describe: a fresh directory
+    asyncio.run(server.resolve_names(a_request()))
+    assert len(received) == 2, "it: does not ask the backend"
+
+    # describe: a stale directory
+    directory["users"][1]["fullName"] = "Samantha"
+    server.USER_DIRECTORY.refreshed_at -= server.USER_DIRECTORY.refresh_interval + 1
+
+    async def stale():
+        names = await server.resolve_names(a_request())
+        await server.USER_DIRECTORY.refreshing
+        return names, await server.resolve_names(a_request())
+
+    names, refreshed = asyncio.run(stale())
+    assert names[2] == "Sam", "it: answers with what it has"
+    assert refreshed[2] == "Samantha", "it: refreshes in the background"
+    assert len(received) == 3
+
+    # describe: a user who is not the super user refreshes
+    directory["users"] = [pat]
+    age = server.get_user_directory_stats().ageSeconds
+    asyncio.run(server.refresh_user_directory(a_request("accessToken=pat")))
+    assert server.get_user_directory_stats().ageSeconds >= age, "it: does not make it fresh"
+    assert asyncio.run(server.resolve_names(a_request())) == {1: "Ada Admin", 2: "Samantha", 3: "Pat"}, "it: merges what they can see"
+
+    # describe: the backend is down
+    def down(request):
+        raise httpx.ConnectError("refused", request=request)
+    fake_backend(down)
+    server.USER_DIRECTORY.refreshed_at -= server.USER_DIRECTORY.max_stale + 1
+    failures = server.get_user_directory_stats().failures
+    assert len(asyncio.run(server.resolve_names(a_request()))) == 3, "it: answers with what it has"
+    assert server.get_user_directory_stats().failures == failures + 1
+    server.clear_user_directory()
+
+
+def test_heartbeat():
+    security = [True]
+
+    def heartbeat(request):
+        if request.url.path == "/heartbeat":
+            signed_in = request.headers.get("cookie") == "accessToken=abc"
+            return httpx.Response(200, json={"isSignedIn": signed_in, "isSecurityEnabled": security[0]})
+        return users(request)
+
+    received = fake_backend(heartbeat)
+    boss = get_app_module("io.bithead.boss")
+    boss.heartbeats().clear()
+
+    async def poll():
+        return await asyncio.gather(
+            *[boss.get_heartbeat(a_request()) for _ in range(5)],
+            *[boss.get_heartbeat(a_request(None)) for _ in range(5)],
+        )
+
+    results = asyncio.run(poll())
+
+    # describe: every desktop polls at once
+    assert len(received) == 2, "it: asks once per session"
+    assert [info.isSignedIn for info in results] == [True] * 5 + [False] * 5
+    assert results[0].isSecurityEnabled
+
+    # describe: polling again
+    asyncio.run(poll())
+    assert len(received) == 2, "it: answers from the cache"
+
+    # describe: the backend's state expires
+    security[0] = False
+    boss.heartbeats().pop(boss.SERVER_STATE)
+    results = asyncio.run(poll())
+    assert len(received) == 3, "it: refreshes it with one probe for every session"
+    assert [info.isSignedIn for info in results] == [True] * 5 + [False] * 5, "it: keeps each session's answer"
+    assert not any(info.isSecurityEnabled for info in results), "it: shares the backend's state with every session"
+    boss.heartbeats().clear()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+#
+# Tests starting apps concurrently and on their first request
+#
+
+import asyncio
+import pytest
+import threading
+import time
+
+from fastapi import HTTPException
+from libtest import *
+from lib import metrics, startup
+
+
+def test_start_apps():
+    # describe: apps start
+    started = []
+
+    def slow(name):
+        def start():
+            time.sleep(0.1)
+            started.append(name)
+        return start
+
+    began = time.perf_counter()
+    startup.start_apps({"test.one": slow("one"), "test.two": slow("two"), "test.three": slow("three")})
+    assert sorted(started) == ["one", "three", "two"]
+    assert time.perf_counter() - began < 0.25, "it: starts them at the same time"
+    assert ("test.one", startup.START) in metrics.BOOT_SECONDS, "it: records how long each took"
+
+    # describe: an app fails to start
+    def fail():
+        raise ValueError("Bad schema")
+
+    started.clear()
+    with pytest.raises(ValueError):
+        startup.start_apps({"test.fail": fail, "test.four": slow("four")})
+    assert started == ["four"], "it: still starts the others"
+    report = {boot.bundleId: boot for boot in startup.get_boot_report()}
+    assert report["test.fail"].error == "Bad schema", "it: reports the failure"
+
+
+def test_lazy_start():
+    calls = []
+    attempts = []
+    lock = threading.Lock()
+
+    def start():
+        with lock:
+            attempts.append(1)
+        time.sleep(0.05)
+        if len(attempts) == 1:
+            raise ValueError("Not yet")
+        calls.append(1)
+
+    lazy = startup.LazyStart("test.lazy", start)
+    assert startup.BOOT["test.lazy"].lazy, "it: is reported as lazy"
+    assert calls == [], "it: does not start at boot"
+
+    async def first_requests():
+        return await asyncio.gather(*[lazy() for _ in range(4)], return_exceptions=True)
+
+    # describe: first requests and the start fails
+    results = asyncio.run(first_requests())
+    refused = [result for result in results if isinstance(result, HTTPException)]
+    assert [error.status_code for error in refused] == [503], "it: refuses the request that started it"
+
+    # describe: later requests
+    results = asyncio.run(first_requests())
+    assert all(result is None for result in results)
+    assert calls == [1], "it: is tried again, and started once"
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+#
+# Tests state shared by every worker process
+#
+
+import multiprocessing
+import pytest
+import time
+
+from libtest import *
+from lib import database
+from lib.state import BOOT_ID_ENV, MemoryState, SharedState, SQLiteState, WORKERS_ENV, shared_state, worker_slot
+from pydantic import BaseModel
+
+
+class Counter(BaseModel):
+    name: str
+    count: int
+
+
+def _claim(path: str) -> bool:
+    return SQLiteState(path, "boot").claim("acl-registration")
+
+
+def test_shared_state(tmp_path, monkeypatch):
+    path = str(tmp_path / "state.sqlite3")
+
+    # describe: one worker
+    monkeypatch.delenv(WORKERS_ENV, raising=False)
+    assert isinstance(shared_state("test.memory"), MemoryState), "it: keeps state in memory"
+
+    # describe: several workers
+    monkeypatch.setenv(WORKERS_ENV, "4")
+    monkeypatch.setattr("lib.state.get_state_db_path", lambda: path)
+    assert isinstance(shared_state("test.sqlite"), SQLiteState), "it: keeps state in SQLite"
+
+    # describe: a value is set by one worker
+    one = SQLiteState(path, "test.counters", model=Counter)
+    other = SQLiteState(path, "test.counters", model=Counter)
+    one[1] = Counter(name="a", count=1)
+    assert other.get(1) == Counter(name="a", count=1), "it: is seen by another"
+    assert SQLiteState(path, "test.other").get(1) is None, "it: is not seen in another namespace"
+    assert other.pop(1) == Counter(name="a", count=1)
+    assert one.get(1) is None, "it: is removed for every worker"
+
+    # describe: a value expires
+    expiring = SQLiteState(path, "test.expiring", ttl=0.05)
+    expiring["a"] = {"rows": [1, 2]}
+    assert expiring.get("a") == {"rows": [1, 2]}
+    time.sleep(0.1)
+    assert expiring.get("a", "gone") == "gone", "it: is no longer returned"
+
+    database.close(path)
+
+    # describe: several workers claim the same key
+    with multiprocessing.get_context("spawn").Pool(4) as pool:
+        claims = pool.map(_claim, [path] * 8)
+    assert claims.count(True) == 1, "it: is claimed by exactly one"
+
+    # describe: workers name themselves
+    monkeypatch.setenv(WORKERS_ENV, "2")
+    monkeypatch.setenv(BOOT_ID_ENV, "first")
+    assert [worker_slot(), worker_slot()] == ["0", "1"], "it: gives each a number"
+    assert worker_slot().startswith("pid"), "it: names one past the last number by its process"
+    monkeypatch.setenv(BOOT_ID_ENV, "second")
+    assert worker_slot() == "0", "it: numbers them again on the next start"
+
+    # describe: a state that does not implement every method
+    class Partial(SharedState):
+        def get(self, key, default=None):
+            return default
+
+    with pytest.raises(TypeError):
+        Partial()
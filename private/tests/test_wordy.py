@@ -354,3 +354,294 @@ def test_solver():
     # describe: only missed matches
     words = get_possible_words([None, None, None, None, None], [], ["r", "c", "h"])
     assert sorted(words) == ["bigot", "bland", "boned", "fails", "foist", "lovel", "milky", "moist", "plant", "twist"]
+
+def test_word_index():
+    from io.bithead.wordy.index import WordIndex
+    import random
+
+    words = sorted(["bigot", "biter", "bland", "boned", "fails", "foist", "forty", "hello", "lovel", "milky",
+                    "moist", "moral", "piper", "plant", "porch", "sorta", "store", "torch", "twist", "whist"])
+    packed = "".join(words).encode("ascii")
+    indexes = [WordIndex(packed, 5, use_numpy=False)]
+    if WordIndex(packed, 5).array is not None:
+        indexes.append(WordIndex(packed, 5))
+
+    def brute_force(hits, found, misses):
+        return [
+            word for word in words
+            if all(h is None or word[i] == h for i, h in enumerate(hits))
+            and all(f in word for f in found)
+            and not any(m in word for m in misses)
+        ]
+
+    for index in indexes:
+        # describe: filter by hits, found, and misses
+        assert index.match([None, "o", "r", None, None], ["t"], ["c", "h"]) == ["forty", "sorta"]
+        assert index.match([None, "o", "r", None, None], [], []) == ["forty", "moral", "porch", "sorta", "torch"]
+        assert index.match([None] * 5, ["b", "n"], []) == ["bland", "boned"]
+        assert index.match([None] * 5, [], ["z"]) == words, "it: returns every word in order"
+        assert index.match(["q", None, None, None, None], [], []) == [], "it: knows no word starting with q"
+
+        # describe: any query
+        rng = random.Random(7)
+        for _ in range(200):
+            hits = [rng.choice("abilmnoprst") if rng.random() < 0.2 else None for _ in range(5)]
+            found = rng.sample("abilmnoprst", rng.randint(0, 2))
+            misses = rng.sample("cdefghkuwy", rng.randint(0, 3))
+            assert index.match(hits, found, misses) == brute_force(hits, found, misses), "it: matches the SQL it replaces"
+
+def test_guess_ranking(monkeypatch):
+    from io.bithead.wordy.index import WordIndex
+    from io.bithead.wordy.patterns import pattern, pattern_matrix
+    from io.bithead.wordy.solver import Ranker
+
+    def marks(guess, answer):
+        # 0 miss, 1 found, 2 hit, as `pattern` encodes them
+        value = pattern(guess.encode("ascii"), answer.encode("ascii"))
+        return "".join("-f*"[value // 3 ** i % 3] for i in range(5))
+
+    # describe: marking a guess
+    assert marks("torch", "forty") == "f**--"
+    assert marks("speed", "abide") == "--f-f", "it: finds a repeated letter once"
+    assert marks("eerie", "there") == "f-f-*", "it: hits before it finds"
+    assert marks("moist", "moist") == "*****"
+
+    words = sorted(["bigot", "biter", "bland", "boned", "fails", "foist", "forty", "hello", "lovel", "milky",
+                    "moist", "moral", "piper", "plant", "porch", "sorta", "store", "torch", "twist", "whist"])
+    packed = "".join(words).encode("ascii")
+    rankers = [Ranker(WordIndex(packed, 5, use_numpy=False))]
+    if WordIndex(packed, 5).array is not None:
+        rankers.append(Ranker(WordIndex(packed, 5)))
+        # describe: every pattern at once
+        array = rankers[-1].index.array
+        matrix = pattern_matrix(array, array)
+        assert matrix.tolist() == [[pattern(g, a) for a in rankers[0].words] for g in rankers[0].words], \
+            "it: marks as one guess at a time does"
+
+    everything = list(range(len(words)))
+    for ranker in rankers:
+        # describe: rank against every word
+        ranked = ranker.rank(everything, 5, budget=10)
+        assert len(ranked) == 5
+        assert ranked == sorted(ranked, key=lambda r: -r.score), "it: ranks the best first"
+        assert ranked == rankers[0].rank(everything, 5, budget=10), "it: ranks as the other implementation does"
+
+        # describe: two words left
+        ranked = ranker.rank([words.index("forty"), words.index("sorta")], 3, budget=10)
+        assert ranked[0].is_candidate and ranked[0].score == 1.0, "it: guesses one that may be the answer"
+
+        # describe: no time to rank
+        assert len(ranker.rank(everything, 3, budget=0)) == 3, "it: still ranks `top` guesses"
+
+    # describe: solve with a ranking
+    monkeypatch.setattr(db, "INDEX", rankers[-1].index)
+    words_left, num_words, ranked = rank_guesses([None, "o", "r", None, None], ["t"], ["c", "h"], top=3)
+    assert words_left == ["forty", "sorta"]
+    assert num_words == 2
+    assert [r.isCandidate for r in ranked][0]
+
+    # describe: a hint that is not one letter
+    for hint in ["", "ab", None, 1]:
+        with pytest.raises(WordyError):
+            rank_guesses([None] * 5, [hint], [], top=3)
+        with pytest.raises(WordyError):
+            rank_guesses([None] * 5, [], [hint], top=3)
+    with pytest.raises(WordyError, match="Hit characters"):
+        rank_guesses([None, "ab", None, None, None], [], [], top=3)
+
+    # describe: empty board
+    words_left, num_words, ranked = rank_guesses([None] * 5, [], [], top=3)
+    assert words_left == [], "it: does not return every word"
+    assert num_words == len(words)
+    assert len(ranked) == 3
+    assert rank_guesses([None] * 5, [], [], top=2)[2] == ranked[:2], "it: ranks the first guess once"
+    assert get_ranker().first_guesses is not None
+
+    monkeypatch.setattr(db, "INDEX", WordIndex(packed, 5, use_numpy=False))
+    assert get_ranker().first_guesses is None, "it: ranks again when the words change"
+
+def test_numpy_matches_python():
+    # NumPy is in requirements.txt so that these paths run. Without it, Wordy
+    # falls back to Python and this test is skipped.
+    pytest.importorskip("numpy")
+    from io.bithead.wordy.index import WordIndex
+    from io.bithead.wordy.solver import Ranker
+
+    words = sorted(["bigot", "biter", "bland", "boned", "fails", "foist", "forty", "hello", "lovel", "milky",
+                    "moist", "moral", "piper", "plant", "porch", "sorta", "store", "torch", "twist", "whist"])
+    packed = "".join(words).encode("ascii")
+    python = WordIndex(packed, 5, use_numpy=False)
+    array = WordIndex(packed, 5)
+
+    # describe: an index with NumPy
+    assert python.array is None
+    assert array.array is not None, "it: uses NumPy when it is installed"
+    for letter, contains in array.contains_array.items():
+        assert contains.nonzero()[0].tolist() == python._indices(python.contains[letter]), \
+            "it: knows which words contain each letter"
+    assert array._match_array([None, "o", "r", None, None], ["t"], ["c", "h"]) == \
+        python.indices([None, "o", "r", None, None], ["t"], ["c", "h"])
+
+    # describe: score guesses with NumPy
+    candidates = [words.index(word) for word in ["forty", "moral", "porch", "sorta", "torch"]]
+    expected = dict(Ranker(python)._score(candidates, len(words), deadline=float("inf")))
+    scored = dict(Ranker(array)._score_array(candidates, len(words), deadline=float("inf")))
+    assert scored.keys() == expected.keys(), "it: scores every guess"
+    for guess, score in scored.items():
+        assert score == pytest.approx(expected[guess], abs=1e-9), "it: scores as Python does"
+
+def test_pattern_table(monkeypatch, tmp_path):
+    from io.bithead.wordy.index import WordIndex
+    from io.bithead.wordy.patterns import build_table, digits, open_table, pattern
+    from io.bithead.wordy.solver import Ranker
+
+    words = sorted(["bigot", "biter", "bland", "boned", "eerie", "fails", "foist", "forty", "hello", "lovel",
+                    "milky", "moist", "moral", "piper", "plant", "porch", "sorta", "store", "there", "torch"])
+    packed = "".join(words).encode("ascii")
+    split = [word.encode("ascii") for word in words]
+    path = str(tmp_path / "wordy.patterns")
+
+    # describe: no table
+    assert open_table(path, packed, 5) is None
+
+    for use_numpy in (False, True):
+        # describe: build a table
+        build_table(packed, 5, path, use_numpy=use_numpy)
+        table = open_table(path, packed, 5)
+        assert table is not None
+        for g, guess in enumerate(split):
+            assert bytes(table.row(g)) == bytes(pattern(guess, answer) for answer in split), "it: has every pattern"
+        assert table.pattern(words.index("eerie"), words.index("there")) == pattern(b"eerie", b"there")
+
+    # describe: a table of other words
+    assert open_table(path, packed.replace(b"bigot", b"bight"), 5) is None, "it: is not used"
+    assert open_table(path, packed[5:], 5) is None
+
+    # describe: rank with a table
+    everything = list(range(len(words)))
+    expected = Ranker(WordIndex(packed, 5, use_numpy=False)).rank(everything, 5, budget=10)
+    assert Ranker(WordIndex(packed, 5, use_numpy=False), table).rank(everything, 5, budget=10) == expected
+    assert Ranker(WordIndex(packed, 5), table).rank(everything, 5, budget=10) == expected
+    assert Ranker(WordIndex(packed, 5, use_numpy=False), table).rank([3], 1, budget=10)[0].index == 3
+
+    # describe: mark a guess with a table
+    monkeypatch.setattr(db, "INDEX", WordIndex(packed, 5))
+    monkeypatch.setattr(db, "TABLE", table)
+    assert mark_guess("eerie", "there") == [FOUND, MISS, FOUND, MISS, HIT]
+    assert mark_guess("speed", "abide") == [MISS, MISS, FOUND, MISS, FOUND], "it: marks words not in the table"
+    assert db.INDEX.find("bigot") == 0 and db.INDEX.find("torch") == 19 and db.INDEX.find("zebra") is None
+
+def test_unit_of_work(monkeypatch, tmp_path):
+    dictionary = tmp_path / "dictionary.csv"
+    dictionary.write_text("bigot\ntorch\nforty\n")
+    db.set_randomize_words(False)
+    db.set_dictionary_name(str(dictionary))
+    db.set_database_name("unit.sqlite3")
+    db.delete_database()
+    db.start_database()
+    clear_puzzle_cache()
+    # The first word is today's
+    set_current_date(datetime.now().strftime("%m-%d-%Y"))
+
+    # describe: a unit that raises
+    with pytest.raises(ValueError):
+        with db.unit_of_work():
+            db.insert_user_word(9, 1)
+            assert len(db.select("SELECT * FROM user_words WHERE user_id = 9")) == 1, "it: reads its own writes"
+            raise ValueError()
+    assert db.select("SELECT * FROM user_words WHERE user_id = 9") == [], "it: saves nothing"
+
+    # describe: a unit of several statements
+    get_conn = db.get_conn
+    conns = []
+    monkeypatch.setattr(db, "get_conn", lambda: conns.append(1) or get_conn())
+    with db.unit_of_work():
+        user_word_id = db.insert_user_word(9, 1)
+        with db.unit_of_work():
+            db.update_user_word(user_word_id, 1, "", 0, None)
+        db.get_user_word(user_word_id)
+    assert len(conns) == 1, "it: uses one connection"
+    assert db.get_user_word(user_word_id).guess_number == 1, "it: saves every statement"
+    monkeypatch.setattr(db, "get_conn", get_conn)
+
+    # describe: a finishing guess that fails
+    get_current_puzzle(1)
+    guess_word(1, "torch")
+    def fail(*args):
+        raise RuntimeError("disk full")
+    monkeypatch.setattr(db, "update_user_state_last_played_date", fail)
+    with pytest.raises(RuntimeError):
+        guess_word(1, "bigot")
+    puzzle = get_current_puzzle(1)
+    assert (puzzle.guessNumber, puzzle.solved) == (1, None), "it: does not save the guess"
+    assert get_statistics(1).played == 0, "it: does not save statistics"
+
+    # describe: the guess, again
+    monkeypatch.undo()
+    puzzle = guess_word(1, "bigot")
+    assert puzzle.solved
+    assert get_current_puzzle(1).solved
+    assert get_statistics(1).won == 1
+    db.delete_database()
+
+def test_compact_guesses(tmp_path):
+    from io.bithead.wordy.model import TypedLetter, decode_attempts, encode_attempts, make_keys
+    import json
+
+    def attempt(word, marks):
+        states = {"0": "miss", "1": "found", "2": "hit"}
+        return [TypedLetter(letter=letter, state=states[mark]) for letter, mark in zip(word, marks)]
+
+    attempts = [attempt("hello", "00001"), attempt("torch", "10200"), attempt("bigot", "22222")]
+
+    # describe: encode guesses
+    guesses = encode_attempts(attempts)
+    assert guesses == "hello00001,torch10200,bigot22222"
+    assert decode_attempts(guesses) == attempts, "it: decodes what it encodes"
+    assert decode_attempts(None) == [] and decode_attempts("") == []
+    assert make_keys(attempts) == {
+        "h": "miss", "e": "miss", "l": "miss", "o": "hit", "t": "hit", "r": "hit", "c": "miss", "b": "hit",
+        "i": "hit", "g": "hit"
+    }, "it: keeps the best mark of each letter"
+
+    # describe: migrate a v1.0.0 database
+    dictionary = tmp_path / "dictionary.csv"
+    dictionary.write_text("bigot\ntorch\nhello\n")
+    db.set_randomize_words(False)
+    db.set_dictionary_name(str(dictionary))
+    db.set_database_name("compact.sqlite3")
+    db.delete_database()
+    conn = db.get_conn()
+    try:
+        db.create_version_1_0_0(conn, None)
+        conn.execute("""
+            INSERT INTO user_words (user_id, word_id, create_date, update_date, guess_number, attempts, keys, solved)
+            VALUES (1, 1, '2026-01-01', '2026-01-01', 2, ?, ?, 1)
+        """, (json.dumps([[letter.model_dump() for letter in a] for a in attempts]), json.dumps(make_keys(attempts))))
+        conn.execute("""
+            INSERT INTO user_words (user_id, word_id, create_date, update_date)
+            VALUES (2, 1, '2026-01-01', '2026-01-01')
+        """)
+        conn.commit()
+    finally:
+        conn.close()
+
+    db.start_database()
+    conn = db.get_conn()
+    try:
+        assert db.get_db_version(conn) == (1, 1, 0)
+    finally:
+        conn.close()
+    played, unplayed = db.get_friend_user_words(1, [1, 2])
+    assert (played.guesses, played.num_guesses, played.solved) == (guesses, 3, True), "it: encodes guesses"
+    assert (played.attempts, played.keys) == (None, None), "it: drops the JSON"
+    assert (unplayed.guesses, unplayed.num_guesses) == (None, 0)
+
+    # describe: start a migrated database
+    db.start_database()
+    puzzle = make_puzzle(1, played)
+    assert puzzle.attempts == attempts
+    assert puzzle.keys == make_keys(attempts)
+    save_puzzle(puzzle)
+    assert db.get_user_word(played.id).guesses == guesses, "it: saves guesses encoded"
+    db.delete_database()
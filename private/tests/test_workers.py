@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+#
+# Tests the worker pool async routes hand blocking rules to
+#
+
+import asyncio
+import contextvars
+import os
+import pytest
+import threading
+import time
+
+from fastapi import HTTPException
+from libtest import *
+from lib import workers
+from lib.workers import ProcessPool, WorkerPool, blocking, run_sync
+
+CALLER = contextvars.ContextVar("caller", default=None)
+
+
+def test_run_sync():
+    def whoami(greeting):
+        return greeting, threading.current_thread().name, CALLER.get()
+
+    def refuse():
+        raise ValueError("no")
+
+    async def calls():
+        CALLER.set("ada")
+        return await run_sync(whoami, "hi")
+
+    greeting, thread, caller = asyncio.run(calls())
+    assert greeting == "hi"
+    assert thread.startswith("boss-worker"), "it: runs off the event loop"
+    assert caller == "ada", "it: runs with the caller's context"
+
+    with pytest.raises(ValueError):
+        asyncio.run(run_sync(refuse))
+
+    @blocking
+    def double(value):
+        return value * 2
+    assert asyncio.run(double(2)) == 4
+    assert workers.get_worker_stats().completed >= 3
+
+
+def test_full_pool():
+    pool = WorkerPool(threads=1, queue=1)
+    release = threading.Event()
+
+    async def overload():
+        first = asyncio.ensure_future(pool.run(release.wait))
+        second = asyncio.ensure_future(pool.run(release.wait))
+        await asyncio.sleep(0.05)
+        stats = pool.stats()
+        with pytest.raises(HTTPException) as exc:
+            await pool.run(release.wait)
+        release.set()
+        await asyncio.gather(first, second)
+        return stats, exc.value
+
+    stats, refused = asyncio.run(overload())
+    assert stats.active == 1 and stats.queued == 1
+    assert refused.status_code == 503, "it: refuses work past its queue"
+    assert refused.headers["Retry-After"] == "1"
+    assert pool.stats().rejected == 1
+    assert pool.stats().completed == 2
+    pool.shutdown()
+
+
+def test_process_pool():
+    pool = ProcessPool(processes=1, queue=1)
+
+    async def calls():
+        assert await pool.run(int, "7") == 7
+        with pytest.raises(ValueError):
+            await pool.run(int, "x")
+
+        # describe: a cancelled caller
+        slow = asyncio.ensure_future(pool.run(time.sleep, 0.5))
+        await asyncio.sleep(0.2)
+        slow.cancel()
+        await asyncio.sleep(0)
+        cancelled = pool.stats()
+        queued = asyncio.ensure_future(pool.run(time.sleep, 0))
+        await asyncio.sleep(0)
+        with pytest.raises(HTTPException):
+            await pool.run(time.sleep, 0)
+        await queued
+
+        # describe: a process dies
+        executor = pool.executor
+        with pytest.raises(HTTPException) as exc:
+            await pool.run(os._exit, 1)
+        return cancelled, exc.value, executor
+
+    cancelled, died, executor = asyncio.run(calls())
+    assert cancelled.pending == 1, "it: counts the call until its process is done with it"
+    assert cancelled.rejected == 0 and pool.stats().rejected == 1, "it: leaves no room for more work than the processes can run"
+    assert died.status_code == 503, "it: refuses the call"
+    assert pool.executor is not executor, "it: starts new processes"
+    assert asyncio.run(pool.run(int, "8")) == 8
+
+    stats = pool.stats()
+    assert stats.completed == 4, "it: counts calls that returned"
+    assert stats.failed == 2, "it: counts calls that raised, or whose process died"
+    assert stats.pending == 0
+    pool.shutdown()